@@ -0,0 +1,483 @@
+import argparse
+import io
+import os
+import secrets
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.connection import AuthenticationError, Client, Listener
+from pathlib import Path
+
+from cfstore.plugins.ssh import SSHlite
+
+# seconds an unused connection is kept open (and the broker stays up without any)
+IDLE_TIMEOUT = 600
+# bytes of remote command output sent back to a client at a time
+EXEC_BLOCKSIZE = 65536
+
+
+def broker_paths():
+    """
+    Return the paths of the broker socket and the key clients use to authenticate
+    to it, which live in the cfstore configuration directory (or $CFS_BROKER_DIR).
+    """
+    cfdir = Path(os.getenv("CFS_BROKER_DIR", Path.home() / ".cfstore"))
+    return cfdir / "broker.sock", cfdir / "broker.key"
+
+
+def _authkey(keyfile, create=False):
+    """Read (or if <create>, make) the broker key, readable only by this user"""
+    if not keyfile.exists():
+        if not create:
+            return None
+        keyfile.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(keyfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(secrets.token_bytes(32))
+    return keyfile.read_bytes()
+
+
+class Broker:
+    """
+    A local process which holds authenticated SSH connections open, one per
+    (host, user), and carries out remote commands and SFTP operations for
+    clients which connect to it over a UNIX socket. Connections which are not
+    used for <idle_timeout> seconds are closed, and the broker exits once it
+    has had no connections for that long.
+
+    The output of remote commands is streamed back to the client as it is
+    produced, and each client connection is served by its own thread, so
+    commands on one SSH connection run concurrently. SFTP operations on one
+    SSH connection are carried out one at a time, since they share its single
+    SFTP channel (so, for example, a brokered <SSHlite.walk_files> lists one
+    directory at a time, rather than one per channel).
+    """
+
+    def __init__(self, idle_timeout=IDLE_TIMEOUT, socket_path=None, keyfile=None):
+        default_socket, default_key = broker_paths()
+        self.socket_path = Path(socket_path or default_socket)
+        self.keyfile = Path(keyfile or default_key)
+        self.idle_timeout = idle_timeout
+        # (host, user) -> [SSHlite, lock for its SFTP client, time last used]
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.busy = 0
+        self.last_used = time.time()
+        self.stopped = False
+
+    def _connection(self, host, user):
+        """Return the connection (and its SFTP lock) for <host> and <user>, opening it if need be"""
+        with self.lock:
+            entry = self.connections.get((host, user))
+            if entry is None or not entry[0].isalive():
+                print(f"Broker connecting to {user}@{host}")
+                entry = [SSHlite(host, user, logging=False), threading.Lock(), 0]
+                self.connections[(host, user)] = entry
+            entry[2] = time.time()
+            return entry[0], entry[1]
+
+    def _do(self, host, user, op, args, send):
+        """
+        Carry out one operation <op> for a client, using <send> to stream back
+        any output before the result is returned.
+        """
+        if op == "ping":
+            return os.getpid()
+        if op == "stop":
+            self._stop()
+            return None
+        ssh, sftp_lock = self._connection(host, user)
+        if op == "exec":
+            (command,) = args
+            stdin, stdout, stderr = ssh._client.exec_command(command)
+            stdin.close()
+            try:
+                # the channel returns output as soon as some has arrived
+                for chunk in iter(lambda: stdout.channel.recv(EXEC_BLOCKSIZE), b""):
+                    send(("chunk", chunk))
+            except OSError:
+                # the client went away, do not leave the command running
+                stdout.channel.close()
+                raise
+            return stderr.read(), stdout.channel.recv_exit_status()
+        with sftp_lock:
+            if op in ("stat", "listdir", "listdir_attr", "remove", "get", "put"):
+                return getattr(ssh._sftp, op)(*args)
+            if op == "putfo":
+                remotepath, data = args
+                return ssh._sftp.putfo(io.BytesIO(data), remotepath)
+            if op == "getfo":
+                (remotepath,) = args
+                buffer = io.BytesIO()
+                ssh._sftp.getfo(remotepath, buffer)
+                return buffer.getvalue()
+        raise ValueError(f"Unknown broker operation {op}")
+
+    def _handle(self, conn):
+        """Serve the requests from one client until it goes away"""
+        with conn:
+            while True:
+                try:
+                    host, user, op, args = conn.recv()
+                except (EOFError, OSError):
+                    return
+                with self.lock:
+                    self.busy += 1
+                try:
+                    reply = ("ok", self._do(host, user, op, args, conn.send))
+                except Exception as e:
+                    reply = ("error", e)
+                finally:
+                    with self.lock:
+                        self.busy -= 1
+                        self.last_used = time.time()
+                try:
+                    conn.send(reply)
+                except OSError:
+                    # the client went away
+                    return
+                except Exception as e:
+                    # e.g. an exception which cannot be pickled
+                    conn.send(("error", OSError(f"{type(e).__name__}: {e}")))
+
+    def _reap(self):
+        """Close idle connections, and stop the broker when it has been idle too long"""
+        while not self.stopped:
+            time.sleep(min(self.idle_timeout / 4, 30))
+            now = time.time()
+            with self.lock:
+                for key, (ssh, sftp_lock, used) in list(self.connections.items()):
+                    if now - used > self.idle_timeout and not self.busy:
+                        print(f"Broker closing idle connection to {key[1]}@{key[0]}")
+                        ssh._client.close()
+                        del self.connections[key]
+                idle = not self.connections and not self.busy
+            if idle and now - self.last_used > self.idle_timeout:
+                self._stop()
+
+    def _stop(self):
+        """Stop accepting clients (waking up the accept loop to notice)"""
+        if self.stopped:
+            return
+        self.stopped = True
+        try:
+            Client(
+                str(self.socket_path),
+                family="AF_UNIX",
+                authkey=_authkey(self.keyfile),
+            ).close()
+        except OSError:
+            pass
+
+    def serve(self):
+        """
+        Accept clients on the broker socket until stopped or idle for too long.
+        """
+        if connect_broker(self.socket_path, self.keyfile) is not None:
+            raise ValueError(f"A broker is already listening on {self.socket_path}")
+        if self.socket_path.exists():
+            # left behind by a broker which died
+            os.remove(self.socket_path)
+        key = _authkey(self.keyfile, create=True)
+        listener = Listener(str(self.socket_path), family="AF_UNIX", authkey=key)
+        os.chmod(self.socket_path, 0o600)
+        threading.Thread(target=self._reap, daemon=True).start()
+        print(f"Broker {os.getpid()} listening on {self.socket_path}")
+        try:
+            while not self.stopped:
+                try:
+                    conn = listener.accept()
+                except (AuthenticationError, EOFError, OSError):
+                    continue
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            listener.close()
+            with self.lock:
+                for ssh, sftp_lock, used in self.connections.values():
+                    ssh._client.close()
+                self.connections = {}
+            print("Broker stopped")
+
+
+class BrokerClient:
+    """
+    A connection to a running <Broker>, which can be shared between threads.
+    """
+
+    def __init__(self, socket_path=None, keyfile=None):
+        default_socket, default_key = broker_paths()
+        self.address = str(socket_path or default_socket)
+        self.authkey = _authkey(Path(keyfile or default_key))
+        self.conn = Client(self.address, family="AF_UNIX", authkey=self.authkey)
+        self.lock = threading.Lock()
+
+    def call(self, host, user, op, *args):
+        """Ask the broker to carry out <op> on the connection to <host> as <user>"""
+        with self.lock:
+            self.conn.send((host, user, op, args))
+            status, result = self.conn.recv()
+        if status == "error":
+            raise result
+        return result
+
+    def stream(self, host, user, op, *args):
+        """
+        As <call>, but yield the chunks of output the broker streams back as they
+        arrive, and return the result at the end. Each stream has a connection
+        to the broker of its own, so it does not hold up other calls.
+        """
+        with Client(self.address, family="AF_UNIX", authkey=self.authkey) as conn:
+            conn.send((host, user, op, args))
+            while True:
+                status, result = conn.recv()
+                if status == "chunk":
+                    yield result
+                elif status == "error":
+                    raise result
+                else:
+                    return result
+
+    def close(self):
+        self.conn.close()
+
+
+def connect_broker(socket_path=None, keyfile=None):
+    """
+    Return a <BrokerClient> for the broker, or None if no broker is running.
+    """
+    default_socket, default_key = broker_paths()
+    socket_path = Path(socket_path or default_socket)
+    keyfile = Path(keyfile or default_key)
+    if not socket_path.exists() or not keyfile.exists():
+        return None
+    try:
+        client = BrokerClient(socket_path, keyfile)
+        client.call(None, None, "ping")
+    except (OSError, EOFError, AuthenticationError):
+        return None
+    return client
+
+
+def start_broker(idle_timeout=IDLE_TIMEOUT, wait=10):
+    """
+    Start a broker in the background (if one is not already running), logging to
+    broker.log next to the socket, and return a <BrokerClient> for it.
+    """
+    client = connect_broker()
+    if client is not None:
+        return client
+    socket_path, keyfile = broker_paths()
+    socket_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(socket_path.with_name("broker.log"), "a") as log:
+        subprocess.Popen(
+            [sys.executable, "-m", "cfstore.broker", "--idle", str(idle_timeout)],
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+    deadline = time.time() + wait
+    while time.time() < deadline:
+        time.sleep(0.1)
+        client = connect_broker()
+        if client is not None:
+            return client
+    raise ValueError(f"Broker did not start, see {socket_path.with_name('broker.log')}")
+
+
+class _Channel:
+    def __init__(self, status):
+        self.status = status
+
+    def recv_exit_status(self):
+        return self.status
+
+
+class _Output(io.BytesIO):
+    """The completed output of a brokered command, read like a paramiko ChannelFile"""
+
+    def __init__(self, data, status):
+        super().__init__(data)
+        self.channel = _Channel(status)
+
+    def readline(self, size=-1):
+        return super().readline(size).decode("utf-8", "replace")
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, ""))
+
+    def __iter__(self):
+        return iter(self.readline, "")
+
+
+class _StreamedOutput:
+    """
+    The standard output of a brokered command, read like a paramiko ChannelFile
+    as it streams back. Its channel gives the exit status (once all the output
+    has arrived).
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = b""
+        self.result = None
+        self.channel = self
+        # wait for the command to start, whether or not its output is read
+        self._fill()
+
+    def _fill(self):
+        """Add the next chunk to the buffer, returning False at the end of the output"""
+        if self.result is not None:
+            return False
+        try:
+            self.buffer += next(self.chunks)
+        except StopIteration as end:
+            self.result = end.value
+            return False
+        return True
+
+    def read(self, size=-1):
+        while (size < 0 or len(self.buffer) < size) and self._fill():
+            pass
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        while b"\n" not in self.buffer and self._fill():
+            pass
+        end = self.buffer.find(b"\n") + 1 or len(self.buffer)
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        return line.decode("utf-8", "replace")
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, ""))
+
+    def __iter__(self):
+        return iter(self.readline, "")
+
+    def wait(self):
+        """Return (standard error, exit status), keeping any unread output"""
+        while self._fill():
+            pass
+        return self.result
+
+    def recv_exit_status(self):
+        return self.wait()[1]
+
+
+class _StreamedError:
+    """The standard error of a brokered command, which arrives after its output"""
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.channel = stdout
+        self.output = None
+
+    def _output(self):
+        if self.output is None:
+            self.output = _Output(*self.stdout.wait())
+        return self.output
+
+    def read(self, size=-1):
+        return self._output().read(size)
+
+    def readline(self, size=-1):
+        return self._output().readline(size)
+
+    def readlines(self, hint=-1):
+        return self._output().readlines(hint)
+
+    def __iter__(self):
+        return iter(self._output())
+
+
+class _BrokeredClient:
+    """Stands in for the paramiko SSHClient of an <SSHlite>"""
+
+    def __init__(self, broker, host, user):
+        self.broker, self.host, self.user = broker, host, user
+
+    def exec_command(self, command):
+        stdout = _StreamedOutput(
+            self.broker.stream(self.host, self.user, "exec", command)
+        )
+        return io.BytesIO(), stdout, _StreamedError(stdout)
+
+    def close(self):
+        pass
+
+
+class _BrokeredSFTP:
+    """Stands in for the paramiko SFTPClient of an <SSHlite>"""
+
+    def __init__(self, broker, host, user):
+        self.broker, self.host, self.user = broker, host, user
+
+    def _call(self, op, *args):
+        return self.broker.call(self.host, self.user, op, *args)
+
+    def stat(self, path):
+        return self._call("stat", path)
+
+    def listdir(self, path="."):
+        return self._call("listdir", path)
+
+    def listdir_attr(self, path="."):
+        return self._call("listdir_attr", path)
+
+    def remove(self, path):
+        return self._call("remove", path)
+
+    def get(self, remotepath, localpath):
+        # the broker runs on this machine, but not necessarily in this directory
+        return self._call("get", remotepath, os.path.abspath(localpath))
+
+    def put(self, localpath, remotepath):
+        return self._call("put", os.path.abspath(localpath), remotepath)
+
+    def putfo(self, fl, remotepath):
+        return self._call("putfo", remotepath, fl.read())
+
+    def getfo(self, remotepath, fl):
+        data = self._call("getfo", remotepath)
+        fl.write(data)
+        return len(data)
+
+    def open(self, remotepath, mode="r"):
+        if "r" not in mode or "+" in mode:
+            raise ValueError("Brokered remote files can only be opened for reading")
+        return io.BytesIO(self._call("getfo", remotepath))
+
+
+class BrokeredSSHlite(SSHlite):
+    """
+    An <SSHlite> which borrows the connection held open by a running <Broker>
+    rather than connecting (and authenticating) itself. Remote commands (and so
+    <find_files> and <checksum_files>) stream their output back as usual, but
+    SFTP operations go through the broker one at a time (see <Broker>).
+    """
+
+    def __init__(self, host, username, broker, logging=False):
+        self.logging = logging
+        # there is no transport here, so walks share the brokered SFTP client
+        self.transport = None
+        self._client = _BrokeredClient(broker, host, username)
+        self._sftp = _BrokeredSFTP(broker, host, username)
+        self.broker = broker
+
+    def isalive(self):
+        try:
+            self.broker.call(None, None, "ping")
+        except (OSError, EOFError):
+            return False
+        return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the cfstore SSH broker")
+    parser.add_argument("--idle", type=int, default=IDLE_TIMEOUT)
+    args = parser.parse_args()
+    Broker(idle_timeout=args.idle).serve()
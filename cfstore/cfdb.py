@@ -890,5 +890,19 @@ def delete_file(ctx, collection, file):
     db.delete_file_from_collection(collection, file)
 
 
+@cli.command()
+@click.pass_context
+def reindex(ctx):
+    """
+    Give fingerprints to variables which lack them, and rebuild the
+    variable property table and facet counts, for variables added before
+    these existed (they are otherwise not found by property searches).
+    Usage: cfsdb reindex
+    """
+    view_state, db = _set_context(ctx, None)
+    print(db.fingerprint_variables(), "variables given fingerprints")
+    print(db.index_variable_properties(), "variables indexed")
+
+
 if __name__ == "__main__":
     safe_cli()
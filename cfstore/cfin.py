@@ -3,6 +3,7 @@ from pathlib import Path
 
 import click
 
+from cfstore.broker import Broker, connect_broker, start_broker
 from cfstore.config import CFSconfig
 from cfstore.plugins.et_main import et_main
 from cfstore.plugins.posix import Posix, RemotePosix
@@ -62,7 +63,13 @@ def cli(ctx, fstype):
     default=False,
     help="(Optional) When true, searches subcollections.",
 )
-def add(ctx, description, regexselect, subcollections, arg1, argm):
+@click.option(
+    "--resume",
+    is_flag=True,
+    default=False,
+    help="(Optional) Resume an interrupted add of the same collection.",
+)
+def add(ctx, description, regexselect, subcollections, resume, arg1, argm):
     """
 
     Add collection to the cfdb.
@@ -83,6 +90,7 @@ def add(ctx, description, regexselect, subcollections, arg1, argm):
 
     No collection or description names are required because this will load a collection
     for each elastic tape batch, and you will need to add descriptions for each batch later.
+    Re-running the same command later only ingests batches which are new or have changed.
 
     To add a directory_path at remote posix location with a particular collection_name::
 
@@ -93,6 +101,11 @@ def add(ctx, description, regexselect, subcollections, arg1, argm):
     are used for the collection description, otherwise the application opens
     your standard editor to use for description content.
 
+    If an add dies part way through, re-run the same command with --resume to
+    skip the files which were already committed::
+
+        cfin rp add location directory_path_at_location collection_name --resume
+
     """
     state = CFSconfig()
     target = ctx.obj["fstype"]
@@ -110,6 +123,9 @@ def add(ctx, description, regexselect, subcollections, arg1, argm):
             assert path.exists()
             with open(path, "r") as f:
                 description = f.read()
+        elif resume:
+            # the collection, and its description, already exist
+            description = None
         else:
             # if len(argm) != 2:
             #    raise InputError('InputError: Missing arguments', add.__doc__)
@@ -142,6 +158,7 @@ def add(ctx, description, regexselect, subcollections, arg1, argm):
                 description,
                 subcollections=subcollections,
                 regex=regexselect,
+                resume=resume,
             )
 
         elif target == "local" or target == "p":
@@ -155,12 +172,95 @@ def add(ctx, description, regexselect, subcollections, arg1, argm):
                 description,
                 subcollections=subcollections,
                 regex=regexselect,
+                resume=resume,
             )
         else:
             raise ValueError(f"Unexpected location type {target}")
     state.save()
 
 
+@cli.command()
+@click.pass_context
+@click.argument("collection")
+@click.option(
+    "--deep",
+    is_flag=True,
+    default=False,
+    help="(Optional) Also check files in unchanged directories for modification.",
+)
+def rescan(ctx, collection, deep):
+    """
+    Bring a local posix collection up to date with the files now on disk.
+
+    Usage::
+
+        cfin p rescan collection_name
+
+    Only directories which have changed since the collection was added (or last
+    rescanned) are listed again. Files modified in place do not change their
+    directory, so use --deep to check every known file for modification.
+    """
+    state = CFSconfig()
+    target = ctx.obj["fstype"]
+    if target == "local" or target == "p":
+        x = Posix(state.db, collection)
+        x.rescan(collection, deep=deep)
+    else:
+        raise ValueError(f"Rescan not supported for location type {target}")
+    state.save()
+
+
+@cli.command()
+@click.pass_context
+@click.argument("collection")
+@click.option(
+    "--method",
+    default="sha256",
+    help="(Optional) Checksum method, e.g. sha256, md5, blake2b, or xxh3_64 and blake3 if installed",
+)
+@click.option(
+    "--processes", default=4, help="(Optional) Number of checksum processes"
+)
+@click.option(
+    "--update/--no-update",
+    default=True,
+    help="(Optional) Whether to replace checksums which have changed",
+)
+@click.option(
+    "--location", default=None, help="Remote location of the collection (for rp)"
+)
+def check(ctx, collection, method, processes, update, location):
+    """
+    Checksum the files in a posix collection, and list those whose
+    checksums have changed since they were last checked. Remote files
+    are checksummed on the remote host.
+
+    Usage::
+
+        cfin p check collection_name --processes=8
+        cfin rp check collection_name --location=location
+    """
+    state = CFSconfig()
+    target = ctx.obj["fstype"]
+    if target == "local" or target == "p":
+        x = Posix(state.db, collection)
+    elif target == "rp":
+        if not location:
+            raise InputError("InputError: Missing location", check.__doc__)
+        x = RemotePosix(state.db, location)
+        x.configure(
+            state.get_location(location)["host"], state.get_location(location)["user"]
+        )
+    else:
+        raise ValueError(f"Check not supported for location type {target}")
+    changed = x.check_collection(
+        collection, update=update, processes=processes, method=method
+    )
+    for f in changed:
+        print(f"Checksum changed: {f.path}/{f.name}")
+    state.save()
+
+
 """
 #This with the right arguments can run scripts on Jasmin
 #Most of the work is done in the arguments though
@@ -292,6 +392,43 @@ def getBMetadataClean(
     state.save()
 
 
+@cli.command()
+@click.pass_context
+@click.option(
+    "--idle",
+    default=600,
+    help="(Optional) Seconds before idle connections (and the broker) are closed",
+)
+@click.option(
+    "--background", is_flag=True, default=False, help="(Optional) Run in background"
+)
+@click.option("--stop", is_flag=True, default=False, help="Stop a running broker")
+def broker(ctx, idle, background, stop):
+    """
+    Run a connection broker which keeps SSH connections to remote posix locations
+    open between cfin commands, so that they need not connect and authenticate
+    every time. Commands use the broker whenever it is running.
+
+    Usage::
+
+        cfin rp broker --background
+        cfin rp broker --stop
+    """
+    if ctx.obj["fstype"] != "rp":
+        raise ValueError("The connection broker is only used for remote posix (rp)")
+    if stop:
+        client = connect_broker()
+        if client is None:
+            print("No broker running")
+        else:
+            client.call(None, None, "stop")
+    elif background:
+        client = start_broker(idle_timeout=idle)
+        print(f"Broker running (pid {client.call(None, None, 'ping')})")
+    else:
+        Broker(idle_timeout=idle).serve()
+
+
 @cli.command()
 @click.pass_context
 @click.argument("location")
@@ -1,14 +1,17 @@
 import cfdm
-from cfstore.db import Variable
+from cfstore.db import File, Variable, index_new_variables, variable_fingerprint
+from cfstore.ingest import chunked
+from cfstore.metacache import file_stamp
+from concurrent.futures import ProcessPoolExecutor
+from django.db import transaction
 import numpy as np
 import os
-from deepdiff import DeepDiff
 import time
 
 
 def manage_types(value):
-    """ 
-    The database only supports variable values which are boolean, int, string, and float. 
+    """
+    The database only supports variable values which are boolean, int, string, and float.
     """
     if isinstance(value, str):
         return value
@@ -24,74 +27,162 @@ def manage_types(value):
         raise ValueError('Unrecognised type for database ',type(value))
 
 
-
-def cfparse_file(db, filename):
-    """  
-    Parse a file and load cf metadata into the database 
+def extract_file_metadata(filename):
+    """
+    Read a file with cfdm and return the metadata of each field in it as
+    a plain dictionary (so it can be handed back from a worker process)
     :Parameters:
-        db: `CollectionDB` 
-            an instance of a collection database
         filename: `str`
             filename which will be parsed
     :Returns:
-        None
+        list of dictionaries with keys identity, standard_name, long_name,
+        size, domain, properties, cell_methods and filenames
     **Examples:**
-    >>> cfparse_file(db, 'my_model_file.nc')
+    >>> extract_file_metadata('my_model_file.nc')[0]['standard_name']
+    'air_temperature'
     """
-    print("Running cfparse_file")
-    cff = cfdm.read(filename)
+    records = []
     # loop over fields in file (not the same as netcdf variables)
-    for v in cff:
+    for v in cfdm.read(filename):
         properties = v.properties()
-
         if ('standard_name' not in properties and 'long_name' not in properties):
-            properties['long_name'] = v.identity
-        name, long_name = v.get_property('standard_name', None), v.get_property('long_name', None)
+            properties['long_name'] = v.identity()
+        cell_methods = []
+        for cm in v.cell_methods().values():
+            cell_methods.append({'axes': list(cm.get_axes(())), 'methods': cm.get_method(None)})
+        records.append({
+            'identity': v.identity(),
+            'standard_name': properties.get('standard_name'),
+            'long_name': properties.get('long_name'),
+            'size': int(v.size),
+            'domain': v.domain._one_line_description(),
+            'properties': {k: manage_types(p) for k, p in properties.items()
+                           if k not in ['standard_name', 'long_name']},
+            'cell_methods': cell_methods,
+            'filenames': sorted(v.get_filenames()),
+        })
+    return records
 
-        domain = v.domain._one_line_description()
-        size = v.size
 
-        var = Variable(standard_name=name, long_name=long_name, cfdm_size=size, cfdm_domain=domain)
-        for k,p in properties.items():
-            if k not in ['standard_name','long_name']:
-                var[k] = manage_types(p) 
+def _extract_task(filename):
+    """ Worker wrapper around <extract_file_metadata> which reports rather than raises errors """
+    start = time.perf_counter()
+    try:
+        records, error = extract_file_metadata(filename), None
+    except Exception as e:
+        records, error = [], f'{type(e).__name__}: {e}'
+    return filename, records, error, time.perf_counter() - start
 
-        for file in v.get_filenames():
-            for f in db.retrieve_files_which_match(os.path.basename(file)):
-                var.in_files.add(f)
 
-        #there is a more pythonic way of doing this
-        #if db.retrieve_variable("long_name",var.long_name) should check emptiness but something is going wrong
-        #I'm just leaving this working before I go mad but #FIXME later
-        #Post-fixme update - comparisons are now checking for exactness. Two things are missing - 
-        #   first should we be checking everything? Probably not, there will be some very similar variables we can group
-        #   second these only included ordered lists which definitely needs to be changed - those are at least one example of similar variables we can group
-        querylist = []
-        duplicate = True
-        if var.long_name:
-            querylist = db.retrieve_variable("long_name",var.long_name)
-        if var.standard_name:
-            querylist = db.retrieve_variable("standard_name",var.standard_name)
-        if var.long_name and var.standard_name:
-            querylist = db.retrieve_variable("long_name",var.long_name)+db.retrieve_variable("standard_name",var.standard_name)
-        if querylist:
-            for queryvar in querylist:
-                if var.cfdm_domain == queryvar.cfdm_domain and var.cfdm_size == queryvar.cfdm_size:
-                    if DeepDiff(var.get_properties(verbosity=2)[1:],queryvar.get_properties(verbosity=2)[1:]):
-                        duplicate=True
-                    else:
-                        duplicate = False
-                else:
-                    duplicate = False
-        else:   
-            duplicate = False
-        
-        if not duplicate:
-            db.session.add(var)
+def harvest(filenames, processes=4, batch=64, cache=None):
+    """
+    Extract the metadata of the fields in each of <filenames> on a pool
+    of <processes> worker processes (one file per task), consuming the
+    filenames <batch> at a time. Yields (filename, records) in order, where
+    records are as returned by <extract_file_metadata>. Files which cannot
+    be read are reported and yield no records. If a <MetadataCache> is given
+    as <cache>, files which are unchanged since they were cached are not read
+    again, and the metadata of the others is added to it.
+    """
+    with ProcessPoolExecutor(max_workers=max(processes, 1)) as pool:
+        for chunk in chunked((str(f) for f in filenames), batch):
+            stamps, results = {}, {}
+            if cache is not None:
+                for f in chunk:
+                    stamps[f] = file_stamp(f)
+                    if stamps[f] is not None:
+                        records = cache.get(stamps[f])
+                        if records is not None:
+                            results[f] = records
+            todo = [f for f in chunk if f not in results]
+            tasks = pool.map(_extract_task, todo) if processes > 1 else map(_extract_task, todo)
+            for filename, records, error, seconds in tasks:
+                if error:
+                    print(f'Unable to parse {filename}: {error}')
+                elif stamps.get(filename) is not None:
+                    cache.put(stamps[filename], records)
+                results[filename] = records
+            if cache is not None:
+                cache.flush()
+            for f in chunk:
+                yield f, results[f]
+
+
+def record_fingerprint(record):
+    """ The <variable_fingerprint> of a record from <extract_file_metadata> """
+    return variable_fingerprint(record['identity'], record['standard_name'], record['long_name'],
+                                record['size'], record['domain'], record['properties'],
+                                record['cell_methods'])
 
-        for m, cm in v.cell_methods().items():
-            for a in cm.get_axes(): 
-                method = cm.get_method()
-                dbmethod = db.cell_method_get_or_make(axis=a, method=method)
-                dbmethod.used_in.append(var)
-        db.session.commit()
+
+def store_variables(records, collection=None, chunksize=500):
+    """
+    Write the variable metadata <records> (as returned by <extract_file_metadata>)
+    into the database, <chunksize> records per transaction, linking each variable
+    to the files (already in the database) it was read from, and to <collection>
+    if given. Variables identical to ones already in the database are not added
+    again, but pick up the new files. Returns the number of new variables.
+    """
+    added = 0
+    for chunk in chunked(records, chunksize):
+        with transaction.atomic():
+            fingerprints = [record_fingerprint(r) for r in chunk]
+            # one indexed lookup for the whole chunk
+            existing = {v.fingerprint: v for v in Variable.objects.filter(
+                fingerprint__in=set(fingerprints))}
+            variables, new = [], []
+            for r, fp in zip(chunk, fingerprints):
+                var = existing.get(fp)
+                if var is None:
+                    var = Variable(identity=r['identity'], standard_name=r['standard_name'],
+                                   long_name=r['long_name'], cfdm_size=r['size'],
+                                   cfdm_domain=r['domain'], _proxied=r['properties'],
+                                   _cell_methods=r['cell_methods'], fingerprint=fp)
+                    existing[fp] = var
+                    new.append(var)
+                variables.append(var)
+            Variable.objects.bulk_create(new)
+            index_new_variables(new)
+            added += len(new)
+
+            names = {os.path.basename(f) for r in chunk for f in r['filenames']}
+            files = {}
+            for f in File.objects.filter(name__in=names).only('id', 'name'):
+                files.setdefault(f.name, []).append(f.id)
+            file_links = {(var.id, fid) for r, var in zip(chunk, variables)
+                          for f in r['filenames'] for fid in files.get(os.path.basename(f), [])}
+            Variable.in_files.through.objects.bulk_create(
+                [Variable.in_files.through(variable_id=v, file_id=f) for v, f in file_links],
+                ignore_conflicts=True)
+            if collection is not None:
+                Variable.in_collection.through.objects.bulk_create(
+                    [Variable.in_collection.through(variable_id=v.id, collection_id=collection.id)
+                     for v in {v.id: v for v in variables}.values()],
+                    ignore_conflicts=True)
+    return added
+
+
+def cfparse_file(db, filename, cache=None):
+    """
+    Parse a file and load cf metadata into the database
+    :Parameters:
+        db: `CollectionDB`
+            an instance of a collection database
+        filename: `str`
+            filename which will be parsed
+        cache: `MetadataCache`
+            if given, reuse (or record) the metadata of an unchanged file
+    :Returns:
+        None
+    **Examples:**
+    >>> cfparse_file(db, 'my_model_file.nc')
+    """
+    print("Running cfparse_file")
+    stamp = file_stamp(filename) if cache is not None else None
+    records = cache.get(stamp) if stamp is not None else None
+    if records is None:
+        records = extract_file_metadata(filename)
+        if stamp is not None:
+            cache.put(stamp, records)
+            cache.flush()
+    store_variables(records)
@@ -0,0 +1,293 @@
+import argparse
+import hashlib
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from cfstore.ingest import chunked
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+# files are read sequentially in blocks of this many bytes
+BLOCKSIZE = 8 * 1024 * 1024
+
+# blocks of this many bytes are sampled from each file by the tiered comparator
+SAMPLE_BLOCK = 1024 * 1024
+
+# The registry of hash algorithms which can be used for checksums: each method
+# name maps to a constructor for a hashlib-like object (with update and hexdigest),
+# and whether the hash is cryptographic. The method name is stored alongside each
+# checksum in File.checksum_method, so names must never be reused for something else.
+HASHES = {
+    "sha256": (hashlib.sha256, True),
+    "md5": (hashlib.md5, True),
+    "blake2b": (hashlib.blake2b, True),
+}
+if xxhash is not None:
+    HASHES["xxh64"] = (xxhash.xxh64, False)
+    HASHES["xxh3_64"] = (xxhash.xxh3_64, False)
+    HASHES["xxh3_128"] = (xxhash.xxh3_128, False)
+if blake3 is not None:
+    HASHES["blake3"] = (blake3.blake3, True)
+
+
+def register_hash(method, constructor, cryptographic=False):
+    """
+    Add a hash algorithm to the registry under the name <method>. The <constructor>
+    must return an object with update and hexdigest methods, and must be available
+    at import time in worker processes if it is to be used with <checksum_files>.
+    """
+    if method in HASHES:
+        raise ValueError(f"Hash method {method} is already registered")
+    HASHES[method] = (constructor, cryptographic)
+
+
+def available_hashes(cryptographic=None):
+    """
+    Return the names of the registered hash methods, optionally only those which
+    are (or are not) <cryptographic>.
+    """
+    return [
+        m
+        for m, (c, strong) in HASHES.items()
+        if cryptographic is None or strong == cryptographic
+    ]
+
+
+def new_hash(method):
+    """
+    Return a new hash object for the registered hash <method>.
+    """
+    try:
+        constructor, strong = HASHES[method]
+    except KeyError:
+        raise ValueError(
+            f"Unknown checksum method {method} (available: {', '.join(HASHES)})"
+        )
+    return constructor()
+
+
+def checksum_file(path, method="sha256", blocksize=BLOCKSIZE):
+    """
+    Return the hex digest of the file at <path> using the registered hash <method>,
+    reading the file sequentially in large blocks into a reused buffer.
+    """
+    return _digest(path, method, blocksize)[0]
+
+
+def _digest(path, method, blocksize):
+    """Return the hex digest of <path> and the number of bytes read"""
+    h = new_hash(method)
+    buffer = bytearray(blocksize)
+    view = memoryview(buffer)
+    nbytes = 0
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            h.update(view[:n])
+            nbytes += n
+    return h.hexdigest(), nbytes
+
+
+def _checksum_task(task):
+    """
+    Checksum one file in a worker process, returning the key and digest (or error)
+    along with what is needed to work out the throughput of each worker.
+    """
+    key, path, method, blocksize = task
+    start = time.perf_counter()
+    try:
+        digest, nbytes = _digest(path, method, blocksize)
+        error = None
+    except OSError as e:
+        digest, nbytes, error = None, 0, str(e)
+    return key, path, digest, error, nbytes, time.perf_counter() - start, os.getpid()
+
+
+def checksum_files(
+    items, method="sha256", processes=4, blocksize=BLOCKSIZE, stats=None, batch=256
+):
+    """
+    Checksum files on a pool of <processes> worker processes, using the
+    registered hash <method>.
+
+    <items> is any iterable of (key, path) tuples, consumed <batch> at a time.
+    Yields (key, digest) tuples in the same order, with digest None for files
+    which could not be read. If a dictionary is passed as <stats>, it is updated
+    with the number of bytes read and seconds spent by each worker (keyed by
+    process id), see <report_throughput>.
+    """
+    # fail here, rather than once per file in the workers
+    new_hash(method)
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for chunk in chunked(items, batch):
+            tasks = [(key, path, method, blocksize) for key, path in chunk]
+            for key, path, digest, error, nbytes, seconds, pid in pool.map(
+                _checksum_task, tasks
+            ):
+                if error:
+                    print(f"Unable to checksum {path}: {error}")
+                if stats is not None:
+                    worker = stats.setdefault(pid, [0, 0.0])
+                    worker[0] += nbytes
+                    worker[1] += seconds
+                yield key, digest
+
+
+def report_throughput(stats):
+    """
+    Print the throughput of each checksum worker, from the <stats> filled in
+    by <checksum_files>.
+    """
+    for n, (pid, (nbytes, seconds)) in enumerate(sorted(stats.items())):
+        rate = nbytes / 1e6 / seconds if seconds else 0.0
+        print(
+            f"Checksum worker {n}: {nbytes / 1e6:.1f} MB in {seconds:.2f}s ({rate:.1f} MB/s)"
+        )
+
+
+def sample_digest(path, method="sha256", block=SAMPLE_BLOCK, size=None):
+    """
+    Return the digest of the head, middle and tail blocks (each of <block> bytes)
+    of the file at <path>, and whether that sample covered the whole file (in
+    which case it is as good as a full checksum).
+    """
+    if size is None:
+        size = os.path.getsize(path)
+    h = new_hash(method)
+    if size <= 3 * block:
+        offsets = [(0, size)]
+    else:
+        offsets = [(0, block), ((size - block) // 2, block), (size - block, block)]
+    with open(path, "rb", buffering=0) as f:
+        fd = f.fileno()
+        for offset, length in offsets:
+            h.update(os.pread(fd, length, offset))
+    return h.hexdigest(), size <= 3 * block
+
+
+def files_equal(file1, file2, method="sha256", block=SAMPLE_BLOCK):
+    """
+    Compare two files in tiers, stopping at the first tier which differs:
+    first the sizes, then a digest of sampled head, middle and tail blocks,
+    then a full streaming checksum using the registered hash <method>.
+    Returns whether the files are equal, and the tier ("size", "sample" or
+    "full") which decided it.
+    """
+    return next(
+        compare_files([(file1, file2)], method=method, block=block, processes=1)
+    )[2:]
+
+
+def compare_files(pairs, method="sha256", block=SAMPLE_BLOCK, processes=4):
+    """
+    Compare many (file1, file2) <pairs> at once, with the same tiers as
+    <files_equal>. Each tier is applied to all the pairs still in question
+    before moving on to the next, and the sizes, samples and checksums of each
+    file are cached, so a file which is in many pairs (e.g. one copy compared
+    against several replicas) is only read once. Full checksums are made on a
+    pool of <processes> worker processes (serially if <processes> is 1).
+
+    Yields (file1, file2, equal, tier) for each pair, in the same order as <pairs>.
+    """
+    pairs = list(pairs)
+    new_hash(method)
+    results = [None] * len(pairs)
+
+    sizes = {}
+    for p in {f for pair in pairs for f in pair}:
+        sizes[p] = os.path.getsize(p)
+    todo = []
+    for n, (a, b) in enumerate(pairs):
+        if sizes[a] != sizes[b]:
+            results[n] = (a, b, False, "size")
+        else:
+            todo.append(n)
+
+    samples = {}
+    remaining = []
+    for n in todo:
+        a, b = pairs[n]
+        for p in (a, b):
+            if p not in samples:
+                samples[p] = sample_digest(p, method, block, sizes[p])
+        (da, complete), (db, _) = samples[a], samples[b]
+        if da != db or complete:
+            results[n] = (a, b, da == db, "sample")
+        else:
+            remaining.append(n)
+
+    if remaining:
+        wanted = sorted({p for n in remaining for p in pairs[n]})
+        if processes > 1 and len(wanted) > 1:
+            digests = dict(
+                checksum_files(
+                    ((p, p) for p in wanted), method=method, processes=processes
+                )
+            )
+        else:
+            digests = {p: checksum_file(p, method) for p in wanted}
+        for n in remaining:
+            a, b = pairs[n]
+            equal = digests[a] is not None and digests[a] == digests[b]
+            results[n] = (a, b, equal, "full")
+
+    yield from results
+
+
+def benchmark_hashes(path=None, size=256 * 1024 * 1024, methods=None, repeat=3):
+    """
+    Compare the throughput of the registered hash <methods> (default all) by
+    checksumming the file at <path>, or a temporary file of <size> random bytes.
+    The file is read once before timing so it is in the page cache and the
+    comparison is of the hashes, not the storage. Returns a dictionary of the
+    best MB/s seen for each method over <repeat> runs.
+    """
+    if methods is None:
+        methods = list(HASHES)
+    tmp = None
+    if path is None:
+        tmp = tempfile.NamedTemporaryFile(delete=False)
+        with tmp:
+            block = os.urandom(1024 * 1024)
+            for i in range(size // len(block)):
+                tmp.write(block)
+        path = tmp.name
+    try:
+        nbytes = os.path.getsize(path)
+        checksum_file(path, "md5")
+        results = {}
+        for method in methods:
+            best = None
+            for i in range(repeat):
+                start = time.perf_counter()
+                checksum_file(path, method)
+                seconds = time.perf_counter() - start
+                best = seconds if best is None else min(best, seconds)
+            results[method] = nbytes / 1e6 / best if best else 0.0
+            strength = "cryptographic" if HASHES[method][1] else "non-cryptographic"
+            print(f"{method:>10}: {results[method]:8.1f} MB/s ({strength})")
+        return results
+    finally:
+        if tmp is not None:
+            os.remove(tmp.name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare checksum throughput")
+    parser.add_argument("path", nargs="?", default=None, help="file to checksum")
+    parser.add_argument("--size", type=int, default=256, help="test file size (MB)")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    benchmark_hashes(args.path, args.size * 1024 * 1024, repeat=args.repeat)
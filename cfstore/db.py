@@ -4,12 +4,20 @@ import django
 from django.db import models
 from cfstoreviewer.models import (
     Collection,
+    Directory_Mtime,
+    ET_Workspace_State,
     File,
     Tag,
     Location,
     Protocol,
     Cell_Method,
     Variable,
+    Var_Metadata,
+    Property_Facet,
+    Cell_Method_Facet,
+    index_new_variables,
+    rebuild_facets,
+    variable_fingerprint,
 )
 from cfstore.parse_cell_methods import parse_cell_methods
 from django import template
@@ -0,0 +1,128 @@
+import json
+import os
+import resource
+import sys
+import time
+from itertools import islice
+from pathlib import Path
+
+from django.conf import settings
+
+
+def chunked(iterable, size):
+    """
+    Consume any <iterable> in lists of at most <size> items, so that
+    only one chunk needs to be held in memory at a time.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def peak_rss():
+    """
+    Return the high-water mark of the resident set size of this process in bytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macos reports bytes
+    if sys.platform == "darwin":
+        return peak
+    return peak * 1024
+
+
+def default_journal_path():
+    """
+    The ingest journal lives next to the database file, or in the cfstore
+    configuration directory if the database is not a file.
+    """
+    name = str(settings.DATABASES["default"].get("NAME", ""))
+    if name and name != ":memory:" and not name.startswith("file:"):
+        return Path(name + ".journal")
+    return Path.home() / ".cfstore" / "ingest.journal"
+
+
+class IngestJournal:
+    """
+    Records the committed chunk boundaries of ingests into collections,
+    so that an ingest which dies part way through can be resumed without
+    re-querying the files which were already committed.
+
+    For each (location, collection) the journal holds the walker cursor (the
+    number of file dictionaries consumed) and the last committed path. This
+    relies on walkers producing files in a repeatable order.
+    """
+
+    def __init__(self, filepath=None):
+        if filepath is None:
+            filepath = default_journal_path()
+        self.filepath = Path(filepath)
+
+    @staticmethod
+    def _key(location, collection):
+        return f"{location}:{collection}"
+
+    def _load(self):
+        if not self.filepath.exists():
+            return {}
+        with open(self.filepath, "r") as f:
+            return json.load(f)
+
+    def _dump(self, entries):
+        if not entries:
+            if self.filepath.exists():
+                os.remove(self.filepath)
+            return
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.filepath.with_name(self.filepath.name + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(entries, f)
+        os.replace(tmp, self.filepath)
+
+    def get(self, location, collection):
+        """
+        Return the journal entry for an ingest of <location> into <collection>, if any.
+        """
+        return self._load().get(self._key(location, collection))
+
+    def record(self, location, collection, cursor, last):
+        """
+        Record that the first <cursor> file dictionaries, ending with <last>, are committed.
+        """
+        entries = self._load()
+        entries[self._key(location, collection)] = {
+            "cursor": cursor,
+            "last": last,
+            "time": time.time(),
+        }
+        self._dump(entries)
+
+    def clear(self, location, collection):
+        """
+        Forget about an ingest (normally because it has completed).
+        """
+        entries = self._load()
+        if entries.pop(self._key(location, collection), None) is not None:
+            self._dump(entries)
+
+    def skip_committed(self, files, location, collection):
+        """
+        Return an iterator over <files> which skips those already committed by a
+        previous ingest of <location> into <collection>, and the number skipped.
+        """
+        iterator = iter(files)
+        entry = self.get(location, collection)
+        if not entry:
+            return iterator, 0
+        last = None
+        for f in islice(iterator, entry["cursor"]):
+            last = os.path.join(f["path"], f["name"])
+        if last != entry["last"]:
+            raise ValueError(
+                f"Cannot resume ingest into {collection}: expected {entry['last']} "
+                f"at position {entry['cursor']} but found {last}"
+            )
+        print(f"Resuming ingest into {collection} after {entry['cursor']} files")
+        return iterator, entry["cursor"]
@@ -2,18 +2,30 @@ import os
 import sys
 
 import django
-from django.db import IntegrityError
-from django.db.models import Q
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
 
 django.setup()
 
-import hashlib
-
 from tqdm import tqdm
 
-from cfstore.cfparse_file import cfparse_file
-from cfstore.db import (Cell_Method, Collection, CoreDB, File, Location,
-                        Protocol, Tag, Variable)
+from cfstore.cfparse_file import cfparse_file, harvest, store_variables
+from cfstore.checksums import checksum_file, files_equal
+from cfstore.db import (
+    Cell_Method,
+    Collection,
+    CoreDB,
+    File,
+    Location,
+    Protocol,
+    Tag,
+    Var_Metadata,
+    Variable,
+    rebuild_facets,
+)
+from cfstore.ingest import IngestJournal, chunked, peak_rss
+from cfstore.jsonquery import property_filter
+from cfstore.metacache import MetadataCache
 
 
 class CollectionError(Exception):
@@ -22,6 +34,12 @@ class CollectionError(Exception):
 
 
 class CollectionDB(CoreDB):
+    # number of file dictionaries ingested per transaction
+    ingest_chunksize = 1000
+    # how variables are filtered by property: joins on the property table
+    # ("table"), or database side JSON queries ("json", see cfstore.jsonquery)
+    property_query = "table"
+
     def cell_method_add(self, axis, method):
         """
         Add a new cell method to database, raise an error if it already exists.
@@ -107,9 +125,51 @@ class CollectionDB(CoreDB):
             c2.add_relationship(relationship_21, c1)
         self.session.commit()
 
-    def add_variables_from_file(self, filename):
-        """Add all the variables found in a file to the database"""
-        cfparse_file(self, filename)
+    def add_variables_from_file(self, filename, cache=True):
+        """
+        Add all the variables found in a file to the database, reusing the metadata
+        cached for it if the file is unchanged (unless <cache> is False; a
+        <MetadataCache> may also be passed as <cache>).
+        """
+        opened = cache is True
+        if opened:
+            cache = MetadataCache()
+        elif cache is False:
+            cache = None
+        try:
+            cfparse_file(self, filename, cache)
+        finally:
+            if opened:
+                cache.close()
+
+    def add_variables_from_files(
+        self, filenames, processes=4, collection=None, cache=True
+    ):
+        """
+        Add all the variables found in <filenames> to the database. The files are
+        read on <processes> worker processes, and the variables written from here
+        in bulk (and added to <collection> if it is given). Files which are unchanged
+        since their metadata was cached are not read again (unless <cache> is False;
+        a <MetadataCache> may also be passed as <cache>). Returns the number of
+        new variables.
+        """
+        if collection is not None:
+            collection = self.retrieve_collection(collection)
+        opened = cache is True
+        if opened:
+            cache = MetadataCache()
+        elif cache is False:
+            cache = None
+        records = (
+            r
+            for filename, records in harvest(filenames, processes, cache=cache)
+            for r in records
+        )
+        try:
+            return store_variables(records, collection, self.ingest_chunksize)
+        finally:
+            if opened:
+                cache.close()
 
     def create_collection(self, collection_name, description, kw={}):
         """
@@ -597,6 +657,44 @@ class CollectionDB(CoreDB):
             return results
         return results[0]
 
+    def fingerprint_variables(self):
+        """
+        Set the fingerprint of any variables added before variables had one,
+        so that they are found when de-duplicating. Returns how many were set.
+        """
+        count = 0
+        while True:
+            chunk = list(
+                Variable.objects.filter(fingerprint__isnull=True)[
+                    : self.ingest_chunksize
+                ]
+            )
+            if not chunk:
+                break
+            for var in chunk:
+                var.update_fingerprint()
+            Variable.objects.bulk_update(chunk, ["fingerprint"])
+            count += len(chunk)
+        return count
+
+    def index_variable_properties(self):
+        """
+        Rebuild the property table (used to filter variables by property) and
+        the facet counts (used by the viewer) from the properties of every
+        variable, e.g. for variables added before they existed. Returns the
+        number of variables indexed.
+        """
+        count = 0
+        for chunk in chunked(
+            Variable.objects.order_by("id").iterator(), self.ingest_chunksize
+        ):
+            with transaction.atomic():
+                Var_Metadata.sync(chunk)
+            count += len(chunk)
+        with transaction.atomic():
+            rebuild_facets(self.ingest_chunksize)
+        return count
+
     def retrieve_all_variables(self, key, value):
         """Retrieve all variables that matches arbitrary property"""
         if key == "identity":
@@ -688,15 +786,19 @@ class CollectionDB(CoreDB):
         return collection.variable_set.distinct()
 
     def retrieve_variables_subset_in_collection(self, collection_name, properties):
-        if collection_name=="all":
+        if collection_name == "all":
             variables = Variable.objects.all()
         else:
             collection = Collection.objects.get(name=collection_name)
             variables = collection.variable_set.all()
-        for k, value in properties.items():
-            for var in variables:
-                if (k, value) not in var._proxied.items():
-                    variables = (variables.exclude(id=var.id))
+        if self.property_query == "json":
+            variables = variables.filter(*property_filter(properties))
+        else:
+            # one indexed join on the property table per property
+            for k, value in properties.items():
+                variables = variables.filter(
+                    **Var_Metadata.lookup(k, value, prefix="metadata__")
+                )
         variables = variables.distinct()
         return variables
 
@@ -864,72 +966,46 @@ class CollectionDB(CoreDB):
         If we do find existing files, and <update> is True, then we will simply add
         a link to the new file as a replica. If <update> is False, we raise an error.
         """
-        try:
-            c = Collection.objects.get(name=collection)
-            loc = Location.objects.get(name=location)
-        except Collection.DoesNotExist:
-            raise ValueError("Collection not yet available in database")
-        except Location.DoesNotExist:
-            raise ValueError("Location not yet available in database")
-
-        if "checksum" not in f:
-            f["checksum"] = "None"
-        name, path, size, checksum = f["name"], f["path"], f["size"], f["checksum"]
-        c.volume += f["size"]
-        try:
-            if lazy == 0:
-                check = self.retrieve_file(path, name)
-            elif lazy == 1:
-                check = self.retrieve_file(path, name, size=size)
-            elif lazy == 2:
-                check = self.retrieve_file(path, name, checksum=checksum)
-            else:
-                raise ValueError(f"Unexpected value of lazy {lazy}")
-        except FileNotFoundError:
-            check = False
-
-        if check:
-            if not update:
-                raise ValueError(
-                    f"Cannot upload file {os.path.join(path, name)} as it already exists"
-                )
-            else:
-                check.replicas.append(loc)
-                c.files.append(check)
-        else:
-            try:
-                fmt = f["format"]
-            except KeyError:
-                fmt = os.path.splitext(name)[1]
-            f = File(
-                name=name,
-                path=path,
-                checksum=checksum,
-                size=size,
-                format=fmt,
-                initial_collection=c.id,
-            )
-            f.replicas.append(loc)
-            c.files.append(f)
-            loc.holds_files.append(f)
-            c.volume += f.size
-            loc.volume += f.size
-            loc.holds_files.add(f)
-            print(loc.holds_files)
-            loc.save()
-            c.save()
-            f.save()
+        self.upload_files_to_collection(
+            location, collection, [f], lazy=lazy, update=update, quiet=True
+        )
 
     def upload_files_to_collection(
-        self, location, collection, files, lazy=0, update=True
+        self,
+        location,
+        collection,
+        files,
+        lazy=0,
+        update=True,
+        chunksize=None,
+        journal=None,
+        resume=False,
+        quiet=False,
     ):
         """
         Add new files which exist at <location> to a <collection>. Both
         location and collection must already exist.
 
-        <files>: list of file dictionaries
+        <files>: list, or any other iterable (e.g. a generator from a directory
+        walker), of file dictionaries
             {name:..., path: ..., checksum: ..., size: ..., format: ...}
+        (posix walkers may also provide mtime and inode)
+
+        Files are ingested in chunks of <chunksize> (default <ingest_chunksize>),
+        each chunk in one transaction: new files are bulk created, the collection,
+        replica and location links are bulk inserted, and the collection and
+        location volumes are updated once per chunk. Only one chunk is held in
+        memory at a time. The meaning of <lazy> and <update> is as for
+        <upload_file_to_collection>.
+
+        If an <IngestJournal> is provided as <journal>, each committed chunk is
+        recorded in it, and if <resume> is True, files committed by a previous
+        (interrupted) ingest are skipped. The <files> must then come in the same
+        order as before.
 
+        Returns a dictionary summarising the ingest: the number of files and chunks
+        and the peak memory (resident set size, in bytes) of this process. Progress
+        and the summary are also reported, unless <quiet>.
         """
 
         try:
@@ -939,68 +1015,193 @@ class CollectionDB(CoreDB):
             raise ValueError("Collection not yet available in database")
         except Location.DoesNotExist:
             raise ValueError("Location not yet available in database")
-        for f in tqdm(files):
+        if lazy not in (0, 1, 2):
+            raise ValueError(f"Unexpected value of lazy {lazy}")
+        if chunksize is None:
+            chunksize = self.ingest_chunksize
+        if resume and journal is None:
+            journal = IngestJournal()
+
+        total = len(files) if hasattr(files, "__len__") else None
+        cursor = 0
+        if resume:
+            files, cursor = journal.skip_committed(files, location, collection)
+        nfiles, nchunks = 0, 0
+        with tqdm(total=total, initial=cursor, unit="file", disable=quiet) as progress:
+            for chunk in chunked(files, chunksize):
+                with transaction.atomic():
+                    self._upload_chunk(c, loc, chunk, lazy, update)
+                nfiles += len(chunk)
+                nchunks += 1
+                if journal is not None:
+                    last = os.path.join(chunk[-1]["path"], chunk[-1]["name"])
+                    journal.record(location, collection, cursor + nfiles, last)
+                progress.update(len(chunk))
+                progress.set_postfix(peak_rss=self.byte_format(peak_rss()))
+        if journal is not None:
+            journal.clear(location, collection)
+
+        summary = {"files": nfiles, "chunks": nchunks, "peak_rss": peak_rss()}
+        if not quiet:
+            print(
+                f"Ingested {nfiles} files into {collection} in {nchunks} chunks "
+                f"(peak memory {self.byte_format(summary['peak_rss'])})"
+            )
+        return summary
+
+    def _upload_chunk(self, c, loc, chunk, lazy, update):
+        """
+        Ingest one chunk of file dictionaries into collection <c> at location <loc>.
+        Should be called inside a transaction.
+        """
+        for f in chunk:
             if "checksum" not in f:
                 f["checksum"] = "None"
+        seen = self._existing_files(chunk, lazy)
+        if seen and not update:
+            path, name = next(iter(seen))[:2]
+            raise ValueError(
+                f"Cannot upload file {os.path.join(path, name)} as it already exists"
+            )
+        new_files, linked = [], {}
+        volume = 0
+        for f in chunk:
             name, path, size, checksum = f["name"], f["path"], f["size"], f["checksum"]
-            check = False
-            try:
-                if lazy == 0:
-                    check = self.retrieve_file(path, name)
-                elif lazy == 1:
-                    check = self.retrieve_file(path, name, size=size)
-                elif lazy == 2:
-                    check = self.retrieve_file(path, name, checksum=checksum)
-                else:
-                    raise ValueError(f"Unexpected value of lazy {lazy}")
-            except FileNotFoundError:
-                pass
-
-            if check:
-                if not update:
-                    raise ValueError(
-                        f"Cannot upload file {os.path.join(path, name)} as it already exists"
-                    )
-                else:
-                    try:
-                        fmt = f["format"]
-                    except KeyError:
-                        fmt = os.path.splitext(name)[1]
-                    f, created = File.objects.get_or_create(
-                        name=name,
-                        path=path,
-                        checksum=checksum,
-                        size=size,
-                        format=fmt,
-                    )
-                    f.replicas.add(loc)
-                    c.files.add(f)
-                    c.volume += f.size
-                    loc.holds_files.add(f)
-                    loc.volume += f.size
-
-            else:
+            key = _file_key(path, name, size, checksum, lazy)
+            check = seen.get(key)
+            if check is None:
                 try:
                     fmt = f["format"]
                 except KeyError:
                     fmt = os.path.splitext(name)[1]
-                f, created = File.objects.get_or_create(
+                check = File(
                     name=name,
                     path=path,
                     checksum=checksum,
                     size=size,
                     format=fmt,
+                    checksum_method=f.get("checksum_method", ""),
+                    mtime=f.get("mtime"),
+                    inode=f.get("inode"),
                 )
-                c.volume += f.size
-                f.replicas.add(loc)
-                c.files.add(f)
-                f.replicas.add(loc)
-                loc.holds_files.add(f)
-                loc.volume += f.size
-                f.save()
-
-        c.save()
-        loc.save()
+                new_files.append(check)
+            seen[key] = check
+            linked[id(check)] = check
+            volume += size
+
+        File.objects.bulk_create(new_files)
+        if any(f.pk is None for f in new_files):
+            # not all backends return primary keys from a bulk insert
+            _resolve_file_ids(new_files)
+
+        ids = {f.pk for f in linked.values()}
+        Collection.files.through.objects.bulk_create(
+            [Collection.files.through(collection_id=c.pk, file_id=i) for i in ids],
+            ignore_conflicts=True,
+        )
+        File.replicas.through.objects.bulk_create(
+            [File.replicas.through(file_id=i, location_id=loc.pk) for i in ids],
+            ignore_conflicts=True,
+        )
+        Location.holds_files.through.objects.bulk_create(
+            [Location.holds_files.through(location_id=loc.pk, file_id=i) for i in ids],
+            ignore_conflicts=True,
+        )
+        Collection.objects.filter(pk=c.pk).update(volume=F("volume") + volume)
+        Location.objects.filter(pk=loc.pk).update(volume=F("volume") + volume)
+        c.volume += volume
+        loc.volume += volume
+
+    def _existing_files(self, chunk, lazy):
+        """
+        Find which of the file dictionaries in <chunk> are already known to the
+        database, using one query for the whole chunk. Returns a dictionary of
+        the matching files, keyed as by <_file_key> for the given <lazy>.
+        """
+        paths = {f["path"] for f in chunk}
+        names = {f["name"] for f in chunk}
+        query = File.objects.filter(path__in=paths, name__in=names)
+        if lazy == 1:
+            query = query.filter(size__in={f["size"] for f in chunk})
+        elif lazy == 2:
+            query = query.filter(checksum__in={f["checksum"] for f in chunk})
+        wanted = {
+            _file_key(f["path"], f["name"], f["size"], f["checksum"], lazy)
+            for f in chunk
+        }
+        existing = {}
+        for f in query.order_by("id"):
+            key = _file_key(f.path, f.name, f.size, f.checksum, lazy)
+            if key in wanted and key not in existing:
+                existing[key] = f
+        return existing
+
+    def file_ids(self, paths, unlisted="unlisted"):
+        """
+        Return a dictionary mapping each (path, name) in <paths> to the id of the
+        file in the database, with one query per <ingest_chunksize> paths. Files
+        which are not yet known are created in bulk (with no size or checksum),
+        and put in the <unlisted> collection.
+        """
+        ids = {}
+        for chunk in chunked(set(paths), self.ingest_chunksize):
+            wanted = set(chunk)
+            for f in (
+                File.objects.filter(
+                    path__in={p for p, n in chunk}, name__in={n for p, n in chunk}
+                )
+                .order_by("id")
+                .only("id", "path", "name")
+            ):
+                if (f.path, f.name) in wanted:
+                    ids.setdefault((f.path, f.name), f.pk)
+            missing = [
+                File(name=n, path=p, checksum="None", size=0, format="unknown")
+                for p, n in chunk
+                if (p, n) not in ids
+            ]
+            if not missing:
+                continue
+            File.objects.bulk_create(missing)
+            if any(f.pk is None for f in missing):
+                _resolve_file_ids(missing)
+            uc, created = Collection.objects.get_or_create(
+                name=unlisted,
+                defaults=dict(
+                    volume=0, description="Holds unlisted files", batch=0, _proxied={}
+                ),
+            )
+            Collection.files.through.objects.bulk_create(
+                [
+                    Collection.files.through(collection_id=uc.pk, file_id=f.pk)
+                    for f in missing
+                ],
+                ignore_conflicts=True,
+            )
+            ids.update({(f.path, f.name): f.pk for f in missing})
+        return ids
+
+    def remove_files(self, c, loc, removed):
+        """
+        Take files (tuples starting with id and size) out of collection <c> and
+        location <loc> (e.g. because they no longer exist there), in bulk. The files
+        themselves stay in the database.
+        """
+        for chunk in chunked(removed, self.ingest_chunksize):
+            ids = [f[0] for f in chunk]
+            volume = sum(f[1] for f in chunk)
+            with transaction.atomic():
+                Collection.files.through.objects.filter(
+                    collection_id=c.pk, file_id__in=ids
+                ).delete()
+                File.replicas.through.objects.filter(
+                    location_id=loc.pk, file_id__in=ids
+                ).delete()
+                Location.holds_files.through.objects.filter(
+                    location_id=loc.pk, file_id__in=ids
+                ).delete()
+                Collection.objects.filter(pk=c.pk).update(volume=F("volume") - volume)
+                Location.objects.filter(pk=loc.pk).update(volume=F("volume") - volume)
 
     def remove_file_from_collection(
         self, collection, file_path, file_name, checksum=None
@@ -1032,32 +1233,48 @@ class CollectionDB(CoreDB):
         pass
 
 
-def chkeq(file1, file2, try_hash=False, return_hash=False):
+def _file_key(path, name, size, checksum, lazy):
     """
-    Compare the equality of two files
+    Return the key used to decide whether a file is already known, for a given
+    value of <lazy> (see <CollectionDB.upload_file_to_collection>).
     """
+    if lazy == 0:
+        return (path, name)
+    elif lazy == 1:
+        return (path, name, size)
+    return (path, name, checksum)
 
-    a_file = open(file1, "rb")
-    b_file = open(file2, "rb")
-
-    filesize_equal = os.path.getsize(a_file) == os.path.getsize(b_file)
-    if try_hash and not filesize_equal:
-        sha256_hash = hashlib.sha256()
 
-        for byte_block in iter(lambda: a_file.read(4096), b""):
-            sha256_hash.update(byte_block)
-        a_hash = sha256_hash.hexdigest()
-
-        sha256_hash = hashlib.sha256()
-
-        for byte_block in iter(lambda: b_file.read(4096), b""):
-            sha256_hash.update(byte_block)
-        b_hash = sha256_hash.hexdigest()
-
-        hash_equal = a_hash == b_hash
+def _resolve_file_ids(files):
+    """
+    Fill in the primary keys of freshly bulk created <files> by looking them
+    up again (newest first, in case of older files with the same path and name).
+    """
+    found = {}
+    for f in (
+        File.objects.filter(
+            path__in={f.path for f in files}, name__in={f.name for f in files}
+        )
+        .order_by("id")
+        .only("id", "path", "name", "size", "checksum")
+    ):
+        found[(f.path, f.name, f.size, f.checksum)] = f.pk
+    for f in files:
+        f.pk = found[(f.path, f.name, f.size, f.checksum)]
 
-        if return_hash:
-            return (hash_equal, a_hash, b_hash)
 
-        return hash_equal
-    return filesize_equal
+def chkeq(file1, file2, try_hash=False, return_hash=False, method="sha256"):
+    """
+    Compare the equality of two files. By default only sizes are compared; with
+    <try_hash> files of the same size are compared by sampled blocks and then
+    full checksums using the registered hash <method> (see
+    cfstore.checksums.compare_files to compare many pairs at once). With
+    <return_hash> the full checksums of both files are also returned.
+    """
+    if not try_hash:
+        return os.path.getsize(file1) == os.path.getsize(file2)
+    if return_hash:
+        a_hash = checksum_file(file1, method)
+        b_hash = checksum_file(file2, method)
+        return (a_hash == b_hash, a_hash, b_hash)
+    return files_equal(file1, file2, method=method)[0]
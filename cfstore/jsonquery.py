@@ -0,0 +1,165 @@
+"""
+Filters on the JSON held in Variable._proxied (properties) and
+Variable._cell_methods which are evaluated by the database rather than by
+loading every variable into Python: json_extract and json_each on SQLite,
+and JSONB containment on PostgreSQL. Use <ensure_json_indexes> to add the
+indexes which make them fast (expression indexes on SQLite, GIN indexes on
+PostgreSQL). This needs no extra tables, unlike the property table
+(Var_Metadata) which is the default for property filters.
+"""
+import hashlib
+import json
+import re
+
+from django.db import connection
+from django.db.models import BooleanField, JSONField
+from django.db.models.expressions import RawSQL
+
+from cfstore.db import Variable
+
+
+def _column(name):
+    qn = connection.ops.quote_name
+    return f"{qn(Variable._meta.db_table)}.{qn(name)}"
+
+
+def _postgres():
+    return connection.vendor == "postgresql"
+
+
+def _json_path(key):
+    """
+    Return the SQLite JSON path of a top level <key>, as an SQL literal (not a
+    parameter, so that queries can use expression indexes on it).
+    """
+    if '"' in key:
+        raise ValueError(f"Cannot query JSON property names containing quotes: {key}")
+    return "'" + f'$."{key}"'.replace("'", "''") + "'"
+
+
+def _where(sql, params):
+    return RawSQL(sql, params, output_field=BooleanField())
+
+
+def property_filter(properties):
+    """
+    Return a list of expressions (for queryset.filter) which match variables
+    having each of the {key: value} <properties>, with values of the same type.
+    """
+    column = _column("_proxied")
+    if _postgres():
+        return [_where(f"{column} @> %s::jsonb", [json.dumps(properties)])]
+    where = []
+    for key, value in properties.items():
+        path = _json_path(key)
+        if isinstance(value, bool):
+            json_type = "true" if value else "false"
+            where.append(_where(f"json_type({column}, {path}) = %s", [json_type]))
+            continue
+        sql = f"json_extract({column}, {path}) = %s"
+        if isinstance(value, int):
+            # otherwise true and false would match 1 and 0
+            sql += f" AND json_type({column}, {path}) IN ('integer', 'real')"
+        elif not isinstance(value, (str, float)):
+            sql = f"json_extract({column}, {path}) = json(%s)"
+            value = json.dumps(value)
+        where.append(_where(sql, [value]))
+    return where
+
+
+def cell_method_filter(method=None, axis=None):
+    """
+    Return an expression (for queryset.filter) which matches variables with a
+    cell method using <method> and/or over <axis>.
+    """
+    column = _column("_cell_methods")
+    if _postgres():
+        cm = {}
+        if method is not None:
+            cm["methods"] = method
+        if axis is not None:
+            cm["axes"] = [axis]
+        return _where(f"{column} @> %s::jsonb", [json.dumps([cm])])
+    sql, params = [], []
+    if method is not None:
+        sql.append("json_extract(cm.value, '$.methods') = %s")
+        params.append(method)
+    if axis is not None:
+        sql.append(
+            "EXISTS (SELECT 1 FROM json_each(cm.value, '$.axes') AS ax WHERE ax.value = %s)"
+        )
+        params.append(axis)
+    condition = " AND ".join(sql) or "1"
+    return _where(
+        f"EXISTS (SELECT 1 FROM json_each({column}) AS cm WHERE {condition})", params
+    )
+
+
+def property_values_filter(values):
+    """
+    Return a list of expressions (for queryset.filter) which match variables
+    having each of <values> as the value of some property.
+    """
+    column = _column("_proxied")
+    if _postgres():
+        sql = f"EXISTS (SELECT 1 FROM jsonb_each({column}) AS p WHERE p.value = %s::jsonb)"
+        return [_where(sql, [json.dumps(v)]) for v in values]
+    sql = f"EXISTS (SELECT 1 FROM json_each({column}) AS p WHERE p.value = %s)"
+    return [_where(sql, [v]) for v in values]
+
+
+def property_values(key, queryset=None):
+    """
+    Return the distinct values of property <key> over the variables in
+    <queryset> (by default all of them), found by the database.
+    """
+    if queryset is None:
+        queryset = Variable.objects.all()
+    column = _column("_proxied")
+    if _postgres():
+        expression = RawSQL(f"{column} -> %s", [key], output_field=JSONField())
+        values = queryset.annotate(value=expression).values_list("value", flat=True)
+        return [v for v in values.order_by().distinct() if v is not None]
+    path = _json_path(key)
+    json_type = RawSQL(f"json_type({column}, {path})", [])
+    value = RawSQL(f"json_extract({column}, {path})", [])
+    rows = (
+        queryset.annotate(json_type=json_type, value=value)
+        .filter(json_type__isnull=False)
+        .values_list("json_type", "value")
+        .order_by()
+        .distinct()
+    )
+    output = []
+    for json_type, value in rows:
+        if json_type in ("true", "false"):
+            value = json_type == "true"
+        elif json_type in ("object", "array"):
+            value = json.loads(value)
+        if value not in output:
+            output.append(value)
+    return output
+
+
+def ensure_json_indexes(keys=()):
+    """
+    Create the indexes used by these filters, if they do not already exist: on
+    PostgreSQL GIN indexes on the properties and cell methods; on SQLite an
+    expression index for each property name in <keys>.
+    """
+    table = connection.ops.quote_name(Variable._meta.db_table)
+    with connection.cursor() as cursor:
+        if _postgres():
+            for name in ("_proxied", "_cell_methods"):
+                cursor.execute(
+                    f"CREATE INDEX IF NOT EXISTS variable{name}_gin ON {table} "
+                    f"USING GIN (({connection.ops.quote_name(name)}) jsonb_path_ops)"
+                )
+            return
+        for key in keys:
+            digest = hashlib.md5(key.encode()).hexdigest()[:8]
+            index = f"variable_property_{re.sub(r'[^0-9a-zA-Z_]', '_', key)}_{digest}"
+            cursor.execute(
+                f'CREATE INDEX IF NOT EXISTS "{index}" ON {table} '
+                f"(json_extract(_proxied, {_json_path(key)}))"
+            )
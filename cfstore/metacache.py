@@ -0,0 +1,130 @@
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+# default limit on the size of the cached metadata
+MAX_BYTES = 256 * 1024**2
+
+
+def default_cache_path():
+    """
+    The metadata cache lives in $CFS_METADATA_CACHE, or in the cfstore
+    configuration directory.
+    """
+    return Path(
+        os.getenv("CFS_METADATA_CACHE", Path.home() / ".cfstore" / "metadata.sqlite")
+    )
+
+
+def file_stamp(path):
+    """
+    Return the (absolute path, size, modification time in ns) which identify a
+    version of the file at <path>, or None if it cannot be seen.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return os.path.abspath(path), st.st_size, st.st_mtime_ns
+
+
+class MetadataCache:
+    """
+    An on-disk (SQLite) cache of the field metadata extracted from files (see
+    <extract_file_metadata>), keyed by path, size and modification time, so that
+    extracting the metadata of an unchanged file again costs only a stat. The
+    cache is limited to <max_bytes> of metadata, beyond which the least recently
+    used entries are evicted.
+    """
+
+    def __init__(self, path=None, max_bytes=MAX_BYTES):
+        self.path = Path(path or default_cache_path())
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(self.path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # it is only a cache, so commits need not wait for the disk
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS metadata (path TEXT PRIMARY KEY, size INTEGER, "
+            "mtime INTEGER, records TEXT, nbytes INTEGER, used REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS metadata_used ON metadata (used)")
+        self.conn.commit()
+        self.total = self._total()
+        self.hits = self.misses = 0
+
+    def _total(self):
+        return self.conn.execute(
+            "SELECT COALESCE(SUM(nbytes), 0) FROM metadata"
+        ).fetchone()[0]
+
+    def get(self, stamp):
+        """
+        Return the cached records for the file version <stamp> (from <file_stamp>),
+        or None if it is not cached (or the file has changed since it was).
+        """
+        path, size, mtime = stamp
+        row = self.conn.execute(
+            "SELECT records FROM metadata WHERE path=? AND size=? AND mtime=?",
+            (path, size, mtime),
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # commit straight away, so as not to hold the lock other processes need
+        with self.conn:
+            self.conn.execute(
+                "UPDATE metadata SET used=? WHERE path=?", (time.time(), path)
+            )
+        return json.loads(row[0])
+
+    def put(self, stamp, records):
+        """
+        Cache the <records> extracted from the file version <stamp>, replacing
+        anything cached for an older version, and evict old entries if need be.
+        """
+        path, size, mtime = stamp
+        data = json.dumps(records)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?)",
+            (path, size, mtime, data, len(data), time.time()),
+        )
+        self.total += len(data)
+        if self.total > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is back under
+        90% of its limit.
+        """
+        self.total = self._total()
+        excess = self.total - int(0.9 * self.max_bytes)
+        if excess <= 0:
+            return
+        paths = []
+        for path, nbytes in self.conn.execute(
+            "SELECT path, nbytes FROM metadata ORDER BY used"
+        ):
+            if excess <= 0:
+                break
+            paths.append((path,))
+            excess -= nbytes
+            self.total -= nbytes
+        self.conn.executemany("DELETE FROM metadata WHERE path=?", paths)
+        self.conn.commit()
+
+    def flush(self):
+        """Commit any cache updates"""
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM metadata").fetchone()[0]
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
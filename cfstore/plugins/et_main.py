@@ -1,41 +1,135 @@
-from cfstore.config import CFSconfig
+from django.utils import timezone
+from cfstore.db import Collection, ET_Workspace_State
 from cfstore.plugins.et_utils import ET_Workspace
 import os
 
-def _load_et(workspace='hiresgw', ssh_host=None, ssh_user=None):
+# the location which holds all elastic tape files
+ET_LOCATION = 'elastic_tape'
+
+
+def _load_et(workspace='hiresgw', ssh_host=None, ssh_user=None, load=True):
     """
     Load a workspace from elastic tape
     """
     print(workspace,ssh_host,ssh_user)
-    et = ET_Workspace(workspace, ssh_host, ssh_user)
+    et = ET_Workspace(workspace, ssh_host, ssh_user, load=load)
     return et
 
 
-def parse_workspace_into_db(etw, db):
+def _file2dict(filename, size):
     """
-    For a given workspace, etw, being an instance of an ET_Workspace,
-    parse it into a CollectionDB instance inside db.
+    Build the dictionary of file information needed for cfstore
+    """
+    path, name = os.path.split(filename)
+    return {'path': path, 'name': name, 'size': size}
+
+
+def _batch_state(batch):
+    """
+    What we record about a batch in its collection, to tell if it has changed
+    """
+    return {'_et_workspace': batch.workspace.name,
+            '_et_creation_time': batch.creation_time,
+            '_et_file_count': batch.file_count,
+            '_et_batch_size': batch.batch_size_bytes}
+
+
+def _workspace_state(etw):
+    """
+    What we record about a workspace, to tell if it has changed
     """
+    return {'file_count': etw.file_count,
+            'quota_used': etw.quota_used,
+            'volume': etw.volume}
 
-    for b in etw.batches:
+
+def parse_workspace_into_db(etw, db, names=None):
+    """
+    For a given workspace, etw, being an instance of an ET_Workspace,
+    parse it into a CollectionDB instance inside db: each batch (or just
+    those called <names>) goes into an et_<batch> collection, which is
+    created if need be. The batch files are streamed into the database
+    (from memory, the cache, or the elastic tape monitor).
+    """
+    db.create_location(ET_LOCATION)
+    if names is None:
+        names = list(etw.batches)
+    for b in names:
         batch = etw.batches[b]
         cname = 'et_'+batch.name
-        db.create_collection(cname, 'None', {})
-        files = []
-        for f in batch.files:
-            path, name = os.path.split(f)
-            size = batch.files[f]
-            files.append({'path': path, 'name': name, 'size': size})
-        db.upload_files_to_collection('elastic_tape', cname, files)
+        try:
+            c = db.retrieve_collection(cname)
+        except ValueError:
+            c = db.create_collection(cname, f'Elastic tape batch {batch.name} ({etw.name})', {})
+        files = (_file2dict(f, size) for f, size in batch.iter_files(etw.cache))
+        db.upload_files_to_collection(ET_LOCATION, cname, files)
+        c = db.retrieve_collection(cname)
+        c._proxied.update(_batch_state(batch))
+        c.save(update_fields=['_proxied'])
+
+
+def sync_workspace_into_db(etw, db):
+    """
+    Bring the et_<batch> collections for the workspace <etw> (an ET_Workspace
+    which has not yet been loaded) up to date, fetching and ingesting files only
+    for new or changed batches. If the workspace totals recorded (as an
+    ET_Workspace_State) by the last sync are unchanged, nothing more is
+    fetched. Returns a dictionary listing the new, changed and vanished batches.
+    """
+    etw.load_summary()
+    state = ET_Workspace_State.objects.filter(workspace=etw.name).first()
+    if state is not None and all(getattr(state, k) == v for k, v in _workspace_state(etw).items()):
+        print(f'{etw.name}: unchanged since last sync')
+        return {'new': [], 'changed': [], 'vanished': []}
+
+    etw.load_batch_list()
+    existing = {c.name[3:]: c for c in Collection.objects.filter(
+        name__in=['et_'+b for b in etw.batches])}
+    new, changed = [], []
+    for name, batch in etw.batches.items():
+        c = existing.get(name)
+        if c is None:
+            new.append(name)
+        elif '_et_creation_time' in c:
+            if any(c._proxied.get(k) != v for k, v in _batch_state(batch).items()):
+                changed.append(name)
+        elif c.files.count() != batch.file_count or c.volume != batch.batch_size_bytes:
+            # loaded before syncs recorded the batch state
+            changed.append(name)
+        else:
+            c._proxied.update(_batch_state(batch))
+            c.save(update_fields=['_proxied'])
+    vanished = [c.name for c in Collection.objects.filter(name__startswith='et_')
+                if c._proxied.get('_et_workspace') == etw.name
+                and c.name[3:] not in etw.batches]
+
+    db.create_location(ET_LOCATION)
+    loc = db.retrieve_location(ET_LOCATION)
+    for name in changed:
+        # start again with the files in changed batches
+        c = existing[name]
+        db.remove_files(c, loc, list(c.files.filter(replicas=loc).values_list('id', 'size')))
+    etw.load_batch_files(new + changed, in_memory=False)
+    parse_workspace_into_db(etw, db, new + changed)
+
+    ET_Workspace_State.objects.update_or_create(
+        workspace=etw.name, defaults=dict(_workspace_state(etw), synced=timezone.now()))
+    for name in vanished:
+        print(f'Batch collection {name} is no longer in workspace {etw.name}')
+    print(f'{etw.name}: {len(new)} new and {len(changed)} changed batches ingested, '
+          f'{len(etw.batches) - len(new) - len(changed)} unchanged')
+    return {'new': new, 'changed': changed, 'vanished': vanished}
 
 
 def et_main(db, operation, gws, ssh_host=None, ssh_user=None):
     """
     Carry out <operation> on the <gws> group workspace
-    using the <db> instance provided.
+    using the <db> instance provided. Both 'init' and 'sync'
+    bring the database up to date with the workspace, only
+    ingesting batches which are new or have changed.
     """
-    if "!elastic_tape" not in CFSconfig.interfaces:
-        db.create_location('!elastic_tape')
-    if operation == 'init':
-        etw = _load_et(workspace=gws, ssh_host=ssh_host, ssh_user=ssh_user)
-        parse_workspace_into_db(etw, db)
+    db.create_location(ET_LOCATION)
+    if operation in ('init', 'sync'):
+        etw = _load_et(workspace=gws, ssh_host=ssh_host, ssh_user=ssh_user, load=False)
+        return sync_workspace_into_db(etw, db)
+    raise ValueError(f'Unknown elastic tape operation {operation}')
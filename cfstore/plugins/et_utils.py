@@ -2,12 +2,179 @@
 import unittest
 from bs4 import BeautifulSoup
 from urllib.request import urlopen
-import pickle, glob, os
+import pickle, glob, os, re, json, hashlib, codecs
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from pathlib import Path
 from dateutil.parser import parse as dateparse
 from datetime import datetime
 from cfstore.plugins.ssh import SSHTape
 
-WEBSITE = "http://et-monitor.fds.rl.ac.uk/et_user/"
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+# the elastic tape monitor (which can be overridden, e.g. to use a local stand-in)
+WEBSITE = os.getenv('CFS_ET_WEBSITE', "http://et-monitor.fds.rl.ac.uk/et_user/")
+
+
+class _TableRows(HTMLParser):
+    """
+    Collects the cell text of each row in the <table_index>'th table of a page
+    as it is fed, without building a document tree. Copes with the missing
+    end tags which browsers (and BeautifulSoup) forgive.
+    """
+    def __init__(self, table_index):
+        super().__init__(convert_charrefs=True)
+        self.table_index = table_index
+        self.tables = -1
+        self.in_table = False
+        self.rows = []
+        self.row = None
+        self.cell = None
+
+    def _end_cell(self):
+        if self.cell is not None:
+            self.row.append(''.join(self.cell).strip())
+            self.cell = None
+
+    def _end_row(self):
+        self._end_cell()
+        if self.row is not None:
+            self.rows.append(self.row)
+            self.row = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'table':
+            self.tables += 1
+            self.in_table = self.tables == self.table_index
+        elif not self.in_table:
+            return
+        elif tag == 'tr':
+            self._end_row()
+            self.row = []
+        elif tag in ('td', 'th'):
+            self._end_cell()
+            if self.row is None:
+                self.row = []
+            self.cell = []
+
+    def handle_endtag(self, tag):
+        if not self.in_table:
+            return
+        if tag in ('td', 'th'):
+            self._end_cell()
+        elif tag == 'tr':
+            self._end_row()
+        elif tag == 'table':
+            self._end_row()
+            self.in_table = False
+
+    def handle_data(self, data):
+        if self.cell is not None:
+            self.cell.append(data)
+
+
+def _lxml_table_rows(chunks, table_index):
+    """ The lxml version of <iter_table_rows> """
+    parser = etree.HTMLPullParser(events=('start', 'end'))
+    tables = -1
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event, element in parser.read_events():
+            if element.tag == 'table' and event == 'start':
+                tables += 1
+            elif element.tag == 'tr' and event == 'end':
+                parent = element.getparent()
+                table = parent if parent.tag == 'table' else parent.getparent()
+                if tables == table_index and table is not None and table.tag == 'table':
+                    yield [''.join(c.itertext()).strip() for c in element if c.tag in ('td', 'th')]
+                # forget rows once they have been seen
+                element.clear()
+                while element.getprevious() is not None:
+                    del parent[0]
+    parser.close()
+
+
+def iter_table_rows(chunks, table_index):
+    """
+    Yield the cell texts of each row of the <table_index>'th table (counting
+    from zero) of the html page provided as an iterable of byte <chunks>, as
+    the page streams in, without building a document tree. Uses lxml if it is
+    available, otherwise the standard library html parser.
+    """
+    if etree is not None:
+        yield from _lxml_table_rows(chunks, table_index)
+        return
+    parser = _TableRows(table_index)
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    for chunk in chunks:
+        parser.feed(decoder.decode(chunk))
+        yield from parser.rows
+        parser.rows = []
+    parser.close()
+    yield from parser.rows
+
+
+class BatchCache:
+    """
+    An on-disk cache of the file listings of elastic tape batches, keyed by
+    batch name and creation time (and the file count and size, which change
+    if files are removed from a batch), so that batches which have already
+    been fetched need not be downloaded and parsed again.
+    """
+    def __init__(self, directory=None):
+        """
+        Cache in <directory>, by default $CFS_ET_CACHE or ~/.cfstore/et_cache
+        """
+        if directory is None:
+            directory = os.getenv('CFS_ET_CACHE', Path.home()/'.cfstore'/'et_cache')
+        self.directory = Path(directory)
+
+    def _path(self, batch):
+        key = f'{batch.name}|{batch.creation_time}|{batch.file_count}|{batch.batch_size_bytes}'
+        stamp = hashlib.md5(key.encode()).hexdigest()[:16]
+        safe_name = re.sub(r'[^\w.-]', '_', batch.name)
+        return self.directory/f'{safe_name}_{stamp}.jsonl'
+
+    def __contains__(self, batch):
+        return self._path(batch).exists()
+
+    def get(self, batch):
+        """
+        Return an iterator over the cached (filename, size) of the files in a
+        <batch>, read from disk as it goes, or None if the batch is not cached.
+        """
+        path = self._path(batch)
+        if not path.exists():
+            return None
+        return self._read(path)
+
+    @staticmethod
+    def _read(path):
+        with open(path, 'r') as f:
+            for line in f:
+                name, size = json.loads(line)
+                yield name, size
+
+    def put(self, batch, files):
+        """
+        Pass through the (filename, size) <files> of a <batch>, writing them to the
+        cache as they go by. The batch is only cached once all of them have been seen.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self._path(batch)
+        tmp = path.with_name(path.name + f'.{os.getpid()}.{id(files)}.tmp')
+        try:
+            with open(tmp, 'w') as f:
+                for row in files:
+                    f.write(json.dumps(row) + '\n')
+                    yield row
+            os.replace(tmp, path)
+        finally:
+            if tmp.exists():
+                os.remove(tmp)
 
 
 class Souper:
@@ -17,7 +184,8 @@ class Souper:
     server, or indirectly, via ssh to a host which
     has access to that content.
     """
-    def __init__(self, ssh_host, ssh_user):
+    def __init__(self, ssh_host, ssh_user, website=None):
+        self.website = website or WEBSITE
         if ssh_host is None:
             self.ssh = None
         else:
@@ -27,23 +195,39 @@ class Souper:
         """
         Return html content
         """
-        target = WEBSITE + url
+        target = self.website + url
         if self.ssh is None:
             html = urlopen(target)
         else:
             html = self.ssh.get_html(target)
         return BeautifulSoup(html, features='html.parser')
 
+    def stream(self, url, blocksize=65536):
+        """
+        Yield html content in byte chunks as it arrives
+        """
+        target = self.website + url
+        if self.ssh is None:
+            with urlopen(target) as response:
+                yield from iter(lambda: response.read(blocksize), b'')
+        else:
+            yield from self.ssh.stream_html(target, blocksize=blocksize)
+
 
 class ET_Workspace:
     """
     Collect all file information about a specific workspace.
     This version assumes all data loaded is still present.
     """
-    def __init__(self, workspace_name, ssh_host=None, ssh_user=None):
+    def __init__(self, workspace_name, ssh_host=None, ssh_user=None, threads=8, cache=True, load=True,
+                 website=None):
         """
         Initialise with the GWS/ET workspace, and if necessary, ssh
-        credentials to access remotely.
+        credentials to access remotely (and the <website> if it is not
+        the usual elastic tape monitor). Batch file listings are fetched
+        using <threads> threads, and (unless <cache> is False) kept in a
+        <BatchCache> (or the one passed as <cache>). Everything is loaded
+        from elastic tape straight away unless <load> is False.
         """
         self.name = workspace_name
         self.batches = {}
@@ -51,32 +235,71 @@ class ET_Workspace:
         self.quota_allocated = 0
         self.quota_used = 0
         self.volume = 0
-        self.souper = Souper(ssh_host, ssh_user)
+        self.threads = threads
+        if cache is True:
+            cache = BatchCache()
+        self.cache = cache or None
+        self.souper = Souper(ssh_host, ssh_user, website)
         if self.souper.ssh is None:
             print('Elastic tape interface being used in "Inside RAL" mode')
         else:
             print(f'Elastic tape access via {ssh_host} and {ssh_user}')
-        self.load_from_et()
+        if load:
+            self.load_from_et()
 
     def load_from_et(self):
+        """
+        Load the workspace summary, its batches, and the files in every batch
+        """
+        self.load_summary()
+        self.load_batch_list()
+        self.load_batch_files()
+
+    def load_summary(self):
+        """
+        Load the file count, quotas and volume of the workspace
+        """
         url = f"ET_Holdings_Summary.php?workspace={self.name}&level=top"
         print(url)
         soup = self.souper.get(url)
         summary_td = soup.find_all('table')[1].find_all('tr')[1].find_all('td')
-        self.file_count = summary_td[0]
+        self.file_count = int(summary_td[0].text)
 
         # quotas in bytes
         self.quota_allocated = int(summary_td[4].text)
         self.quota_used = int(summary_td[5].text)
         self.volume = int(summary_td[6].text)
+
+    def load_batch_list(self):
+        """
+        Load the list of batches in the workspace, without their files
+        """
         url = f"ET_Holdings_Summary.php?workspace={self.name}&level=batches"
         soup = self.souper.get(url)
         try:
             rows = soup.find_all('table')[2].find_all('tr')
         except:
             rows = []
-        self.batches = {B.name: B for B in [Batch(r, self) for r in rows[1:]]}
-        print(f'{self.name}: {len(self.batches)} batches')
+        self.batches = {B.name: B for B in [Batch(r, self, load_files=False) for r in rows[1:]]}
+
+    def load_batch_files(self, names=None, in_memory=True):
+        """
+        Load the files of the batches called <names> (default all), using
+        <threads> threads, and the cache if there is one. If not <in_memory>,
+        and there is a cache, the files are only put in the cache, from which
+        they can be streamed with Batch.iter_files.
+        """
+        if names is None:
+            names = list(self.batches)
+        batches = [self.batches[n] for n in names]
+        if in_memory:
+            load = lambda b: b.load_files(self.cache)
+        else:
+            load = lambda b: b.prefetch(self.cache)
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            fetched = sum(pool.map(load, batches))
+        print(f'{self.name}: {len(self.batches)} batches, files loaded for {len(batches)} '
+              f'({fetched} fetched, {len(batches) - fetched} cached)')
 
     def __str__(self):
         return self.name
@@ -89,10 +312,11 @@ class Batch:
     """
     Describe a batch and the files within.
     """
-    def __init__(self, row, workspace):
+    def __init__(self, row, workspace, load_files=True):
         """ Initialise with a soup row element from
             http://et-monitor.fds.rl.ac.uk/et_user/
             ET_Holdings_Summary.php?workspace=X&level=batches
+            and (unless <load_files> is False) load the list of files.
         """
         self.workspace = workspace
         link = row.find('a')
@@ -104,17 +328,60 @@ class Batch:
         self.batch_size_bytes = int(td[5].text)
         self.url = link['href']
         self.transfers = []
+        self.files = None
+        if load_files:
+            self.load_files()
+
+    def load_files(self, cache=None):
+        """
+        Load the {filename: size} of the files in this batch, from the <cache>
+        if it is there, otherwise from the batch details page (adding them to
+        the <cache>). Returns True if the page was fetched.
+        """
+        fetched = cache is None or self not in cache
+        self.files = dict(self.iter_files(cache))
+        return fetched
+
+    def prefetch(self, cache):
+        """
+        Make sure the files of this batch are in the <cache> (which avoids holding
+        them in memory), or if there is no cache, load them. Returns True if the
+        page was fetched.
+        """
+        if cache is None:
+            return self.load_files()
+        if self in cache:
+            return False
+        for row in self.iter_files(cache):
+            pass
+        return True
+
+    def iter_files(self, cache=None):
+        """
+        Yield (filename, size) for the files in this batch, from memory if they
+        have been loaded, or from the <cache>, or otherwise streamed from the batch
+        details page (and added to the <cache>) without holding them all in memory.
+        """
+        if self.files is not None:
+            yield from self.files.items()
+            return
+        cached = cache.get(self) if cache is not None else None
+        if cached is not None:
+            yield from cached
+            return
         file_url = 'ET_Batch_Input_File_Details.php?batch='+self.name
-        soup = self.workspace.souper.get(file_url)
-        tables = soup.find_all('table')
-        file_rows = tables[1].find_all('tr')[1:]
-        file_data = [r.find_all('td') for r in file_rows]
-        self.files = {f[0].text: int(f[1].text) for f in file_data}
+        rows = iter_table_rows(self.workspace.souper.stream(file_url), 1)
+        # skip the header row
+        next(rows, None)
+        files = ((r[0], int(r[1])) for r in rows)
+        if cache is not None:
+            files = cache.put(self, files)
+        yield from files
 
     def load_transfers(self):
         soup = self.workspace.souper.get(self.url)
         tables = soup.find_all('table')
-        self.transfers = [TransferSummary(r) for r in self.tables[3].find_all('tr')[1:]]
+        self.transfers = [TransferSummary(r) for r in tables[3].find_all('tr')[1:]]
 
 
 class TransferSummary:
@@ -124,7 +391,7 @@ class TransferSummary:
             http://et-monitor.fds.rl.ac.uk/et_user/
             ET_Batch_Input_Summary.php?workspace=X&caller=etjasmin&batch=Y
         """
-        link = row.findf('a')
+        link = row.find('a')
         self.name = link.text
         td = row.find_all('td')
         self.status = td[1].text
@@ -173,11 +440,12 @@ class Transfer:
             http://et-monitor.fds.rl.ac.uk/et_user/
             ET_Aggregation_File_Details.php?aggregation=235228
     """
-    def __init__(self, name):
+    def __init__(self, name, souper=None):
 
         self.name = name
         url = f'ET_Aggregation_File_Details.php?aggregation={name}'
-        souper = Souper(None, None)
+        if souper is None:
+            souper = Souper(None, None)
         soup = souper.get(url)
         self.files = []
         self.aggregation_name = soup.find('p').text.split()[-1]
@@ -205,7 +473,7 @@ class Transfer:
         file_table = soup.find_all('table', id='Aggregation details')[1]
         for f in file_table.find_all('tr')[1:]:
             td = f.find_all('td')
-            self.files.append(File(name=td[0].findf('a').text, size=int(td[1].text)))
+            self.files.append(File(name=td[0].find('a').text, size=int(td[1].text)))
 
     def __str__(self):
         return '\n'.join([str(t) for t in self.transitions])
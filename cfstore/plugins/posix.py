@@ -1,12 +1,25 @@
 import os
 import re
+import time
 
 import cf
 import numpy as np
+from django.db import transaction
+from django.db.models import F
 
 from cfstore import db
-from cfstore.cfparse_file import cfparse_file
-from cfstore.plugins.ssh import SSHlite
+from cfstore.broker import BrokeredSSHlite, connect_broker
+from cfstore.cfparse_file import cfparse_file, record_fingerprint
+from cfstore.checksums import (
+    checksum_file,
+    checksum_files,
+    new_hash,
+    report_throughput,
+)
+from cfstore.ingest import IngestJournal, chunked
+from cfstore.metacache import MetadataCache, file_stamp
+from cfstore.plugins.ssh import REMOTE_CHECKSUMS, SSHlite
+from cfstore.walk import ordered_walk, scan_tree, scandir_listing
 
 
 def manage_types(value):
@@ -27,6 +40,60 @@ def manage_types(value):
         raise ValueError("Unrecognised type for database ", type(value))
 
 
+def extract_aggregation_metadata(aggfile):
+    """
+    Read a cf python aggregation file and return the metadata of each field in
+    it as a plain dictionary, as for <extract_file_metadata>, with the fragment
+    files of the field as its filenames.
+    """
+    records = []
+    # loop over fields in file (not the same as netcdf variables)
+    for v in cf.read(aggfile):
+        properties = v.properties()
+        cell_methods = v.cell_methods()
+        cell_methods_unpacked = []
+        if cell_methods:
+            for cmethod in cell_methods.values():
+                axes = cmethod.axes
+                methods = cmethod.method
+                cell_method_dict = {"axes": list(axes), "methods": methods}
+                cell_methods_unpacked.append(cell_method_dict)
+
+        if "standard_name" not in properties and "long_name" not in properties:
+            properties["long_name"] = v.identity()
+        name, long_name = v.get_property("standard_name", None), v.get_property(
+            "long_name", None
+        )
+        # Maybe use shape? Would require back-end update
+
+        managed_properties = {}
+        for k, p in properties.items():
+            if k not in ["standard_name", "long_name"]:
+                managed_properties[k] = manage_types(p)
+
+        if "frequency" in managed_properties.keys():
+            if managed_properties["frequency"] == cf.D:
+                managed_properties["frequency"] = "Daily"
+            if managed_properties["frequency"] == cf.M:
+                managed_properties["frequency"] = "Monthly"
+            if managed_properties["frequency"] == cf.Y:
+                managed_properties["frequency"] = "Yearly"
+
+        records.append(
+            {
+                "identity": v.identity(),
+                "standard_name": name,
+                "long_name": long_name,
+                "size": int(v.size),
+                "domain": v.domain._one_line_description(),
+                "properties": managed_properties,
+                "cell_methods": cell_methods_unpacked,
+                "filenames": sorted(v.get_filenames()),
+            }
+        )
+    return records
+
+
 class Posix:
     """
 
@@ -36,6 +103,9 @@ class Posix:
 
     """
 
+    # number of threads used to list directories when walking local trees
+    walk_threads = 8
+
     def __init__(self, db, location):
         """
 
@@ -58,6 +128,7 @@ class Posix:
         subcollections=False,
         checksum=None,
         regex=None,
+        resume=False,
     ):
         """
 
@@ -67,11 +138,25 @@ class Posix:
         Optionally (<subcollections=True>), create sub-collections for all internal directories
         (default = False = do not create sub-collections). (NOT YET IMPLEMENTED) Not Implemented
 
-        If checksums required, provide a checksum method string.
-        (NOT YET IMPLEMENTED) Not Implemented
+        If checksums required, provide a checksum method string (e.g. "sha256", or a
+        fast non-cryptographic hash such as "xxh3_64" if xxhash is installed, see
+        cfstore.checksums.HASHES); the files are checksummed in parallel once they
+        are in the collection.
+
+        Progress is recorded in an ingest journal as files are committed. If a previous
+        attempt to add this collection was interrupted, use <resume=True> to carry on
+        from where it stopped (the collection must then already exist).
 
         """
-        c = self.db.create_collection(collection_head_name, collection_head_description)
+        if checksum:
+            # check the method is available before doing anything else
+            self._check_method(checksum)
+        if resume:
+            c = self.db.retrieve_collection(collection_head_name)
+        else:
+            c = self.db.create_collection(
+                collection_head_name, collection_head_description
+            )
         args = [
             path_to_collection_head,
             collection_head_name,
@@ -92,14 +177,20 @@ class Posix:
         for n in range(len(args)):
             print(c._proxied, type(c._proxied))
             c[keys[n]] = args[n]
+        c.save(update_fields=["_proxied"])
         self._walk(
             path_to_collection_head,
             collection_head_name,
             subcollections,
             checksum,
             regex,
+            resume,
         )
 
+    def _check_method(self, method):
+        """Raise a ValueError if files here cannot be checksummed with <method>"""
+        new_hash(method)
+
     def _walk(
         self,
         path_to_collection_head,
@@ -107,35 +198,194 @@ class Posix:
         subcollections,
         checksum,
         regex,
+        resume=False,
     ):
         """Walk local POSIX tree"""
-        if subcollections:
-            for dirName, directories, files in os.walk(path_to_collection_head):
-                dbfiles = []
-                for f in files:
-                    if not regex or re.match(regex, f):
-                        fp = dirName + "/" + f
-                        dbfiles.append(
-                            self._file2dict(fp, os.stat(fp).st_size, checksum=checksum)
-                        )
-                self.db.upload_files_to_collection(
-                    self.location, collection_head_name, dbfiles
-                )
-        else:
-            for dirName, directories, files in os.walk(path_to_collection_head):
-                dbfiles = []
-                for f in files:
-                    if not regex or re.match(regex, f):
-                        if dirName == path_to_collection_head:
-                            fp = path_to_collection_head + "/" + f
-                            dbfiles.append(
-                                self._file2dict(
-                                    fp, os.stat(fp).st_size, checksum=checksum
-                                )
-                            )
-                    self.db.upload_files_to_collection(
-                        self.location, collection_head_name, dbfiles
+        dir_mtimes = {}
+        self.db.upload_files_to_collection(
+            self.location,
+            collection_head_name,
+            self._iter_files(
+                path_to_collection_head, subcollections, None, regex, dir_mtimes
+            ),
+            journal=IngestJournal(),
+            resume=resume,
+        )
+        # keep the directory state for later rescans
+        c = self.db.retrieve_collection(collection_head_name)
+        db.Directory_Mtime.store(c, dir_mtimes)
+        if checksum:
+            self.check_collection(collection_head_name, method=checksum)
+
+    def _iter_files(
+        self, path_to_collection_head, subcollections, checksum, regex, dir_mtimes=None
+    ):
+        """
+        Yield the file dictionaries for files below <path_to_collection_head> as
+        they are found (only those in the top directory unless <subcollections>).
+        Directories are listed in parallel (using <walk_threads> threads), but files
+        are yielded in a repeatable (sorted) order so ingests can be resumed.
+        """
+        for fp, st in scan_tree(
+            path_to_collection_head,
+            recurse=subcollections,
+            workers=self.walk_threads,
+            dir_mtimes=dir_mtimes,
+        ):
+            if not regex or re.match(regex, os.path.basename(fp)):
+                yield self._file2dict(fp, st.st_size, checksum=checksum, stat=st)
+
+    def rescan(self, collection, deep=False):
+        """
+        Bring an existing <collection> (added by <add_collection>) up to date with the
+        files now found below its <path_to_collection_head>, applying only the adds,
+        removes and modifications found.
+
+        Directories whose modification time is unchanged since the last walk are not
+        listed again, since no files can have been added to or removed from them.
+        Files modified in place do not change the directory modification time, so
+        these are only found in unchanged directories if <deep> is True, in which case
+        each previously known file is stat-ed again.
+
+        Modified files (different size, mtime or inode) have their size updated and
+        their checksum reset. Files ingested without an mtime and inode are only
+        compared on size, and have those filled in if unchanged. Removed files are
+        taken out of the collection and this location, but stay in the database. If
+        the collection was walked with a checksum, only the added and modified files
+        are checksummed again.
+
+        Returns a dictionary with the number of files added, removed and modified,
+        and the number of directories skipped.
+        """
+        c = self.db.retrieve_collection(collection)
+        loc = self.db.retrieve_location(self.location)
+        try:
+            top, recurse = c["_path_to_collection_head"], c["_subcollections"]
+        except KeyError:
+            raise ValueError(f"Collection {collection} was not added by a posix walk")
+        regex, checksum = c._proxied.get("_regex"), c._proxied.get("_checksum")
+        old_dirs = db.Directory_Mtime.load(c)
+
+        known, names_in = {}, {}
+        for fid, path, name, size, mtime, inode in c.files.filter(
+            replicas=loc
+        ).values_list("id", "path", "name", "size", "mtime", "inode"):
+            known[os.path.join(path, name)] = (fid, size, mtime, inode)
+            names_in.setdefault(path, []).append(name)
+        children = {}
+        for d in sorted(old_dirs):
+            if d != top:
+                children.setdefault(os.path.dirname(d), []).append(d)
+
+        new_dirs = {}
+
+        def lister(path):
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                return [], []
+            new_dirs[path] = mtime
+            if old_dirs.get(path) != mtime:
+                return scandir_listing(path)
+            files = [os.path.join(path, n) for n in sorted(names_in.get(path, []))]
+            if deep:
+                statted = []
+                for fp in files:
+                    try:
+                        statted.append((fp, os.stat(fp)))
+                    except OSError:
+                        pass
+                return statted, children.get(path, [])
+            return [(fp, None) for fp in files], children.get(path, [])
+
+        seen, modified, new, unstamped = set(), [], [], []
+
+        def changes():
+            for fp, st in ordered_walk(
+                lister, top, workers=self.walk_threads, recurse=recurse
+            ):
+                if fp in known:
+                    seen.add(fp)
+                    fid, size, mtime, inode = known[fp]
+                    if st is None:
+                        continue
+                    if mtime is None or inode is None:
+                        # ingested without them, so only the size can be compared
+                        if size != st.st_size:
+                            modified.append((fid, size, st))
+                        else:
+                            unstamped.append((fid, st))
+                    elif (size, mtime, inode) != (st.st_size, st.st_mtime, st.st_ino):
+                        modified.append((fid, size, st))
+                elif not regex or re.match(regex, os.path.basename(fp)):
+                    new.append(os.path.split(fp))
+                    yield self._file2dict(fp, st.st_size, stat=st)
+
+        added = self.db.upload_files_to_collection(self.location, collection, changes())
+        removed = [known[fp] for fp in known.keys() - seen]
+        self.db.remove_files(c, loc, removed)
+        self._update_modified(c, loc, modified)
+        self._update_stamps(unstamped)
+        if checksum and (new or modified):
+            # only the new and modified files need checksums
+            ids = list(self.db.file_ids(new).values()) + [fid for fid, _, _ in modified]
+            self.check_collection(collection, update=False, method=checksum, ids=ids)
+        db.Directory_Mtime.store(c, new_dirs)
+
+        skipped = sum(1 for d, m in new_dirs.items() if old_dirs.get(d) == m)
+        summary = {
+            "added": added["files"],
+            "removed": len(removed),
+            "modified": len(modified),
+            "skipped_directories": skipped,
+        }
+        print(f"Rescanned {collection}: {summary}")
+        return summary
+
+    def _update_stamps(self, unstamped):
+        """
+        Record the modification time and inode of the unchanged files in <unstamped>
+        (tuples of id and stat result), which were ingested without them.
+        """
+        for chunk in chunked(unstamped, self.db.ingest_chunksize):
+            db.File.objects.bulk_update(
+                [
+                    db.File(id=fid, mtime=st.st_mtime, inode=st.st_ino)
+                    for fid, st in chunk
+                ],
+                ["mtime", "inode"],
+            )
+
+    def _update_modified(self, c, loc, modified):
+        """
+        Update the files in <modified> (tuples of id, old size, and new stat result)
+        and the collection and location volumes.
+        """
+        for chunk in chunked(modified, self.db.ingest_chunksize):
+            files = []
+            volume = 0
+            for fid, size, st in chunk:
+                files.append(
+                    db.File(
+                        id=fid,
+                        size=st.st_size,
+                        mtime=st.st_mtime,
+                        inode=st.st_ino,
+                        checksum="None",
+                        checksum_method="",
                     )
+                )
+                volume += st.st_size - size
+            with transaction.atomic():
+                db.File.objects.bulk_update(
+                    files, ["size", "mtime", "inode", "checksum", "checksum_method"]
+                )
+                db.Collection.objects.filter(pk=c.pk).update(
+                    volume=F("volume") + volume
+                )
+                db.Location.objects.filter(pk=loc.pk).update(
+                    volume=F("volume") + volume
+                )
 
     def getBMetadata(
         self, remotepath, collection, localpath, subcollections, checksum, regex
@@ -150,121 +400,191 @@ class Posix:
         # self.ssh.get_b_metadata(path_to_collection_head,self.db)
         self.ssh.run_script(remotepath, collection, localpath)
 
-    def _file2dict(self, path_to_file, size, checksum=None):
+    def _file2dict(self, path_to_file, size, checksum=None, stat=None):
         """
         Build the dictionary of file information needed for cfstore
+        (including the modification time and inode if a <stat> result is available,
+        and a checksum if a <checksum> method is given).
         """
         p, n = os.path.split(path_to_file)
-        if checksum is not None:
-            raise NotImplementedError
 
         f = {"size": size, "path": p, "name": n}
+        if checksum is not None:
+            f["checksum"] = checksum_file(path_to_file, checksum)
+            f["checksum_method"] = checksum
+        if stat is not None:
+            f["mtime"] = stat.st_mtime
+            f["inode"] = stat.st_ino
         return f
 
-    def check_collection(self, collection, update=True, processes=4):
+    def check_collection(
+        self, collection, update=True, processes=4, method="sha256", ids=None
+    ):
         """
         Used to check AND update status of files in a collection. If files already have checksums, will return
         those files which have changed checksums (user has to decide whether that is corruption or a
         deliberate change). If update is True, the checksums will be updated, if not, they will only be
         updated if there was no previous checksum. (Files with no previous checksum will not be returned as changed,
         come what may. By default, use <processes> subprocesses to do the checksumming.
+
+        Checksums use the registered hash <method>, and a previous checksum only counts if
+        it was made with the same method. Checksums are written back in bulk, and the
+        throughput of each worker is reported. If <ids> are given, only the files of the
+        collection with those ids are checked.
         """
-        raise NotImplementedError
+        files = self._collection_files(
+            collection, ("id", "path", "name", "checksum", "checksum_method"), ids
+        )
+        known = {}
+
+        def items():
+            for f in files:
+                known[f.pk] = f
+                yield f.pk, os.path.join(f.path, f.name)
+
+        stats = {}
+        start = time.perf_counter()
+        results = (
+            (known.pop(fid), digest)
+            for fid, digest in checksum_files(
+                items(), method=method, processes=processes, stats=stats
+            )
+        )
+        changed = self._store_checksums(results, method, update)
 
-    def aggregation_files_to_collection(self, aggfile, collection):
+        nbytes = sum(s[0] for s in stats.values())
+        elapsed = time.perf_counter() - start
+        print(
+            f"Checksummed {nbytes / 1e6:.1f} MB in {elapsed:.2f}s "
+            f"({nbytes / 1e6 / elapsed if elapsed else 0.0:.1f} MB/s overall)"
+        )
+        report_throughput(stats)
+        return changed
+
+    def _collection_files(self, collection, fields, ids=None):
+        """
+        Yield the files of <collection> at this location (with only <fields> loaded)
+        in id order, restricted to those with <ids> (looked up in chunks) if given.
+        """
+        c = self.db.retrieve_collection(collection)
+        loc = self.db.retrieve_location(self.location)
+        files = c.files.filter(replicas=loc).only(*fields).order_by("id")
+        if ids is None:
+            yield from files.iterator()
+            return
+        for chunk in chunked(sorted(set(ids)), self.db.ingest_chunksize):
+            yield from files.filter(id__in=chunk)
+
+    def _store_checksums(self, results, method, update):
         """
-        Uses a cf python aggregation file to add metadata variables to the appropriate files
+        Given (file, digest) <results> from checking files with <method>, write back
+        new checksums in bulk (changed checksums only if <update>), and return the
+        files whose checksums changed. Digests of None (unreadable files) are ignored.
+        """
+        changed, updates = [], []
+        for f, digest in results:
+            if digest is None:
+                continue
+            previous = f.checksum if f.checksum_method == method else None
+            if previous in (None, "", "None"):
+                previous = None
+            if previous is not None and previous != digest:
+                changed.append(f)
+                if not update:
+                    continue
+            elif previous == digest:
+                continue
+            f.checksum, f.checksum_method = digest, method
+            updates.append(f)
+            if len(updates) >= self.db.ingest_chunksize:
+                db.File.objects.bulk_update(updates, ["checksum", "checksum_method"])
+                updates = []
+        db.File.objects.bulk_update(updates, ["checksum", "checksum_method"])
+        return changed
+
+    def aggregation_files_to_collection(self, aggfile, collection, cache=True):
+        """
+        Uses a cf python aggregation file to add metadata variables to the appropriate files.
+        The metadata read from an aggregation file is cached like that of other files (see
+        <CollectionDB.add_variables_from_files>), so it is not read again while the file is
+        unchanged (unless <cache> is False; a <MetadataCache> may also be passed as <cache>).
         """
-        # open file
-        # read file into list of variables
         print("Adding variables from", aggfile)
-        # aggfileobject = open(aggfile,'r')
-        cff = cf.read(aggfile)
-        # for each variable
+        opened = cache is True
+        if opened:
+            cache = MetadataCache()
+        elif cache is False:
+            cache = None
+        try:
+            # (an empty cache is falsy, so test against None)
+            stamp = file_stamp(aggfile) if cache is not None else None
+            records = cache.get(stamp) if stamp is not None else None
+            if records is None:
+                records = extract_aggregation_metadata(aggfile)
+                if stamp is not None:
+                    cache.put(stamp, records)
+                    cache.flush()
+        finally:
+            if opened:
+                cache.close()
         c = self.db.retrieve_collection(collection)
 
-        # loop over fields in file (not the same as netcdf variables)
-        for v in cff:
-            properties = v.properties()
-            cell_methods = v.cell_methods()
-            cell_methods_unpacked = []
-            if cell_methods:
-                for cmethod in cell_methods.values():
-                    axes = cmethod.axes
-                    methods = cmethod.method
-                    cell_method_dict = {"axes": axes, "methods": methods}
-                    print(cell_method_dict)
-                    cell_methods_unpacked.append(cell_method_dict)
-
-            print("Starting")
-            if "standard_name" not in properties and "long_name" not in properties:
-                properties["long_name"] = v.identity()
-            name, long_name = v.get_property("standard_name", None), v.get_property(
-                "long_name", None
+        fields = []
+        for r in records:
+            var = db.Variable(
+                identity=r["identity"],
+                standard_name=r["standard_name"],
+                long_name=r["long_name"],
+                cfdm_size=r["size"],
+                cfdm_domain=r["domain"],
+                _proxied=r["properties"],
+                _cell_methods=r["cell_methods"],
+                fingerprint=record_fingerprint(r),
             )
-            identity = v.identity()
-            domain = v.domain._one_line_description()
-            size = v.size
-            # Maybe use shape? Would require back-end update
-
-            managed_properties = {}
-            for k, p in properties.items():
-                if k not in ["standard_name", "long_name"]:
-                    managed_properties[k] = manage_types(p)
-
-                    if "frequency" in managed_properties.keys():
-                if managed_properties["frequency"] == cf.D:
-                    managed_properties["frequency"] = "Daily"
-                if managed_properties["frequency"] == cf.M:
-                    managed_properties["frequency"] = "Monthly"
-                if managed_properties["frequency"] == cf.Y:
-                    managed_properties["frequency"] = "Yearly"
-
-            var, created = db.Variable.objects.get_or_create(
-                identity=identity,
-                standard_name=name,
-                long_name=long_name,
-                cfdm_size=size,
-                cfdm_domain=domain,
-                _proxied=managed_properties,
-                _cell_methods=cell_methods_unpacked,
-            )
-            print(created)
-            if not created:
-                print("Variable already exists! Updating files")
-            if c not in var.in_collection.all():
-                var.in_collection.add(c)
-
-            files = list(v.get_filenames())
-            for file in files:
-                (path, file) = os.path.split(file)
-                try:
-                    file = self.db.retrieve_file(path, file)
-                    if file not in var.in_files.all():
-                        var.in_files.add(file)
-                    file.save()
-                except FileNotFoundError:
-                    try:
-                        uc = (
-                            self.session.query(db.Collection)
-                            .filter_by(name="unlisted")
-                            .one()
-                        )
-                    except:
-                        uc = db.Collection(
-                            name="unlisted",
-                            volume=0,
-                            description="Holds unlisted files",
-                        )
-                    uf = db.File(
-                        name=file, path=path, checksum=0, size=0, format="unknown"
+            files = [os.path.split(f) for f in r["filenames"]]
+            fields.append((var, files))
+
+        with transaction.atomic():
+            # one lookup for the variables, and one per chunk of fragment files
+            existing = {
+                var.fingerprint: var
+                for var in db.Variable.objects.filter(
+                    fingerprint__in={var.fingerprint for var, files in fields}
+                )
+            }
+            new = []
+            for var, files in fields:
+                if var.fingerprint not in existing:
+                    existing[var.fingerprint] = var
+                    new.append(var)
+            db.Variable.objects.bulk_create(new)
+            db.index_new_variables(new)
+            print(f"{len(new)} new variables, {len(fields) - len(new)} already known")
+            file_ids = self.db.file_ids(p for var, files in fields for p in files)
+
+            links = {
+                (existing[var.fingerprint].pk, file_ids[p])
+                for var, files in fields
+                for p in files
+            }
+            for chunk in chunked(links, self.db.ingest_chunksize):
+                db.Variable.in_files.through.objects.bulk_create(
+                    [
+                        db.Variable.in_files.through(variable_id=v, file_id=f)
+                        for v, f in chunk
+                    ],
+                    ignore_conflicts=True,
+                )
+            db.Variable.in_collection.through.objects.bulk_create(
+                [
+                    db.Variable.in_collection.through(
+                        variable_id=var.pk, collection_id=c.pk
                     )
-                    uf.save()
-                    var.in_files.add(uf)
-
-            print(var.id)
-            print(var.keys())
-            var.save()
+                    for var in {var.pk: var for var in existing.values()}.values()
+                ],
+                ignore_conflicts=True,
+            )
+        print(f"Linked {len(fields)} variables to their files ({len(links)} links)")
 
 
 class RemotePosix(Posix):
@@ -276,9 +596,14 @@ class RemotePosix(Posix):
         """
         Configure RemotePosix backend with hostname, username, and anything else needed by the
         SSH backend. Currently the ssh backend uses SSHlite, and expects to use a running SSH Agent,
-        and so now keyword arguments are expected or used.
+        and so now keyword arguments are expected or used. If a connection broker is running
+        (see cfstore.broker) its connection is borrowed rather than connecting afresh.
         """
-        self.ssh = SSHlite(hostname, username)
+        broker = connect_broker()
+        if broker is not None:
+            self.ssh = BrokeredSSHlite(hostname, username, broker)
+        else:
+            self.ssh = SSHlite(hostname, username)
 
     def _walk(
         self,
@@ -287,6 +612,7 @@ class RemotePosix(Posix):
         subcollections,
         checksum,
         regex,
+        resume=False,
     ):
         """
         Walk a remote directory and populate the collection
@@ -294,15 +620,72 @@ class RemotePosix(Posix):
         # Useful: https://stackoverflow.com/questions/45653213/parallel-downloads-with-multiprocessing-and-pysftp
         if not hasattr(self, "ssh"):
             raise ConnectionError("Posix has not been initialised")
-        if checksum:
-            raise ValueError(
-                "Cannot (ok, really we mean, will not) checksum remote files"
-            )
         if subcollections:
             raise NotImplementedError("No support for sub-collections as yet")
         if regex:
             raise NotImplementedError("No support for remote regex yet")
 
-        files = self.ssh.get_files_and_sizes(path_to_collection_head, subcollections)
-        dbfiles = [self._file2dict(f[0], f[1]) for f in files]
-        self.db.upload_files_to_collection(self.location, collection_head_name, dbfiles)
+        files = self.ssh.iter_files_and_sizes(path_to_collection_head)
+        dbfiles = (dict(self._file2dict(p, s), mtime=m) for p, s, m in files)
+        self.db.upload_files_to_collection(
+            self.location,
+            collection_head_name,
+            dbfiles,
+            journal=IngestJournal(),
+            resume=resume,
+        )
+        if checksum:
+            self.check_collection(collection_head_name, method=checksum)
+
+    def _check_method(self, method):
+        """Raise a ValueError if files here cannot be checksummed with <method>"""
+        if method not in REMOTE_CHECKSUMS:
+            raise ValueError(
+                f"Cannot checksum remote files with {method} "
+                f"(available: {', '.join(REMOTE_CHECKSUMS)})"
+            )
+
+    def check_collection(
+        self, collection, update=True, processes=4, method="sha256", ids=None
+    ):
+        """
+        As for Posix.check_collection, but the files are checksummed on the remote host
+        by <processes> parallel checksum commands (see SSHlite.checksum_files), so that
+        only paths and checksums cross the network. Files are checked in batches
+        of <ingest_chunksize>.
+        """
+        if not hasattr(self, "ssh"):
+            raise ConnectionError("Posix has not been initialised")
+        files = self._collection_files(
+            collection,
+            ("id", "path", "name", "size", "checksum", "checksum_method"),
+            ids,
+        )
+        nbytes = 0
+
+        def results():
+            nonlocal nbytes
+            for chunk in chunked(files, self.db.ingest_chunksize):
+                bypath = {os.path.join(f.path, f.name): f for f in chunk}
+                for path, digest in self.ssh.checksum_files(
+                    list(bypath), method=method, processes=processes
+                ):
+                    f = bypath.pop(path, None)
+                    if f is not None:
+                        nbytes += f.size
+                        yield f, digest
+
+        start = time.perf_counter()
+        changed = self._store_checksums(results(), method, update)
+        elapsed = time.perf_counter() - start
+        print(
+            f"Checksummed {nbytes / 1e6:.1f} MB remotely in {elapsed:.2f}s "
+            f"({nbytes / 1e6 / elapsed if elapsed else 0.0:.1f} MB/s overall)"
+        )
+        return changed
+
+    def rescan(self, collection, deep=False):
+        """
+        Incremental rescans depend on local directory modification times.
+        """
+        raise NotImplementedError("No support for remote rescan yet")
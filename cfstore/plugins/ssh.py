@@ -1,14 +1,26 @@
 import fnmatch
 import glob
+import io
 import os
 import posixpath
+import shlex
+import threading
 import time
+import uuid
 from itertools import product
-from stat import S_ISDIR, S_ISREG
+from stat import S_ISDIR, S_ISLNK, S_ISREG
 
 import paramiko
 
 from cfstore.cfparse_file import cfparse_file
+from cfstore.walk import ordered_walk
+
+# remote commands (which must support -z) for the checksum methods of cfstore.checksums
+REMOTE_CHECKSUMS = {
+    "sha256": "sha256sum",
+    "md5": "md5sum",
+    "blake2b": "b2sum",
+}
 
 
 class SSHcore:
@@ -48,6 +60,9 @@ class SSHlite(SSHcore):
     machine*.
     """
 
+    # number of SFTP channels used to list directories concurrently
+    walk_channels = 4
+
     def isalive(self):
         return self.transport.is_active()
 
@@ -70,8 +85,9 @@ class SSHlite(SSHcore):
         """
         Recursively descend, depth first, the directory tree rooted at
         remotepath, calling discreet callback functions for each regular file,
-        directory and unknown file type. (This is a direct clone of the pysftp
-        function.)
+        directory and unknown file type. (This is a clone of the pysftp
+        function, but with one listdir_attr round trip per directory rather
+        than a stat for every entry.)
 
         :param str remotepath:
             root of remote directory to descend, use '.' to start at
@@ -89,9 +105,8 @@ class SSHlite(SSHcore):
         :returns: None
         """
 
-        for entry in self._sftp.listdir(remotepath):
-            pathname = posixpath.join(remotepath, entry)
-            mode = self._sftp.stat(pathname).st_mode
+        for pathname, attr in self.listdir_attr(remotepath):
+            mode = attr.st_mode
             if S_ISDIR(mode):
                 # It's a directory, call the dcallback function
                 if dcallback is not None:
@@ -107,39 +122,200 @@ class SSHlite(SSHcore):
                 if ucallback is not None:
                     ucallback(pathname)
 
+    def listdir_attr(self, remotepath, sftp=None):
+        """
+        Return sorted (path, attributes) for the entries in <remotepath>, from one
+        SFTP READDIR round trip (the attributes come back with the names, so entries
+        need not be stat-ed one by one). Only symbolic links are stat-ed, so that,
+        like stat, they are reported as what they point to. Uses the SFTP
+        client <sftp> if given, rather than the default one.
+        """
+        sftp = sftp or self._sftp
+        entries = []
+        for attr in sorted(sftp.listdir_attr(remotepath), key=lambda a: a.filename):
+            pathname = posixpath.join(remotepath, attr.filename)
+            if S_ISLNK(attr.st_mode):
+                try:
+                    attr = sftp.stat(pathname)
+                except FileNotFoundError:
+                    # dangling link, leave it as an unknown file type
+                    pass
+            entries.append((pathname, attr))
+        return entries
+
     def get_size(self, remote_path):
         """
         Get the size in bytes of remote file object at remote_path
         """
         return self._sftp.stat(remote_path).st_size
 
-    def get_files_and_sizes(self, remotepath, subcollections=False):
+    def iter_files_and_sizes(self, remotepath, use_find=True):
+        """
+        Yield (path, size, mtime) for all files found in the directories
+        which live below <remotepath>, as they are found, so that
+        the caller need not hold the whole listing in memory.
+
+        By default the listing comes from a single remote find command (see
+        <find_files>), with a concurrent walk over SFTP (see <walk_files>) as
+        the fallback if there is no usable shell on the remote host.
+        """
+        try:
+            self._sftp.stat(remotepath)
+        except FileNotFoundError:
+            raise FileNotFoundError(f" check {remotepath} exists?")
+        if use_find:
+            try:
+                files = self.find_files(remotepath)
+                first = next(files, None)
+            except (paramiko.SSHException, FindError) as e:
+                print(f"Remote find unavailable ({e}), walking {remotepath} over SFTP")
+            else:
+                if first is not None:
+                    yield first
+                    yield from files
+                return
+        yield from self.walk_files(remotepath)
+
+    def find_files(self, remotepath, blocksize=65536):
+        """
+        Yield (path, size, mtime) for all files below <remotepath> from one
+        remote find command, parsing the output as it streams back rather than
+        making SFTP round trips for every file. The listing is sorted on the
+        remote host so that it comes back in a repeatable order.
+
+        Raises FindError if find produced no files but complained (e.g. a find
+        without -printf).
+        """
+        command = (
+            f"find {shlex.quote(remotepath)} -type f -printf '%s %T@ %p\\0'"
+            " | LC_ALL=C sort -z -t ' ' -k3"
+        )
+        stdin, stdout, stderr = self._client.exec_command(command)
+        stdin.close()
+        found = False
+        for record in parse_find_output(iter(lambda: stdout.read(blocksize), b"")):
+            found = True
+            yield record
+        stdout.channel.recv_exit_status()
+        errors = stderr.read().decode("utf-8", "replace").strip()
+        if errors:
+            if not found:
+                raise FindError(errors.splitlines()[-1])
+            for line in errors.splitlines():
+                print("find:", line)
+
+    def walk_files(self, remotepath, channels=None, max_pending=64):
+        """
+        Yield (path, size, mtime) for each regular file below <remotepath>,
+        listing directories concurrently, each worker using its own SFTP channel
+        on the existing transport (at most <channels>, default <walk_channels>).
+        Directories are queued for listing as soon as their parent has been
+        listed, but files are yielded in a repeatable (depth first, sorted) order.
+        """
+        channels = channels or self.walk_channels
+        owner = threading.get_ident()
+        local = threading.local()
+        opened = []
+
+        def client():
+            # the consumer thread (which lists directories beyond <max_pending>)
+            # uses the default client, workers open their own channel (if there
+            # is a transport here to open it on)
+            if threading.get_ident() == owner or self.transport is None:
+                return self._sftp
+            if not hasattr(local, "sftp"):
+                try:
+                    local.sftp = paramiko.SFTPClient.from_transport(self.transport)
+                    opened.append(local.sftp)
+                except paramiko.SSHException:
+                    # the server limits the number of sessions, share the default one
+                    local.sftp = self._sftp
+            return local.sftp
+
+        def lister(path):
+            files, directories = [], []
+            for pathname, attr in self.listdir_attr(path, client()):
+                if S_ISDIR(attr.st_mode):
+                    directories.append(pathname)
+                elif S_ISREG(attr.st_mode):
+                    files.append((pathname, attr))
+            return files, directories
+
+        try:
+            for pathname, attr in ordered_walk(
+                lister, remotepath, workers=channels, max_pending=max_pending
+            ):
+                yield pathname, attr.st_size, attr.st_mtime
+        finally:
+            for sftp in opened:
+                sftp.close()
+
+    def checksum_files(
+        self, paths, method="sha256", processes=4, batch=32, blocksize=65536
+    ):
+        """
+        Checksum the remote files at <paths> on the remote host, with <processes>
+        parallel checksum commands (see REMOTE_CHECKSUMS) each given <batch> files
+        at a time, so that no file data crosses the network. The paths are pushed
+        as a NUL separated list, and (path, digest) is yielded for each file as
+        the results stream back. Files which cannot be read are reported, and
+        left out.
         """
-        Get a list of all files and their sizes found in the
-        directories which live below remote-path.
+        try:
+            command = REMOTE_CHECKSUMS[method]
+        except KeyError:
+            raise ValueError(
+                f"Cannot checksum remote files with {method} "
+                f"(available: {', '.join(REMOTE_CHECKSUMS)})"
+            )
+        listfile = f".cfstore-checksum-{uuid.uuid4().hex}"
+        listing = b"".join(p.encode("utf-8", "surrogateescape") + b"\0" for p in paths)
+        self._sftp.putfo(io.BytesIO(listing), listfile)
+        # Each batch writes its results in one go while holding a lock, so results
+        # from parallel batches cannot interleave. Without flock, checksum one file
+        # per command, since short writes to a pipe are atomic anyway.
+        batched = shlex.quote(
+            f'{command} -z -- "$@" > "$0.$$"; flock "$0" cat "$0.$$"; rm -f "$0.$$"'
+        )
+        xargs = f"xargs -0 -a {listfile} -P {int(processes)}"
+        script = (
+            f"if command -v flock > /dev/null 2>&1; "
+            f"then {xargs} -n {int(batch)} sh -c {batched} {listfile}; "
+            f"else {xargs} -n 1 {command} -z --; fi"
+        )
+        try:
+            stdin, stdout, stderr = self._client.exec_command(script)
+            stdin.close()
+            yield from parse_checksum_output(iter(lambda: stdout.read(blocksize), b""))
+            stdout.channel.recv_exit_status()
+            for line in stderr.read().decode("utf-8", "replace").splitlines():
+                print("checksum:", line)
+        finally:
+            self._sftp.remove(listfile)
+
+    def get_files_and_sizes(self, remotepath, subcollections=False, use_find=True):
+        """
+        Get a list of all files and their sizes (as (path, size, mtime)
+        tuples) found in the directories which live below remote-path.
 
         If subcollections (default False, and not yet implemented),
         additionally return for each directory below that path, a
         lists of files for that directory (without further recursion
         below each of those sub-directories).
 
+        The listing comes from a remote find, or (if that is not available or
+        <use_find> is False) a listdir_attr walk over SFTP.
+        (Use <iter_files_and_sizes> to avoid building the list.)
+
         """
 
         if subcollections:
             raise NotImplementedError
 
-        files = []
-
-        def callback(file):
-            files.append((file, self.get_size(file)))
-
         if self.logging:
             stime = time.time()
 
-        try:
-            self.walktree(remotepath, callback)
-        except FileNotFoundError:
-            raise FileNotFoundError(f" check {remotepath} exists?")
+        files = list(self.iter_files_and_sizes(remotepath, use_find=use_find))
 
         if self.logging:
             etime = time.time()
@@ -274,6 +450,47 @@ class SSHlite(SSHcore):
         return find_matching_paths(paths, expression)
 
 
+class FindError(Exception):
+    """Raised when a remote find cannot be used to list files"""
+
+
+def parse_find_output(chunks):
+    """
+    Parse the output of find -printf '%s %T@ %p\\0' given as an iterable of
+    byte <chunks> (which may split records anywhere), yielding (path, size, mtime)
+    for each NUL terminated record as soon as it is complete.
+    """
+    pending = b""
+    for chunk in chunks:
+        records = (pending + chunk).split(b"\0")
+        pending = records.pop()
+        for record in records:
+            if record:
+                size, mtime, path = record.split(b" ", 2)
+                yield path.decode("utf-8", "surrogateescape"), int(size), float(mtime)
+    if pending:
+        raise ValueError(f"Incomplete record at end of find output: {pending!r}")
+
+
+def parse_checksum_output(chunks):
+    """
+    Parse the output of sha256sum -z (and similar) given as an iterable of byte
+    <chunks>, yielding (path, digest) for each NUL terminated "digest  path"
+    (or "digest *path") record as soon as it is complete.
+    """
+    pending = b""
+    for chunk in chunks:
+        records = (pending + chunk).split(b"\0")
+        pending = records.pop()
+        for record in records:
+            if record:
+                digest, path = record.split(b" ", 1)
+                path = path[1:]
+                yield path.decode("utf-8", "surrogateescape"), digest.decode("ascii")
+    if pending:
+        raise ValueError(f"Incomplete record at end of checksum output: {pending!r}")
+
+
 def find_matching_paths(pathlist, pattern):
     """
     Given a list of paths, return a list of those paths which match
@@ -355,6 +572,17 @@ class SSHTape(SSHcore):
         lines = stdout.readlines()
         return "".join(lines)
 
+    def stream_html(self, url, option="curl", blocksize=65536):
+        """
+        As <get_html>, but yield the content in byte chunks as it arrives,
+        rather than holding it all in memory.
+        """
+        stdin, stdout, stderr = self._client.exec_command(f"{option} '{url}'")
+        yield from iter(lambda: stdout.read(blocksize), b"")
+        if stdout.channel.recv_exit_status():
+            error = stderr.read().decode("utf-8", "replace").strip()
+            raise ValueError(f"Unable to get {url}: {error}")
+
 
 if __name__ == "__main__":
     s = SSHlite("xfer1", "lawrence")
@@ -0,0 +1,80 @@
+"""
+Measure how fast the elastic tape interface fetches and parses pages, against a
+local stand-in for the elastic tape monitor (see et_standin.py), e.g.
+
+    python bench_et.py --batches 200 --files 2000 --big 200000
+
+Reports pages/s and rows/s for loading an ET_Workspace (and its batches),
+streaming one big Batch, and parsing Transfer pages.
+"""
+import argparse
+import time
+
+from cfstore.plugins import et_utils
+from cfstore.plugins.et_utils import ET_Workspace, Souper, Transfer
+from et_standin import standin
+
+
+def _report(what, seconds, pages, rows):
+    print(f'{what:<36} {seconds:8.2f}s {pages / seconds:10.1f} pages/s {rows / seconds:12.0f} rows/s')
+
+
+def bench_workspace(batches, files, threads):
+    """ Load a whole workspace (without the cache), with <threads> threads """
+    with standin(batches=batches, files=files) as server:
+        start = time.perf_counter()
+        ws = ET_Workspace('standin', threads=threads, cache=False, website=server.url)
+        seconds = time.perf_counter() - start
+        rows = batches + sum(len(b.files) for b in ws.batches.values())
+        _report(f'ET_Workspace ({threads} threads)', seconds, server.pages, rows)
+
+
+def bench_batch(files):
+    """ Stream the files of one big batch, and (for comparison) parse it into a soup """
+    with standin(batches=1, files=files) as server:
+        ws = ET_Workspace('standin', cache=False, website=server.url, load=False)
+        ws.load_batch_list()
+        batch = next(iter(ws.batches.values()))
+        for parser in (['lxml'] if et_utils.etree is not None else []) + ['html.parser']:
+            etree, et_utils.etree = et_utils.etree, (et_utils.etree if parser == 'lxml' else None)
+            try:
+                pages = server.pages
+                start = time.perf_counter()
+                rows = sum(1 for f in batch.iter_files())
+                _report(f'Batch.iter_files ({parser})', time.perf_counter() - start,
+                        server.pages - pages, rows)
+            finally:
+                et_utils.etree = etree
+        pages = server.pages
+        start = time.perf_counter()
+        soup = Souper(None, None, server.url).get(f'ET_Batch_Input_File_Details.php?batch={batch.name}')
+        rows = len(soup.find_all('table')[1].find_all('tr')[1:])
+        _report('Batch page as BeautifulSoup', time.perf_counter() - start, server.pages - pages, rows)
+
+
+def bench_transfers(aggregations, files):
+    """ Parse the summary and details pages of the aggregations in a batch """
+    with standin(batches=1, files=aggregations * files, aggregation_files=files) as server:
+        ws = ET_Workspace('standin', cache=False, website=server.url, load=False)
+        ws.load_batch_list()
+        batch = next(iter(ws.batches.values()))
+        pages = server.pages
+        start = time.perf_counter()
+        batch.load_transfers()
+        transfers = [Transfer(t.name, souper=ws.souper) for t in batch.transfers]
+        rows = len(batch.transfers) + sum(len(t.files) + len(t.transitions) for t in transfers)
+        _report('Transfer', time.perf_counter() - start, server.pages - pages, rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark elastic tape page parsing')
+    parser.add_argument('--batches', type=int, default=50, help='batches in the workspace')
+    parser.add_argument('--files', type=int, default=500, help='files per batch')
+    parser.add_argument('--threads', type=int, default=8, help='threads loading batches')
+    parser.add_argument('--big', type=int, default=100000, help='files in the big batch')
+    parser.add_argument('--aggregations', type=int, default=50, help='aggregations to parse')
+    args = parser.parse_args()
+    for threads in sorted({1, args.threads}):
+        bench_workspace(args.batches, args.files, threads)
+    bench_batch(args.big)
+    bench_transfers(args.aggregations, 100)
@@ -0,0 +1,205 @@
+"""
+A local stand-in for the elastic tape monitor (et-monitor.fds.rl.ac.uk/et_user),
+serving generated pages in the same layout as the real ones, at whatever scale
+is wanted, so that the elastic tape interface can be tested (and timed) offline.
+
+Run it with
+
+    python et_standin.py --batches 100 --files 1000
+
+and point cfstore at it with CFS_ET_WEBSITE=http://localhost:8123/
+"""
+import argparse
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class StandinWorkspace:
+    """
+    The contents of a generated elastic tape workspace: <batches> batches, each of
+    <files> files, stored in aggregations of <aggregation_files> files.
+    """
+    def __init__(self, name='standin', batches=10, files=100, aggregation_files=50):
+        self.name = name
+        self.nbatches = batches
+        self.nfiles = files
+        self.aggregation_files = aggregation_files
+        self.naggregations = -(-files // aggregation_files)
+
+    def batch_names(self):
+        return [f'{100000 + b}' for b in range(self.nbatches)]
+
+    def creation_time(self, batch):
+        return f'2020-{int(batch) % 12 + 1:02d}-01 12:00:00'
+
+    def files(self, batch):
+        """ Yield (path, size) for the files in <batch> """
+        for n in range(self.nfiles):
+            yield f'/gws/{self.name}/{batch}/dir{n // 1000}/file{n}.nc', 1000 + (int(batch) * 7 + n) % 5000
+
+    def batch_size(self, batch):
+        return sum(size for path, size in self.files(batch))
+
+    def aggregations(self, batch):
+        return [int(batch) * 1000 + a for a in range(self.naggregations)]
+
+    def aggregation_files_of(self, aggregation):
+        batch, a = str(aggregation // 1000), aggregation % 1000
+        files = list(self.files(batch))
+        return files[a * self.aggregation_files:(a + 1) * self.aggregation_files]
+
+    @property
+    def volume(self):
+        return sum(self.batch_size(b) for b in self.batch_names())
+
+
+def _row(cells, header=False):
+    tag = 'th' if header else 'td'
+    return '<tr>' + ''.join(f'<{tag}>{c}</{tag}>' for c in cells) + '</tr>\n'
+
+
+def _table(header, rows, id=None):
+    """ Yield a table in pieces, so that big tables need not be held in memory """
+    yield f'<table id="{id}">\n' if id else '<table>\n'
+    yield _row(header, header=True)
+    yield from (_row(r) for r in rows)
+    yield '</table>\n'
+
+
+def holdings_top(ws):
+    yield f'<html><body><h1>Holdings for {ws.name}</h1>\n<table><tr><td>menu</td></tr></table>\n'
+    volume = ws.volume
+    yield from _table(['Files', 'Batches', 'Aggregations', 'Tapes', 'Quota', 'Used', 'Volume'],
+                      [[ws.nbatches * ws.nfiles, ws.nbatches, ws.nbatches * ws.naggregations, 1,
+                        10 * volume, volume, volume]])
+    yield '</body></html>\n'
+
+
+def holdings_batches(ws):
+    yield f'<html><body><h1>Batches for {ws.name}</h1>\n<table><tr><td>menu</td></tr></table>\n'
+    yield '<table><tr><td>summary</td></tr></table>\n'
+    rows = ([f'<a href="ET_Batch_Input_Summary.php?workspace={ws.name}&amp;caller=etjasmin&amp;batch={b}">'
+             f'Batch {b}</a>', 'SYNCED', ws.name, ws.creation_time(b), ws.nfiles, ws.batch_size(b)]
+            for b in ws.batch_names())
+    yield from _table(['Batch', 'Status', 'Workspace', 'Created', 'Files', 'Size'], rows)
+    yield '</body></html>\n'
+
+
+def batch_file_details(ws, batch):
+    yield f'<html><body><h1>Files in batch {batch}</h1>\n<table><tr><td>menu</td></tr></table>\n'
+    yield from _table(['File', 'Size'], ws.files(batch))
+    yield '</body></html>\n'
+
+
+def batch_input_summary(ws, batch):
+    yield f'<html><body><h1>Batch {batch}</h1>\n'
+    yield '<table><tr><td>menu</td></tr></table>\n<table><tr><td>a</td></tr></table>\n'
+    yield '<table><tr><td>b</td></tr></table>\n'
+    rows = ([f'<a href="ET_Aggregation_File_Details.php?aggregation={a}">{a}</a>', 'ON_TAPE',
+             ws.creation_time(batch), ws.creation_time(batch), len(ws.aggregation_files_of(a)),
+             sum(s for p, s in ws.aggregation_files_of(a)) / 1e9, f'{a:08x}']
+            for a in ws.aggregations(batch))
+    yield from _table(['Aggregation', 'Status', 'Created', 'On tape', 'Files', 'Size (GB)', 'Checksum'], rows)
+    yield '</body></html>\n'
+
+
+def aggregation_details(ws, aggregation):
+    files = ws.aggregation_files_of(aggregation)
+    yield f'<html><body><p>Details of aggregation {aggregation}</p>\n'
+    yield from _table(['Aggregation', 'Files', 'Size', 'Started', 'Checksum', 'On tape'],
+                      [[aggregation, len(files), float(sum(s for p, s in files)),
+                        '2020-01-01 12:00:00.25', f'{aggregation:08x}', '2020-01-01 12:10:00']])
+    history = [['NEW:et1', 'CACHED:et1', '2020-01-01 12:01:00'],
+               ['CACHED:et1', 'SYNCING:et2', '2020-01-01 12:05:00'],
+               ['SYNCING:et2', 'ON_TAPE:et2', '2020-01-01 12:10:00']]
+    yield from _table(['From', 'To', 'Ended'], history, id='Aggregation History')
+    # the real page has two tables with this id
+    yield from _table(['Summary'], [], id='Aggregation details')
+    yield from _table(['File', 'Size'], ([f'<a href="#">{p}</a>', s] for p, s in files),
+                      id='Aggregation details')
+    yield '</body></html>\n'
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        ws = self.server.workspace
+        url = urlparse(self.path)
+        page = url.path.rsplit('/', 1)[-1]
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if page == 'ET_Holdings_Summary.php' and query.get('level') == 'top':
+            content = holdings_top(ws)
+        elif page == 'ET_Holdings_Summary.php' and query.get('level') == 'batches':
+            content = holdings_batches(ws)
+        elif page == 'ET_Batch_Input_File_Details.php':
+            content = batch_file_details(ws, query['batch'])
+        elif page == 'ET_Batch_Input_Summary.php':
+            content = batch_input_summary(ws, query['batch'])
+        elif page == 'ET_Aggregation_File_Details.php':
+            content = aggregation_details(ws, int(query['aggregation']))
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.end_headers()
+        buffer, size = [], 0
+        for piece in content:
+            buffer.append(piece)
+            size += len(piece)
+            if size > 65536:
+                self.wfile.write(''.join(buffer).encode())
+                buffer, size = [], 0
+        self.wfile.write(''.join(buffer).encode())
+        with self.server.lock:
+            self.server.pages += 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandinServer(ThreadingHTTPServer):
+    """
+    Serves the pages of a <StandinWorkspace>, counting the pages served.
+    """
+    daemon_threads = True
+
+    def __init__(self, workspace, port=0):
+        super().__init__(('localhost', port), _Handler)
+        self.workspace = workspace
+        self.pages = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f'http://localhost:{self.server_address[1]}/'
+
+
+@contextmanager
+def standin(**kw):
+    """
+    Run a stand-in server for a StandinWorkspace(**kw) in a background
+    thread, providing the server (whose url is server.url).
+    """
+    server = StandinServer(StandinWorkspace(**kw))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve a stand-in elastic tape monitor')
+    parser.add_argument('--port', type=int, default=8123)
+    parser.add_argument('--workspace', default='standin')
+    parser.add_argument('--batches', type=int, default=10)
+    parser.add_argument('--files', type=int, default=100, help='files per batch')
+    args = parser.parse_args()
+    server = StandinServer(StandinWorkspace(args.workspace, args.batches, args.files), args.port)
+    print(f'Serving workspace {args.workspace} at {server.url}')
+    server.serve_forever()
@@ -0,0 +1,116 @@
+import unittest
+import os, tempfile
+
+from unittest import mock
+
+from cfstore.interface import CollectionDB
+from cfstore.db import File, Variable
+from cfstore.metacache import MetadataCache
+from cfstore.plugins import posix
+
+
+class _CellMethod:
+    axes = ('area',)
+    method = 'mean'
+
+
+class _Domain:
+    def _one_line_description(self):
+        return 'aggregated domain'
+
+
+class _Field:
+    """ Stands in for a field read by cf from an aggregation file """
+    def __init__(self, n, filenames):
+        self.n = n
+        self.size = 10 * (n + 1)
+        self.domain = _Domain()
+        self.filenames = filenames
+
+    def properties(self):
+        return {'standard_name': f'aggvar{self.n}', 'units': 'K', 'realization': self.n}
+
+    def get_property(self, key, default=None):
+        return self.properties().get(key, default)
+
+    def cell_methods(self):
+        return {'cellmethod0': _CellMethod()}
+
+    def identity(self):
+        return f'aggvar{self.n}'
+
+    def get_filenames(self):
+        return set(self.filenames)
+
+
+class TestAggregation(unittest.TestCase):
+    """
+    Test adding the variables of an aggregation file, linked to their fragment files in bulk
+    """
+    def setUp(self):
+        self.db = CollectionDB()
+        self.db.init('sqlite://')
+        self.db.ingest_chunksize = 7
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.aggfile = os.path.join(self.tmpdir.name, 'agg.nca')
+        with open(self.aggfile, 'w') as f:
+            f.write('aggregation')
+        self.name = f'aggregation{id(self)}'
+        self.fragments = [(f'/gws/agg{id(self)}/{n // 10}', f'fragment{n}.nc') for n in range(30)]
+        # the first variable is split over all the fragments, the others over some of them
+        self.fields = [_Field(0, [os.path.join(*f) for f in self.fragments]),
+                       _Field(1, [os.path.join(*f) for f in self.fragments[:5]]),
+                       _Field(2, [os.path.join(*f) for f in self.fragments[20:]])]
+        self.posix = posix.Posix(self.db, f'aggregation_location{id(self)}')
+        self.db.create_collection(self.name, 'aggregated variables', {})
+        # some of the fragments are already known
+        self.db.upload_files_to_collection(self.posix.location, self.name, [
+            {'path': p, 'name': n, 'size': 1} for p, n in self.fragments[:12]])
+
+    def tearDown(self):
+        Variable.objects.filter(identity__startswith='aggvar').delete()
+        self.tmpdir.cleanup()
+
+    def _add(self, cache):
+        with mock.patch.object(posix.cf, 'read', return_value=self.fields) as read:
+            self.posix.aggregation_files_to_collection(self.aggfile, self.name, cache=cache)
+        return read.call_count
+
+    def _links(self):
+        links = Variable.in_files.through.objects.filter(variable__identity__startswith='aggvar')
+        return sorted(links.values_list('variable__identity', 'file__path', 'file__name'))
+
+    def test_links(self):
+        """ Each variable is linked to each of its fragments, and to the collection """
+        self.assertEqual(self._add(cache=False), 1)
+        expected = sorted((field.identity(), p, n) for field in self.fields
+                          for p, n in map(os.path.split, field.filenames))
+        self.assertEqual(self._links(), expected)
+        c = self.db.retrieve_collection(self.name)
+        self.assertEqual(sorted(v.identity for v in Variable.objects.filter(in_collection=c)),
+                         ['aggvar0', 'aggvar1', 'aggvar2'])
+        self.assertEqual(Variable.objects.get(identity='aggvar2')._cell_methods,
+                         [{'axes': ['area'], 'methods': 'mean'}])
+        # fragments which were not known are added as unlisted files
+        unlisted = self.db.retrieve_collection('unlisted')
+        self.assertEqual(unlisted.files.filter(path__startswith=f'/gws/agg{id(self)}/').count(), 18)
+
+    def test_rerun(self):
+        """ Adding the same aggregation again adds no variables, files or links """
+        cache = MetadataCache(os.path.join(self.tmpdir.name, 'cache.sqlite'))
+        self.assertEqual(self._add(cache), 1)
+        links, files = self._links(), File.objects.count()
+        variables = Variable.objects.filter(identity__startswith='aggvar').count()
+        # the second time round the fields come from the cache
+        self.assertEqual(self._add(cache), 0)
+        self.assertEqual(self._add(cache=False), 1)
+        self.assertEqual(self._links(), links)
+        self.assertEqual(File.objects.count(), files)
+        self.assertEqual(Variable.objects.filter(identity__startswith='aggvar').count(), variables)
+        c = self.db.retrieve_collection(self.name)
+        self.assertEqual(Variable.in_collection.through.objects.filter(collection=c).count(), 3)
+        cache.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
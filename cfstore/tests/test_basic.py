@@ -1,7 +1,9 @@
 import unittest
 from cfstore.interface import CollectionDB, CollectionError
+from cfstore.ingest import IngestJournal
 from click.testing import CliRunner
-import os
+import io, os, tempfile
+from contextlib import redirect_stderr, redirect_stdout
 from cfstore.cfdb import cli
 
 
@@ -47,6 +49,65 @@ class BasicStructure(unittest.TestCase):
 
         self.assertEqual(len(self.db.retrieve_files_in_collection('mrun1')), len(files))
 
+    def test_fileupload_chunks(self):
+        """ Test uploading files in several chunks, including replicas """
+        self.db.create_collection('mrun1', 'no real description', {})
+        self.db.create_collection('mrun2', 'no real description', {})
+        self.db.create_location('testing')
+        self.db.create_location('tape')
+        files = [{'path': '/somewhere/in/unix_land', 'name': f'file{i}', 'size': 10} for i in range(10)]
+        self.db.upload_files_to_collection('testing', 'mrun1', files, chunksize=3)
+        self.db.upload_files_to_collection('tape', 'mrun2', files[:4], chunksize=3)
+        self.assertEqual(len(self.db.retrieve_files_in_collection('mrun1')), 10)
+        self.assertEqual(len(self.db.retrieve_files_in_collection('mrun2')), 4)
+        self.assertEqual(self.db.retrieve_collection('mrun1').volume, 100)
+        self.assertEqual(self.db.retrieve_location('tape').volume, 40)
+        f = self.db.retrieve_file('/somewhere/in/unix_land', 'file2')
+        self.assertEqual(f.replicas.count(), 2)
+
+    def test_fileupload_generator(self):
+        """ Test uploading files from an iterator rather than a list """
+        self.db.create_collection('mrun1', 'no real description', {})
+        self.db.create_location('testing')
+        files = ({'path': '/somewhere/in/unix_land', 'name': f'file{i}', 'size': 1} for i in range(25))
+        summary = self.db.upload_files_to_collection('testing', 'mrun1', files, chunksize=10)
+        self.assertEqual(summary['files'], 25)
+        self.assertEqual(summary['chunks'], 3)
+        self.assertEqual(len(self.db.retrieve_files_in_collection('mrun1')), 25)
+
+    def test_fileupload_single(self):
+        """ Test uploading one file, which reports no progress """
+        self.db.create_collection('quiet1', 'no real description', {})
+        self.db.create_location('testing')
+        out, err = io.StringIO(), io.StringIO()
+        with redirect_stdout(out), redirect_stderr(err):
+            self.db.upload_file_to_collection(
+                'testing', 'quiet1', {'path': '/somewhere/in/unix_land', 'name': 'quiet_file', 'size': 1})
+        self.assertEqual((out.getvalue(), err.getvalue()), ('', ''))
+        self.assertEqual(len(self.db.retrieve_files_in_collection('quiet1')), 1)
+
+    def test_fileupload_resume(self):
+        """ Test resuming an interrupted upload from the ingest journal """
+        self.db.create_collection('mrun1', 'no real description', {})
+        self.db.create_location('testing')
+
+        def walker(fail_at=None):
+            for i in range(25):
+                if i == fail_at:
+                    raise RuntimeError('walker died')
+                yield {'path': '/somewhere/in/unix_land', 'name': f'file{i:02d}', 'size': 1}
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            journal = IngestJournal(os.path.join(tmpdir, 'journal'))
+            with self.assertRaises(RuntimeError):
+                self.db.upload_files_to_collection('testing', 'mrun1', walker(17), chunksize=5, journal=journal)
+            self.assertEqual(journal.get('testing', 'mrun1')['cursor'], 15)
+            summary = self.db.upload_files_to_collection(
+                'testing', 'mrun1', walker(), chunksize=5, journal=journal, resume=True)
+            self.assertEqual(summary['files'], 10)
+            self.assertIsNone(journal.get('testing', 'mrun1'))
+        self.assertEqual(len(self.db.retrieve_files_in_collection('mrun1')), 25)
+
     def test_add_and_retrieve_tag(self):
         """
         Need to add tags, and select by tags
@@ -0,0 +1,131 @@
+import unittest
+import os, subprocess, tempfile, threading, time
+
+from unittest import mock
+
+import cfstore.interface
+from cfstore import broker
+
+
+class _FakeSFTP:
+    """ Answers SFTP requests from the local file system """
+    def listdir(self, path):
+        return sorted(os.listdir(path))
+
+    def stat(self, path):
+        return os.stat(path)
+
+
+class _FakeChannel:
+    """ The output of a local process, read like a paramiko channel """
+    def __init__(self, process):
+        self.process = process
+
+    def recv(self, nbytes):
+        return os.read(self.process.stdout.fileno(), nbytes)
+
+    def recv_exit_status(self):
+        return self.process.wait()
+
+    def close(self):
+        self.process.kill()
+
+
+class _FakeClient:
+    """ Runs commands locally """
+    def exec_command(self, command):
+        process = subprocess.Popen(['sh', '-c', command], stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        process.stdout.channel = process.stderr.channel = _FakeChannel(process)
+        return process.stdin, process.stdout, process.stderr
+
+    def close(self):
+        pass
+
+
+class _FakeSSH:
+    """ Stands in for an SSHlite connection, counting how many are made """
+    made = 0
+
+    def __init__(self, host, user, logging=True):
+        _FakeSSH.made += 1
+        self._client = _FakeClient()
+        self._sftp = _FakeSFTP()
+
+    def isalive(self):
+        return True
+
+
+class TestBroker(unittest.TestCase):
+    """
+    Test connections are held open by the broker and shared between clients
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.env = mock.patch.dict(os.environ, {'CFS_BROKER_DIR': self.tmpdir.name})
+        self.env.start()
+        self.ssh = mock.patch('cfstore.broker.SSHlite', _FakeSSH)
+        self.ssh.start()
+        _FakeSSH.made = 0
+        self.broker = broker.Broker(idle_timeout=60)
+        self.thread = threading.Thread(target=self.broker.serve, daemon=True)
+        self.thread.start()
+        for i in range(50):
+            if broker.connect_broker() is not None:
+                break
+            time.sleep(0.1)
+
+    def tearDown(self):
+        self.broker._stop()
+        self.thread.join(5)
+        self.ssh.stop()
+        self.env.stop()
+        self.tmpdir.cleanup()
+
+    def test_shared_connection(self):
+        """ Two clients borrow the same connection """
+        for i in range(2):
+            ssh = broker.BrokeredSSHlite('host', 'user', broker.connect_broker())
+            self.assertEqual(ssh._sftp.listdir(self.tmpdir.name), ['broker.key', 'broker.sock'])
+        self.assertEqual(_FakeSSH.made, 1)
+
+    def test_remote_errors(self):
+        """ Errors on the remote side are raised in the client """
+        ssh = broker.BrokeredSSHlite('host', 'user', broker.connect_broker())
+        with self.assertRaises(FileNotFoundError):
+            ssh._sftp.stat(os.path.join(self.tmpdir.name, 'missing'))
+
+    def test_exec_streams(self):
+        """ The output of a command comes back as it is produced """
+        fifo = os.path.join(self.tmpdir.name, 'fifo')
+        os.mkfifo(fifo)
+        ssh = broker.BrokeredSSHlite('host', 'user', broker.connect_broker())
+        stdin, stdout, stderr = ssh._client.exec_command(
+            f'echo first; read line < {fifo}; echo $line; echo oops >&2; exit 3')
+        # the command is still waiting for the fifo to be written
+        self.assertEqual(stdout.readline(), 'first\n')
+        with open(fifo, 'w') as f:
+            f.write('second\n')
+        self.assertEqual(stdout.read(), b'second\n')
+        self.assertEqual(stderr.read(), b'oops\n')
+        self.assertEqual(stdout.channel.recv_exit_status(), 3)
+
+    def test_exec_alongside_calls(self):
+        """ A client can make other calls while a command is streaming """
+        client = broker.connect_broker()
+        ssh = broker.BrokeredSSHlite('host', 'user', client)
+        stdin, stdout, stderr = ssh._client.exec_command('echo first; sleep 0.5; echo second')
+        self.assertEqual(stdout.readline(), 'first\n')
+        self.assertIn('broker.key', ssh._sftp.listdir(self.tmpdir.name))
+        self.assertEqual(stdout.readlines(), ['second\n'])
+
+    def test_stop(self):
+        """ The broker can be stopped by a client """
+        broker.connect_broker().call(None, None, 'stop')
+        self.thread.join(5)
+        self.assertFalse(self.thread.is_alive())
+        self.assertIsNone(broker.connect_broker())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,207 @@
+import unittest
+import os, tempfile
+
+from unittest import mock
+
+import cfdm
+from django.db import connection
+
+from cfstore.interface import CollectionDB
+from cfstore.cfparse_file import extract_file_metadata, harvest, record_fingerprint
+from cfstore.db import File, Variable
+from cfstore.metacache import MetadataCache, file_stamp
+
+
+class TestHarvest(unittest.TestCase):
+    """
+    Test extracting CF metadata on worker processes and writing it in bulk
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.db = CollectionDB()
+        cls.db.init('sqlite://')
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.files = []
+        for n in range(3):
+            path = os.path.join(cls.tmpdir.name, f'example{n}.nc')
+            cfdm.write(cfdm.example_field(n), path)
+            cls.files.append(path)
+        cls.db.create_location('harvest')
+        cls.db.create_collection('harvest_examples', 'example fields', {})
+        cls.db.upload_files_to_collection('harvest', 'harvest_examples', [
+            {'path': cls.tmpdir.name, 'name': os.path.basename(f), 'size': os.path.getsize(f)}
+            for f in cls.files])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def tearDown(self):
+        self._variables().delete()
+
+    def _variables(self):
+        """ The variables read from the example files, which are all linked to them """
+        return Variable.objects.filter(in_files__path=self.tmpdir.name)
+
+    def test_extract_file_metadata(self):
+        """ Records are plain dictionaries describing each field """
+        records = extract_file_metadata(self.files[0])
+        self.assertEqual(len(records), 1)
+        r = records[0]
+        self.assertEqual(r['standard_name'], 'specific_humidity')
+        self.assertEqual(r['size'], 40)
+        self.assertEqual([os.path.basename(f) for f in r['filenames']], ['example0.nc'])
+        self.assertNotIn('standard_name', r['properties'])
+
+    def test_harvest(self):
+        """ Results come back in order, and unreadable files are skipped """
+        missing = os.path.join(self.tmpdir.name, 'missing.nc')
+        results = list(harvest(self.files + [missing], processes=2, batch=2))
+        self.assertEqual([f for f, r in results], self.files + [missing])
+        self.assertEqual([len(r) for f, r in results], [1, 1, 1, 0])
+
+    def test_add_variables_from_files(self):
+        """ Variables are linked to their files and collection, and not added twice """
+        added = self.db.add_variables_from_files(self.files, processes=2, collection='harvest_examples',
+                                              cache=False)
+        self.assertEqual(added, 3)
+        for var in self._variables():
+            self.assertEqual(var.in_files.count(), 1)
+            self.assertEqual([c.name for c in var.in_collection.all()], ['harvest_examples'])
+        self.assertEqual(self.db.add_variables_from_files(self.files, processes=1, cache=False), 0)
+        self.assertEqual(self._variables().count(), 3)
+
+    def test_fingerprint(self):
+        """ Fingerprints ignore property order, and old variables can be given one """
+        r = extract_file_metadata(self.files[1])[0]
+        fp = record_fingerprint(r)
+        self.assertEqual(record_fingerprint(dict(r, properties=dict(reversed(r['properties'].items())))), fp)
+        self.assertNotEqual(record_fingerprint(dict(r, size=r['size'] + 1)), fp)
+        self.db.add_variables_from_files(self.files, processes=1, cache=False)
+        self._variables().update(fingerprint=None)
+        self.assertEqual(self.db.fingerprint_variables(), 3)
+        self.assertEqual(self._variables().get(fingerprint=fp).identity, r['identity'])
+
+    def test_fingerprint_follows_edits(self):
+        """ Saving an edited variable gives it the fingerprint of its new metadata """
+        self.db.add_variables_from_files(self.files[:1], processes=1, cache=False)
+        var = self._variables().get()
+        r = extract_file_metadata(self.files[0])[0]
+        var['realization'] = 3
+        var.save()
+        edited = dict(r, properties=dict(r['properties'], realization=3))
+        self.assertEqual(self._variables().get().fingerprint, record_fingerprint(edited))
+        var.long_name = 'edited'
+        var.save(update_fields=['long_name'])
+        self.assertEqual(self._variables().get().fingerprint,
+                         record_fingerprint(dict(edited, long_name='edited')))
+        # so the edited variable is not mistaken for the original when reading the file again
+        self.assertEqual(self.db.add_variables_from_files(self.files[:1], processes=1, cache=False), 1)
+
+    def test_property_filters(self):
+        """ Property filters match typed values, and follow changes to variables """
+        self.db.add_variables_from_files(self.files, processes=1, collection='harvest_examples',
+                                         cache=False)
+        subset = self.db.retrieve_variables_subset_in_collection
+        self.assertEqual(subset('harvest_examples', {'units': 'K'}).count(), 2)
+        self.assertEqual(subset('all', {'units': 'K', 'standard_name': 'x'}).count(), 0)
+        var = subset('harvest_examples', {'units': '1'}).get()
+        var['realization'] = 3
+        var['history'] = 'x' * 1000
+        var.save()
+        self.assertEqual(subset('all', {'realization': 3}).get(), var)
+        self.assertEqual(subset('all', {'realization': '3'}).count(), 0)
+        self.assertEqual(subset('all', {'history': 'x' * 1000, 'units': '1'}).get(), var)
+        del var['realization']
+        var.save()
+        self.assertEqual(subset('all', {'realization': 3}).count(), 0)
+        self.assertEqual(self.db.index_variable_properties(), Variable.objects.count())
+
+    def test_file_ids(self):
+        """ Known files are found, and unknown ones created as unlisted, in bulk """
+        known = [(self.tmpdir.name, os.path.basename(f)) for f in self.files]
+        unknown = [('/no/such/dir', f'fragment{n}.nc') for n in range(5)]
+        ids = self.db.file_ids(known + unknown + known[:1])
+        self.assertEqual(len(ids), 8)
+        self.assertEqual(self.db.file_ids(known + unknown), ids)
+        unlisted = self.db.retrieve_collection('unlisted')
+        self.assertEqual(sorted(f.name for f in unlisted.files.all()), sorted(n for p, n in unknown))
+
+    def test_file_ids_not_returned(self):
+        """ Files created on databases which do not return ids from bulk inserts are found again """
+        unknown = [('/no/such/dir', f'unreturned{n}.nc') for n in range(3)]
+        with mock.patch.object(type(connection.features), 'can_return_rows_from_bulk_insert', False):
+            ids = self.db.file_ids(unknown)
+        self.assertEqual(ids, {(p, n): File.objects.get(path=p, name=n).pk for p, n in unknown})
+        self.assertEqual({f.checksum for f in File.objects.filter(pk__in=ids.values())}, {'None'})
+
+    def test_cache(self):
+        """ Unchanged files come from the cache, changed ones are read again """
+        cache = MetadataCache(os.path.join(self.tmpdir.name, 'cache.sqlite'))
+        first = list(harvest(self.files, processes=2, cache=cache))
+        self.assertEqual((cache.hits, cache.misses), (0, 3))
+        self.assertEqual(list(harvest(self.files, processes=2, cache=cache)), first)
+        self.assertEqual((cache.hits, cache.misses), (3, 3))
+        st = os.stat(self.files[0])
+        os.utime(self.files[0], ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        self.assertEqual(list(harvest(self.files, processes=1, cache=cache)), first)
+        self.assertEqual((cache.hits, cache.misses), (5, 4))
+        cache.close()
+
+    def test_empty_cache(self):
+        """ A new (empty) cache passed in is filled, not mistaken for no cache """
+        cache = MetadataCache(os.path.join(self.tmpdir.name, 'empty.sqlite'))
+        self.db.add_variables_from_files(self.files, processes=1, cache=cache)
+        self.assertEqual(len(cache), 3)
+        cache.close()
+
+    def test_cache_hits_commit(self):
+        """ Using cached metadata does not leave the cache locked against other processes """
+        path = os.path.join(self.tmpdir.name, 'shared.sqlite')
+        cache, other = MetadataCache(path), MetadataCache(path)
+        cache.put(('/data/shared.nc', 1, 1), [{'identity': 'x'}])
+        cache.flush()
+        self.assertEqual(other.get(('/data/shared.nc', 1, 1)), [{'identity': 'x'}])
+        self.assertFalse(other.conn.in_transaction)
+        cache.put(('/data/other.nc', 1, 1), [])
+        cache.flush()
+        cache.close()
+        other.close()
+
+    def test_default_cache_closed(self):
+        """ The cache opened when none is given is closed again """
+        path, opened = os.path.join(self.tmpdir.name, 'default.sqlite'), []
+
+        class Cache(MetadataCache):
+            def __init__(self):
+                super().__init__(path)
+                self.closed = False
+                opened.append(self)
+
+            def close(self):
+                super().close()
+                self.closed = True
+
+        with mock.patch('cfstore.interface.MetadataCache', Cache):
+            self.db.add_variables_from_file(self.files[0])
+            self.db.add_variables_from_files(self.files, processes=1)
+        self.assertEqual([c.closed for c in opened], [True, True])
+
+    def test_cache_eviction(self):
+        """ The least recently used entries go once the cache is too big """
+        cache = MetadataCache(os.path.join(self.tmpdir.name, 'evict.sqlite'), max_bytes=1000)
+        records = [{'properties': {'history': 'x' * 80}}]
+        for n in range(20):
+            cache.put((f'/data/file{n}.nc', 100, n), records)
+            # keep the first file in use
+            self.assertIsNotNone(cache.get(('/data/file0.nc', 100, 0)))
+        self.assertLessEqual(cache.total, 1000)
+        self.assertLess(len(cache), 20)
+        self.assertIsNone(cache.get(('/data/file1.nc', 100, 1)))
+        self.assertIsNotNone(cache.get(('/data/file19.nc', 100, 19)))
+        self.assertIsNone(file_stamp('/data/no/such/file.nc'))
+        cache.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+import hashlib, os, tempfile
+
+from cfstore.checksums import (available_hashes, checksum_file, checksum_files,
+                                compare_files, files_equal, register_hash)
+
+
+class TestChecksums(unittest.TestCase):
+    """
+    Test checksumming files, serially and on a process pool
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.files = []
+        for i in range(6):
+            path = os.path.join(self.tmpdir.name, f'file{i}')
+            with open(path, 'wb') as f:
+                f.write(os.urandom(1000 * i + 1))
+            self.files.append(path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _expected(self, path, method='sha256'):
+        with open(path, 'rb') as f:
+            return hashlib.new(method, f.read()).hexdigest()
+
+    def test_checksum_file(self):
+        """ Large block reads give the same answer as hashing the whole file, including partial blocks """
+        for path in self.files:
+            self.assertEqual(checksum_file(path), self._expected(path))
+            self.assertEqual(checksum_file(path, 'md5', blocksize=512), self._expected(path, 'md5'))
+
+    def test_checksum_files(self):
+        """ Results come back in order, with per worker statistics """
+        stats = {}
+        items = ((n, path) for n, path in enumerate(self.files))
+        results = list(checksum_files(items, processes=2, stats=stats, batch=4))
+        self.assertEqual([k for k, d in results], list(range(len(self.files))))
+        self.assertEqual([d for k, d in results], [self._expected(p) for p in self.files])
+        self.assertEqual(sum(s[0] for s in stats.values()), sum(os.path.getsize(p) for p in self.files))
+
+    def test_checksum_missing_file(self):
+        """ Unreadable files give no digest rather than an error """
+        items = [(0, os.path.join(self.tmpdir.name, 'missing')), (1, self.files[0])]
+        results = dict(checksum_files(items, processes=1))
+        self.assertIsNone(results[0])
+        self.assertEqual(results[1], self._expected(self.files[0]))
+
+    def test_hash_registry(self):
+        """ Every registered hash can be used, and unknown ones are refused """
+        for method in available_hashes():
+            self.assertTrue(checksum_file(self.files[1], method))
+        self.assertIn('sha256', available_hashes(cryptographic=True))
+        self.assertRaises(ValueError, checksum_file, self.files[1], 'nosuchhash')
+        self.assertRaises(ValueError, register_hash, 'md5', hashlib.md5)
+
+    def _copy(self, path, name, offset=None):
+        """ Copy a file, optionally flipping the byte at <offset> """
+        with open(path, 'rb') as f:
+            data = bytearray(f.read())
+        if offset is not None:
+            data[offset] ^= 0xff
+        copy = os.path.join(self.tmpdir.name, name)
+        with open(copy, 'wb') as f:
+            f.write(data)
+        return copy
+
+    def test_files_equal_tiers(self):
+        """ Comparison stops at the first tier which differs """
+        big = self.files[5]
+        self.assertEqual(files_equal(big, self.files[4]), (False, 'size'))
+        self.assertEqual(files_equal(big, self._copy(big, 'head', 0), block=512), (False, 'sample'))
+        self.assertEqual(files_equal(big, self._copy(big, 'inner', 700), block=512), (False, 'full'))
+        self.assertEqual(files_equal(big, self._copy(big, 'same'), block=512), (True, 'full'))
+        # small files are wholly covered by the sample
+        self.assertEqual(files_equal(big, self._copy(big, 'same2')), (True, 'sample'))
+
+    def test_compare_files(self):
+        """ Many pairs can be compared at once, in order """
+        big = self.files[5]
+        pairs = [(big, self._copy(big, 'same')), (big, self._copy(big, 'inner', 700)),
+                 (big, self.files[4]), (self.files[1], self._copy(self.files[1], 'small'))]
+        results = list(compare_files(pairs, block=512, processes=2))
+        self.assertEqual([r[:2] for r in results], pairs)
+        self.assertEqual([r[2:] for r in results],
+                         [(True, 'full'), (False, 'full'), (False, 'size'), (True, 'sample')])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,6 +6,7 @@ from click.testing import CliRunner
 from cfstore.cfdb import cli
 from cfstore.cfin import cli as incli
 from cfstore.config import CFSconfig
+from cfstore.db import Variable, Var_Metadata
 from test_basic import _dummy
 from cfstore.plugins.ssh import SSHlite
 
@@ -464,6 +465,27 @@ class Test_cfdb(unittest.TestCase):
             result = runner.invoke(cli, ['pr', 'dummy1'])
             self.assertEqual("<Result okay>", str(result))
 
+    def test_reindex(self):
+        """
+        Test that variables from before fingerprints and the property table
+        can be found by property once reindexed
+        """
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            _mysetup()
+            var = Variable(identity='reindexed', cfdm_size=1, cfdm_domain='none',
+                           _proxied={'reindex_units': 'K'}, _cell_methods=[])
+            var.save()
+            Variable.objects.filter(pk=var.pk).update(fingerprint=None)
+            Var_Metadata.objects.filter(variable=var).delete()
+            result = runner.invoke(cli, ['reindex'])
+            lines = _check(self, result, 2)
+            self.assertEqual(lines[0], '1 variables given fingerprints')
+            self.assertEqual(Variable.objects.get(pk=var.pk).fingerprint, var.fingerprint)
+            self.assertEqual(list(Var_Metadata.objects.filter(variable=var).values_list('key', 'char_value')),
+                             [('reindex_units', 'K')])
+            var.delete()
+
 
 
 if __name__=="__main__":
@@ -0,0 +1,142 @@
+import unittest
+import os, tempfile
+
+from unittest import mock
+
+from cfstore.interface import CollectionDB
+from cfstore.db import Collection, ET_Workspace_State
+from cfstore.plugins.et_main import sync_workspace_into_db
+from cfstore.plugins.et_utils import BatchCache, ET_Workspace, Transfer, iter_table_rows
+from et_standin import standin
+
+
+class TestET(unittest.TestCase):
+    """
+    Test the elastic tape interface against a local stand-in for the elastic tape monitor
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = BatchCache(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_workspace(self):
+        """ Totals, batches and files all come through """
+        with standin(batches=5, files=30) as server:
+            ws = ET_Workspace('standin', cache=self.cache, website=server.url)
+            self.assertEqual(len(ws.batches), 5)
+            self.assertEqual(ws.file_count, 150)
+            self.assertEqual(ws.volume, sum(server.workspace.batch_size(b) for b in ws.batches))
+            for name, batch in ws.batches.items():
+                self.assertEqual(list(batch.files.items()), list(server.workspace.files(name)))
+
+    def test_workspace_cached(self):
+        """ Batches are only fetched once """
+        with standin(batches=5, files=30) as server:
+            ET_Workspace('standin', cache=self.cache, website=server.url)
+            pages = server.pages
+            ws = ET_Workspace('standin', cache=self.cache, website=server.url)
+            self.assertEqual(server.pages - pages, 2)
+            self.assertEqual(sum(len(b.files) for b in ws.batches.values()), 150)
+
+    def test_stream_batch(self):
+        """ Batch files can be streamed without loading them first """
+        with standin(batches=1, files=2500) as server:
+            ws = ET_Workspace('standin', cache=False, website=server.url, load=False)
+            ws.load_batch_list()
+            name, batch = next(iter(ws.batches.items()))
+            self.assertIsNone(batch.files)
+            self.assertEqual(list(batch.iter_files()), list(server.workspace.files(name)))
+
+    def test_transfers(self):
+        """ Transfer summaries and details parse """
+        with standin(batches=1, files=120, aggregation_files=50) as server:
+            ws = ET_Workspace('standin', cache=False, website=server.url)
+            batch = next(iter(ws.batches.values()))
+            batch.load_transfers()
+            self.assertEqual([t.file_count for t in batch.transfers], [50, 50, 20])
+            transfer = Transfer(batch.transfers[-1].name, souper=ws.souper)
+            self.assertEqual(len(transfer.files), 20)
+            self.assertEqual(len(transfer.transitions), 3)
+
+    def test_table_rows(self):
+        """ Rows are found in the right table, however the page is split """
+        html = b'<table><tr><td>x</table><table><tr><th>a<th>b<tr><td>1 &amp; 2</td><td>3</table>'
+        for n in (1, 7, len(html)):
+            rows = iter_table_rows((html[i:i + n] for i in range(0, len(html), n)), 1)
+            self.assertEqual(list(rows), [['a', 'b'], ['1 & 2', '3']])
+
+
+class TestSync(unittest.TestCase):
+    """
+    Test bringing the batch collections up to date with a stand-in workspace
+    """
+    def setUp(self):
+        self.db = CollectionDB()
+        self.db.init('sqlite://')
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = BatchCache(self.tmpdir.name)
+        self.name = f'sync{id(self)}'
+
+    def tearDown(self):
+        Collection.objects.filter(name__startswith='et_1').delete()
+        ET_Workspace_State.objects.filter(workspace=self.name).delete()
+        self.tmpdir.cleanup()
+
+    def _sync(self, server):
+        ws = ET_Workspace(self.name, cache=self.cache, website=server.url, load=False)
+        return sync_workspace_into_db(ws, self.db)
+
+    def _files(self, batch):
+        c = self.db.retrieve_collection('et_' + batch)
+        return sorted((f.path, f.name, f.size) for f in c.files.all())
+
+    def _expected(self, server, batch):
+        return sorted(os.path.split(p) + (s,) for p, s in server.workspace.files(batch))
+
+    def test_new_batches(self):
+        """ Every batch is ingested the first time round, and the workspace totals kept out of sight """
+        with standin(name=self.name, batches=3, files=20) as server:
+            synced = self._sync(server)
+            self.assertEqual(synced, {'new': server.workspace.batch_names(), 'changed': [], 'vanished': []})
+            for b in server.workspace.batch_names():
+                self.assertEqual(self._files(b), self._expected(server, b))
+            state = ET_Workspace_State.objects.get(workspace=self.name)
+            self.assertEqual((state.file_count, state.volume), (60, server.workspace.volume))
+            self.assertFalse(Collection.objects.filter(name__contains=self.name).exists())
+
+    def test_unchanged(self):
+        """ Nothing beyond the workspace summary is fetched when its totals are unchanged """
+        with standin(name=self.name, batches=3, files=20) as server:
+            self._sync(server)
+            pages = server.pages
+            self.assertEqual(self._sync(server), {'new': [], 'changed': [], 'vanished': []})
+            self.assertEqual(server.pages - pages, 1)
+
+    def test_changed_batches(self):
+        """ Only new and changed batches are fetched again, and changed ones replace their old files """
+        with standin(name=self.name, batches=3, files=20) as server:
+            self._sync(server)
+            workspace = server.workspace
+            first, files = workspace.batch_names()[0], workspace.files
+
+            def changed_files(batch):
+                yield from files(batch)
+                if batch == first:
+                    yield f'/gws/{self.name}/{batch}/extra.nc', 10
+
+            workspace.nbatches = 4
+            pages = server.pages
+            with mock.patch.object(workspace, 'files', changed_files):
+                synced = self._sync(server)
+                self.assertEqual(synced, {'new': [workspace.batch_names()[-1]], 'changed': [first],
+                                          'vanished': []})
+                # the summary, the batch list, and the files of the two batches
+                self.assertEqual(server.pages - pages, 4)
+                for b in workspace.batch_names():
+                    self.assertEqual(self._files(b), self._expected(server, b))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+
+from cfstore.interface import CollectionDB
+from cfstore.db import Cell_Method_Facet, Property_Facet, Variable, rebuild_facets
+from cfstoreviewer.templatetags.tags import (getallvariablecellaxes, getallvariablecellmethods,
+                                             getpropertyvalues)
+
+
+class TestFacets(unittest.TestCase):
+    """
+    Test the facet counts behind the viewer sidebar follow changes to variables
+    """
+    def setUp(self):
+        self.db = CollectionDB()
+        self.db.init('sqlite://')
+
+    def tearDown(self):
+        Variable.objects.filter(identity__startswith='facet').delete()
+
+    def _variable(self, n, properties, cell_methods=()):
+        var = Variable(identity=f'facet{n}', cfdm_size=1, cfdm_domain='none',
+                       _proxied=properties, _cell_methods=list(cell_methods))
+        var.save()
+        return var
+
+    def _counts(self, key):
+        return {f.decoded(): f.count for f in Property_Facet.objects.filter(key=key)}
+
+    def test_property_counts(self):
+        """ Counts go up and down as variables are added, changed and removed """
+        a = self._variable(1, {'facet_units': 'K', 'facet_note': 'x' * 5000})
+        b = self._variable(2, {'facet_units': 'K'})
+        self._variable(3, {'facet_units': 'm'})
+        self.assertEqual(self._counts('facet_units'), {'K': 2, 'm': 1})
+        self.assertEqual(getpropertyvalues(('facet_units', 2)), ['K', 'm'])
+        b['facet_units'] = 'm'
+        b.save()
+        self.assertEqual(self._counts('facet_units'), {'K': 1, 'm': 2})
+        a.delete()
+        self.assertEqual(self._counts('facet_units'), {'m': 2})
+        self.assertEqual(self._counts('facet_note'), {})
+
+    def test_cell_method_counts(self):
+        self._variable(1, {}, [{'axes': ['facet_area'], 'methods': 'facet_mean'},
+                               {'axes': ['facet_time'], 'methods': 'facet_mean'}])
+        self._variable(2, {}, [{'axes': ['facet_time'], 'methods': 'facet_max'}])
+        methods = getallvariablecellmethods(None)
+        self.assertEqual((methods['facet_mean'], methods['facet_max']), (1, 1))
+        axes = getallvariablecellaxes(None)
+        self.assertEqual((axes['facet_time'], axes['facet_area']), (2, 1))
+        Variable.objects.filter(identity='facet2').delete()
+        self.assertFalse(Cell_Method_Facet.objects.filter(name='facet_max').exists())
+
+    def test_rebuild(self):
+        """ Rebuilding gives the same counts as keeping them up to date """
+        self._variable(1, {'facet_units': 'K', 'facet_flag': True}, [{'axes': ['facet_x'], 'methods': 'facet_sum'}])
+        self._variable(2, {'facet_units': 'K', 'facet_flag': 1})
+        before = sorted(Property_Facet.objects.values_list('key', 'value', 'count'))
+        rebuild_facets()
+        self.assertEqual(sorted(Property_Facet.objects.values_list('key', 'value', 'count')), before)
+        self.assertEqual(sorted(Property_Facet.objects.filter(key='facet_flag').values_list('value', 'count')),
+                         [('1', 1), ('true', 1)])
+
+
+if __name__ == "__main__":
+    unittest.main()
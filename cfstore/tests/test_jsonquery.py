@@ -0,0 +1,72 @@
+import unittest
+
+from cfstore.interface import CollectionDB
+from cfstore.db import Variable
+from cfstore.jsonquery import (cell_method_filter, ensure_json_indexes, property_filter,
+                               property_values, property_values_filter)
+
+
+class TestJSONQuery(unittest.TestCase):
+    """
+    Test filtering variables on their properties and cell methods in the database
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.db = CollectionDB()
+        cls.db.init('sqlite://')
+        cls.db.create_collection('jsonquery', 'variables to query', {})
+        c = cls.db.retrieve_collection('jsonquery')
+        variables = [
+            ('jq1', {'units': 'K', 'realization': 3, 'flag': True, 'comment': "it's"},
+             [{'axes': ['area'], 'methods': 'mean'}, {'axes': ['time'], 'methods': 'maximum'}]),
+            ('jq2', {'units': '1', 'realization': '3', 'flag': 1},
+             [{'axes': ['time'], 'methods': 'mean'}]),
+            ('jq3', {'units': 'K', 'realization': 4, 'flag': False}, []),
+        ]
+        for identity, properties, cell_methods in variables:
+            var = Variable(identity=identity, cfdm_size=1, cfdm_domain='none',
+                           _proxied=properties, _cell_methods=cell_methods)
+            var.save()
+            var.in_collection.add(c)
+        ensure_json_indexes(['units', 'realization'])
+
+    @classmethod
+    def tearDownClass(cls):
+        Variable.objects.filter(identity__startswith='jq').delete()
+
+    def _identities(self, *filters):
+        variables = Variable.objects.filter(identity__startswith='jq').filter(*filters)
+        return sorted(v.identity for v in variables)
+
+    def test_property_filter(self):
+        """ Properties match with the same type of value """
+        self.assertEqual(self._identities(*property_filter({'units': 'K'})), ['jq1', 'jq3'])
+        self.assertEqual(self._identities(*property_filter({'realization': 3})), ['jq1'])
+        self.assertEqual(self._identities(*property_filter({'realization': '3'})), ['jq2'])
+        self.assertEqual(self._identities(*property_filter({'flag': True})), ['jq1'])
+        self.assertEqual(self._identities(*property_filter({'flag': 1})), ['jq2'])
+        self.assertEqual(self._identities(*property_filter({'comment': "it's", 'units': 'K'})), ['jq1'])
+
+    def test_cell_method_filter(self):
+        self.assertEqual(self._identities(cell_method_filter('mean')), ['jq1', 'jq2'])
+        self.assertEqual(self._identities(cell_method_filter(axis='time')), ['jq1', 'jq2'])
+        self.assertEqual(self._identities(cell_method_filter('mean', 'time')), ['jq2'])
+
+    def test_property_values(self):
+        self.assertEqual(self._identities(*property_values_filter(['K', 4])), ['jq3'])
+        queryset = Variable.objects.filter(identity__startswith='jq')
+        self.assertEqual(sorted(property_values('units', queryset)), ['1', 'K'])
+        self.assertEqual(sorted(map(repr, property_values('realization', queryset))), ["'3'", '3', '4'])
+
+    def test_subset_in_collection(self):
+        """ Both ways of filtering on properties give the same answer """
+        for property_query in ('table', 'json'):
+            self.db.property_query = property_query
+            variables = self.db.retrieve_variables_subset_in_collection(
+                'jsonquery', {'units': 'K', 'realization': 4})
+            self.assertEqual([v.identity for v in variables], ['jq3'])
+        del self.db.property_query
+
+
+if __name__ == "__main__":
+    unittest.main()
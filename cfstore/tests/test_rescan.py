@@ -0,0 +1,120 @@
+import unittest
+import hashlib, os, shutil, tempfile, time
+
+from unittest import mock
+
+from cfstore.interface import CollectionDB
+from cfstore.checksums import checksum_files
+from cfstore.db import Directory_Mtime, File
+from cfstore.plugins import posix
+
+
+class TestRescan(unittest.TestCase):
+    """
+    Test bringing a walked collection up to date with the files on disk
+    """
+    def setUp(self):
+        self.db = CollectionDB()
+        self.db.init('sqlite://')
+        self.top = tempfile.mkdtemp()
+        for d in 'abc':
+            os.mkdir(os.path.join(self.top, d))
+            for i in range(3):
+                with open(os.path.join(self.top, d, f'f{i}.nc'), 'w') as f:
+                    f.write(d * i)
+        self.name = f'rescan{id(self)}'
+        self.posix = posix.Posix(self.db, 'rescan_local')
+        self.posix.add_collection(self.top, self.name, 'files to rescan',
+                                  subcollections=True, checksum='sha256')
+        # make every directory look unchanged since the walk
+        self.then = time.time() - 100
+        for d in ('', 'a', 'b', 'c'):
+            os.utime(os.path.join(self.top, d), (self.then, self.then))
+        self.posix.rescan(self.name)
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+
+    def _file(self, d, name):
+        return File.objects.get(path=os.path.join(self.top, d), name=name)
+
+    def test_unchanged(self):
+        """ Nothing is listed again when no directory has changed """
+        with mock.patch.object(posix, 'scandir_listing') as listing:
+            summary = self.posix.rescan(self.name)
+        listing.assert_not_called()
+        self.assertEqual(summary, {'added': 0, 'removed': 0, 'modified': 0, 'skipped_directories': 4})
+
+    def test_changes(self):
+        """ Adds, removes and (with deep) modifications are found, and only those are checksummed """
+        with open(os.path.join(self.top, 'b', 'new.nc'), 'w') as f:
+            f.write('new')
+        os.utime(os.path.join(self.top, 'b'), (self.then + 1, self.then + 1))
+        os.remove(os.path.join(self.top, 'a', 'f1.nc'))
+        os.utime(os.path.join(self.top, 'a'), (self.then + 1, self.then + 1))
+        with open(os.path.join(self.top, 'c', 'f2.nc'), 'w') as f:
+            f.write('changed')
+        os.utime(os.path.join(self.top, 'c'), (self.then, self.then))
+
+        summary = self.posix.rescan(self.name)
+        self.assertEqual(summary, {'added': 1, 'removed': 1, 'modified': 0, 'skipped_directories': 2})
+
+        checksummed = []
+
+        def recording(items, **kw):
+            items = list(items)
+            checksummed.extend(os.path.basename(p) for i, p in items)
+            return checksum_files(items, **kw)
+
+        with mock.patch.object(posix, 'checksum_files', recording):
+            summary = self.posix.rescan(self.name, deep=True)
+        self.assertEqual(summary, {'added': 0, 'removed': 0, 'modified': 1, 'skipped_directories': 4})
+        self.assertEqual(checksummed, ['f2.nc'])
+
+        c = self.db.retrieve_collection(self.name)
+        self.assertEqual(c.files.filter(name='f1.nc', path=os.path.join(self.top, 'a')).count(), 0)
+        new = self._file('b', 'new.nc')
+        self.assertEqual((new.checksum, new.checksum_method),
+                         (hashlib.sha256(b'new').hexdigest(), 'sha256'))
+        changed = self._file('c', 'f2.nc')
+        self.assertEqual((changed.size, changed.checksum, changed.checksum_method),
+                         (7, hashlib.sha256(b'changed').hexdigest(), 'sha256'))
+
+        # until it is checksummed again, a modified file has no checksum at all
+        with open(os.path.join(self.top, 'c', 'f2.nc'), 'w') as f:
+            f.write('changed again')
+        with mock.patch.object(self.posix, 'check_collection'):
+            self.posix.rescan(self.name, deep=True)
+        changed = self._file('c', 'f2.nc')
+        self.assertEqual((changed.checksum, changed.checksum_method), ('None', ''))
+
+    def test_unstamped_files(self):
+        """ Files ingested without an mtime and inode keep their checksums unless their size changed """
+        c = self.db.retrieve_collection(self.name)
+        c.files.update(mtime=None, inode=None)
+        Directory_Mtime.objects.filter(collection=c).delete()
+        with open(os.path.join(self.top, 'b', 'f1.nc'), 'w') as f:
+            f.write('resized')
+        before = {(f.path, f.name): f.checksum for f in c.files.all()}
+        summary = self.posix.rescan(self.name, deep=True)
+        self.assertEqual(summary, {'added': 0, 'removed': 0, 'modified': 1, 'skipped_directories': 0})
+        for f in c.files.all():
+            if f.name == 'f1.nc' and f.path.endswith('b'):
+                self.assertEqual(f.checksum, hashlib.sha256(b'resized').hexdigest())
+            else:
+                self.assertEqual((f.checksum, f.checksum_method), (before[(f.path, f.name)], 'sha256'))
+            st = os.stat(os.path.join(f.path, f.name))
+            self.assertEqual((f.mtime, f.inode), (st.st_mtime, st.st_ino))
+        self.assertEqual(self.posix.rescan(self.name, deep=True)['modified'], 0)
+
+    def test_directory_mtimes(self):
+        """ Directory times are kept in their own table, one row per directory """
+        c = self.db.retrieve_collection(self.name)
+        mtimes = Directory_Mtime.load(c)
+        self.assertEqual(sorted(mtimes), sorted(os.path.join(self.top, d).rstrip(os.sep)
+                                                for d in ('', 'a', 'b', 'c')))
+        self.assertEqual(Directory_Mtime.objects.filter(collection=c).count(), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
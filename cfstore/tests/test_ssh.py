@@ -0,0 +1,272 @@
+import unittest
+import hashlib, io, os, subprocess, tempfile, threading
+
+from stat import S_ISDIR, S_ISLNK, S_ISREG
+from unittest import mock
+
+import paramiko
+
+from cfstore.interface import CollectionDB
+from cfstore.db import File
+from cfstore.plugins.posix import RemotePosix
+from cfstore.plugins.ssh import FindError, SSHlite, parse_checksum_output, parse_find_output
+
+
+class _FakeSFTP:
+    """ Answers SFTP requests from the local file system, with relative paths below <home> """
+    def __init__(self, home):
+        self.home = home
+        self.threads = set()
+        self.closed = False
+
+    def _local(self, path):
+        return os.path.join(self.home, path)
+
+    def stat(self, path):
+        return paramiko.SFTPAttributes.from_stat(os.stat(self._local(path)))
+
+    def listdir_attr(self, path):
+        self.threads.add(threading.get_ident())
+        entries = []
+        for name in os.listdir(self._local(path)):
+            attr = paramiko.SFTPAttributes.from_stat(os.lstat(os.path.join(self._local(path), name)))
+            attr.filename = name
+            entries.append(attr)
+        return entries
+
+    def putfo(self, fl, path):
+        with open(self._local(path), 'wb') as f:
+            f.write(fl.read())
+
+    def remove(self, path):
+        os.remove(self._local(path))
+
+    def close(self):
+        self.closed = True
+
+
+class _FakeChannel:
+    def __init__(self, status):
+        self.status = status
+
+    def recv_exit_status(self):
+        return self.status
+
+
+class _FakeClient:
+    """ Runs commands locally, in <home> """
+    def __init__(self, home):
+        self.home = home
+
+    def exec_command(self, command):
+        done = subprocess.run(['sh', '-c', command], cwd=self.home, capture_output=True)
+        stdout, stderr = io.BytesIO(done.stdout), io.BytesIO(done.stderr)
+        stdout.channel = stderr.channel = _FakeChannel(done.returncode)
+        return io.BytesIO(), stdout, stderr
+
+
+class _LocalSSH(SSHlite):
+    """ An SSHlite whose remote host is this one, with <home> as the remote home directory """
+    def __init__(self, home, transport=None):
+        self.logging = False
+        self.transport = transport
+        self._client = _FakeClient(home)
+        self._sftp = _FakeSFTP(home)
+
+
+class TestFindOutput(unittest.TestCase):
+    """
+    Test parsing the streamed output of a remote find
+    """
+    data = b"3 1700000000.5 dir/a file\x0012 1700000001.0 dir/sub/b\x000 1.0 dir/new\nline\x00"
+    expected = [('dir/a file', 3, 1700000000.5), ('dir/sub/b', 12, 1700000001.0),
+                ('dir/new\nline', 0, 1.0)]
+
+    def test_parse(self):
+        """ Paths may contain spaces and newlines """
+        self.assertEqual(list(parse_find_output([self.data])), self.expected)
+
+    def test_parse_split_records(self):
+        """ Records split across chunks are reassembled """
+        for n in (1, 5, 17):
+            chunks = (self.data[i:i + n] for i in range(0, len(self.data), n))
+            self.assertEqual(list(parse_find_output(chunks)), self.expected)
+
+    def test_parse_truncated(self):
+        """ A partial record at the end is an error, not a file """
+        with self.assertRaises(ValueError):
+            list(parse_find_output([self.data + b"4 2.0 dir/c"]))
+
+
+class TestChecksumOutput(unittest.TestCase):
+    """
+    Test parsing the streamed output of remote checksum commands
+    """
+    def test_parse(self):
+        """ Both text and binary mode records are understood, split anywhere """
+        data = b"abc123  dir/a file\x00def456 *dir/b\nc\x00"
+        for n in (1, 4, len(data)):
+            chunks = (data[i:i + n] for i in range(0, len(data), n))
+            self.assertEqual(list(parse_checksum_output(chunks)),
+                             [('dir/a file', 'abc123'), ('dir/b\nc', 'def456')])
+
+
+class TestSFTPWalk(unittest.TestCase):
+    """
+    Test listing remote trees over SFTP (here, of this machine)
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.top = os.path.join(self.tmpdir.name, 'top')
+        os.makedirs(os.path.join(self.top, 'empty'))
+        for d in ('', 'b', 'b/c', 'b/c/d', 'a', 'a.d'):
+            os.makedirs(os.path.join(self.top, d), exist_ok=True)
+            for n in range(3):
+                with open(os.path.join(self.top, d, f'{d.replace("/", "")}f{2 - n}.nc'), 'w') as f:
+                    f.write('x' * n)
+        os.symlink(os.path.join(self.top, 'a', 'af0.nc'), os.path.join(self.top, 'b', 'link.nc'))
+        os.symlink(os.path.join(self.top, 'gone.nc'), os.path.join(self.top, 'b', 'dangling.nc'))
+        self.ssh = _LocalSSH(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _serial(self, path):
+        """ The files below <path> in the order of a serial depth first walk """
+        files, walked = [], []
+        for name in sorted(os.listdir(path)):
+            pathname = os.path.join(path, name)
+            if os.path.isdir(pathname):
+                walked.extend(self._serial(pathname))
+            elif os.path.isfile(pathname):
+                files.append((pathname, os.path.getsize(pathname)))
+        return files + walked
+
+    def test_listdir_attr(self):
+        """ Entries come back sorted, with links to files stat-ed, and dangling links left alone """
+        entries = self.ssh.listdir_attr(os.path.join(self.top, 'b'))
+        self.assertEqual([os.path.basename(p) for p, a in entries],
+                         ['bf0.nc', 'bf1.nc', 'bf2.nc', 'c', 'dangling.nc', 'link.nc'])
+        attrs = dict(entries)
+        self.assertTrue(S_ISREG(attrs[os.path.join(self.top, 'b', 'link.nc')].st_mode))
+        self.assertEqual(attrs[os.path.join(self.top, 'b', 'link.nc')].st_size, 2)
+        self.assertTrue(S_ISDIR(attrs[os.path.join(self.top, 'b', 'c')].st_mode))
+        self.assertTrue(S_ISLNK(attrs[os.path.join(self.top, 'b', 'dangling.nc')].st_mode))
+
+    def test_walk_order(self):
+        """ Concurrent walks give the files of nested directories in the order of a serial walk """
+        expected = self._serial(self.top)
+        self.assertIn((os.path.join(self.top, 'b', 'link.nc'), 2), expected)
+        for channels, max_pending in ((1, 64), (4, 64), (4, 1)):
+            found = [(p, s) for p, s, m in self.ssh.walk_files(self.top, channels, max_pending)]
+            self.assertEqual(found, expected)
+
+    def test_walk_channels(self):
+        """ Each worker thread lists directories on its own channel, closed at the end """
+        self.ssh.transport = object()
+        opened = []
+
+        def from_transport(transport):
+            self.assertIs(transport, self.ssh.transport)
+            opened.append(_FakeSFTP(self.tmpdir.name))
+            return opened[-1]
+
+        with mock.patch('paramiko.SFTPClient.from_transport', from_transport):
+            found = [(p, s) for p, s, m in self.ssh.walk_files(self.top, channels=3)]
+        self.assertEqual(found, self._serial(self.top))
+        self.assertTrue(1 <= len(opened) <= 3)
+        for sftp in opened:
+            self.assertEqual(len(sftp.threads), 1)
+            self.assertTrue(sftp.closed)
+        self.assertNotIn(threading.get_ident(), set().union(*(sftp.threads for sftp in opened)))
+        self.assertFalse(self.ssh._sftp.closed)
+
+    def test_walk_channels_refused(self):
+        """ If the server will not open more channels, workers share the default one """
+        self.ssh.transport = object()
+        with mock.patch('paramiko.SFTPClient.from_transport', side_effect=paramiko.SSHException):
+            found = [(p, s) for p, s, m in self.ssh.walk_files(self.top, channels=3)]
+        self.assertEqual(found, self._serial(self.top))
+        self.assertFalse(self.ssh._sftp.closed)
+
+    def test_iter_files_and_sizes(self):
+        """ Files are listed with find, or by walking if find is unavailable """
+        expected = sorted(self._serial(self.top))
+        found = [(p, s) for p, s, m in self.ssh.iter_files_and_sizes(self.top)]
+        # find does not follow the link
+        self.assertEqual(sorted(found + [(os.path.join(self.top, 'b', 'link.nc'), 2)]), expected)
+        with mock.patch.object(self.ssh, 'find_files', side_effect=FindError('no -printf')):
+            found = [(p, s) for p, s, m in self.ssh.iter_files_and_sizes(self.top)]
+        self.assertEqual(found, self._serial(self.top))
+        with self.assertRaises(FileNotFoundError):
+            list(self.ssh.iter_files_and_sizes(os.path.join(self.top, 'missing')))
+
+
+class TestRemoteChecksums(unittest.TestCase):
+    """
+    Test checksumming files on the remote host (here, this one)
+    """
+    names = ['plain.nc', 'with space.nc', 'new\nline.nc', ' leading space.nc']
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.home = os.path.join(self.tmpdir.name, 'home')
+        self.data = os.path.join(self.tmpdir.name, 'data')
+        os.mkdir(self.home)
+        os.mkdir(self.data)
+        self.contents = {}
+        for n, name in enumerate(self.names):
+            path = os.path.join(self.data, name)
+            with open(path, 'wb') as f:
+                f.write(b'x' * n)
+            self.contents[path] = b'x' * n
+        self.ssh = _LocalSSH(self.home)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_checksum_files(self):
+        """ Digests come back for awkward file names, and unreadable files are left out """
+        missing = os.path.join(self.data, 'missing.nc')
+        for processes, batch in ((1, 32), (3, 1)):
+            results = list(self.ssh.checksum_files(list(self.contents) + [missing], method='md5',
+                                                   processes=processes, batch=batch))
+            self.assertEqual(dict(results), {p: hashlib.md5(c).hexdigest() for p, c in self.contents.items()})
+            self.assertEqual(len(results), len(self.contents))
+            # the list of files pushed to the remote host is tidied up
+            self.assertEqual(os.listdir(self.home), [])
+
+    def test_unknown_method(self):
+        with self.assertRaises(ValueError):
+            list(self.ssh.checksum_files(list(self.contents), method='crc32'))
+
+    def test_check_collection(self):
+        """ Checksums made remotely are stored against the files, and changes found """
+        db = CollectionDB()
+        db.init('sqlite://')
+        location, collection = f'remote{id(self)}', f'remote_checksums{id(self)}'
+        remote = RemotePosix(db, location)
+        remote.ssh = self.ssh
+        db.create_collection(collection, 'files checksummed remotely', {})
+        db.upload_files_to_collection(location, collection, [
+            {'path': self.data, 'name': name, 'size': len(self.contents[os.path.join(self.data, name)])}
+            for name in self.names])
+        self.assertEqual(remote.check_collection(collection, processes=2), [])
+        for f in File.objects.filter(path=self.data):
+            self.assertEqual((f.checksum, f.checksum_method),
+                             (hashlib.sha256(self.contents[os.path.join(f.path, f.name)]).hexdigest(),
+                              'sha256'))
+        changed = os.path.join(self.data, 'new\nline.nc')
+        with open(changed, 'wb') as f:
+            f.write(b'changed')
+        found = remote.check_collection(collection, update=False)
+        self.assertEqual([os.path.join(f.path, f.name) for f in found], [changed])
+        f = File.objects.get(path=self.data, name='new\nline.nc')
+        self.assertNotEqual(f.checksum, hashlib.sha256(b'changed').hexdigest())
+        remote.check_collection(collection, ids=[f.pk])
+        f.refresh_from_db()
+        self.assertEqual(f.checksum, hashlib.sha256(b'changed').hexdigest())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+import os, tempfile
+
+from cfstore.walk import ordered_walk, scan_tree
+
+
+def _tree(top, depth=3, width=3, nfiles=4):
+    """ Build a small directory tree below top for walking """
+    for i in range(nfiles):
+        with open(os.path.join(top, f'file{i}.nc'), 'w') as f:
+            f.write('x' * i)
+    if depth:
+        for j in range(width):
+            d = os.path.join(top, f'dir{j}')
+            os.mkdir(d)
+            _tree(d, depth - 1, width, nfiles)
+
+
+def _serial(top, recurse=True):
+    """ The reference result: a sorted, depth first os.walk """
+    for dirname, directories, files in os.walk(top):
+        directories.sort()
+        for f in sorted(files):
+            yield os.path.join(dirname, f)
+        if not recurse:
+            break
+
+
+class TestWalk(unittest.TestCase):
+    """
+    Test the parallel tree walker produces the same stream as a serial walk
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.top = self.tmpdir.name
+        _tree(self.top)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_scan_tree_order(self):
+        """ Output is identical to a sorted serial walk, including with a small queue """
+        expected = list(_serial(self.top))
+        for workers, max_pending in [(1, 1), (4, 2), (8, 64)]:
+            found = [p for p, st in scan_tree(self.top, workers=workers, max_pending=max_pending)]
+            self.assertEqual(expected, found)
+
+    def test_scan_tree_stat(self):
+        """ File sizes come from the directory entries """
+        for p, st in scan_tree(self.top):
+            self.assertEqual(st.st_size, os.stat(p).st_size)
+
+    def test_scan_tree_no_recurse(self):
+        """ Only the top directory is listed if not recursing """
+        found = [p for p, st in scan_tree(self.top, recurse=False)]
+        self.assertEqual(list(_serial(self.top, recurse=False)), found)
+        self.assertEqual(len(found), 4)
+
+    def test_ordered_walk_early_exit(self):
+        """ Consumers can stop part way through the walk """
+        walk = scan_tree(self.top, workers=4, max_pending=4)
+        first = [next(walk) for i in range(5)]
+        walk.close()
+        self.assertEqual([p for p, st in first], list(_serial(self.top))[:5])
+
+    def test_ordered_walk_lister(self):
+        """ Any lister can be used, e.g. one describing a remote tree """
+        tree = {'/': (['/a'], ['/d1', '/d2']), '/d1': (['/d1/b'], []), '/d2': (['/d2/c'], [])}
+
+        def lister(path):
+            files, directories = tree[path]
+            return [(f, None) for f in files], directories
+
+        self.assertEqual([p for p, i in ordered_walk(lister, '/', workers=2)], ['/a', '/d1/b', '/d2/c'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+def ordered_walk(list_dir, top, workers=8, max_pending=64, recurse=True):
+    """
+    Walk the directory tree below <top>, listing directories concurrently on a
+    pool of <workers> threads, but yielding results as a single stream in the
+    same (depth first, sorted) order as a serial walk would.
+
+    <list_dir(path)> must return a tuple (files, directories) for one directory,
+    where <files> is a sorted list of (path, info) tuples (info being whatever the
+    lister knows about the file, e.g. a stat result) and <directories> is a sorted
+    list of directory paths.
+
+    Sub-directories are queued for listing as soon as their parent is listed, so
+    listings run ahead of the consumer, but no more than <max_pending> listings are
+    queued or running at once (the rest are listed when the walk reaches them).
+
+    Yields the (path, info) tuples for every file.
+    """
+    pool = ThreadPoolExecutor(max_workers=workers)
+    pending = 0
+
+    def submit(path):
+        nonlocal pending
+        if pending < max_pending:
+            pending += 1
+            return pool.submit(list_dir, path)
+        return path
+
+    try:
+        stack = [submit(top)]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, Future):
+                files, directories = item.result()
+                pending -= 1
+            else:
+                files, directories = list_dir(item)
+            if recurse:
+                stack.extend(reversed([submit(d) for d in directories]))
+            yield from files
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def scandir_listing(path):
+    """
+    List one local directory with <os.scandir>, reusing the stat information
+    from each directory entry. Returns (files, directories) as needed by
+    <ordered_walk>, where each file is a (path, os.stat_result) tuple.
+    As for <os.walk>, directories which cannot be read are ignored, and
+    symbolic links to directories are not followed.
+    """
+    files, directories = [], []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    elif entry.is_file():
+                        files.append((entry.path, entry.stat()))
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    files.sort(key=lambda f: f[0])
+    directories.sort()
+    return files, directories
+
+
+def scan_tree(top, recurse=True, workers=8, max_pending=64, dir_mtimes=None):
+    """
+    Yield (path, os.stat_result) for all files below the local directory <top>
+    (or just those in <top> if not <recurse>), listing directories in parallel.
+    Suitable for parallel file systems where the latency of each directory
+    listing dominates the time taken to walk a tree.
+
+    If a dictionary is provided as <dir_mtimes>, it is filled with the
+    modification time of each directory walked (taken before it is listed).
+    """
+    lister = scandir_listing
+    if dir_mtimes is not None:
+
+        def lister(path):
+            try:
+                dir_mtimes[path] = os.stat(path).st_mtime
+            except OSError:
+                return [], []
+            return scandir_listing(path)
+
+    return ordered_walk(
+        lister,
+        os.fspath(top),
+        workers=workers,
+        max_pending=max_pending,
+        recurse=recurse,
+    )
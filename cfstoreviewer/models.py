@@ -1,4 +1,11 @@
-from django.db import models
+import hashlib
+import json
+from collections import Counter
+
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
 
 
 def sizeof_fmt(num, suffix="B"):
@@ -9,6 +16,23 @@ def sizeof_fmt(num, suffix="B"):
     return "%.1f%s%s" % (num, "Yi", suffix)
 
 
+def variable_fingerprint(
+    identity, standard_name, long_name, size, domain, properties, cell_methods
+):
+    """
+    Return a stable hash of everything which makes a variable distinct, so that
+    duplicates can be found with one indexed lookup. Properties are sorted, but
+    cell methods keep their order, which is significant in CF.
+    """
+    canonical = json.dumps(
+        [identity, standard_name, long_name, size, domain, properties, cell_methods],
+        sort_keys=True,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
 class VDM(models.Model):
     def __len__(self):
         return len(self._proxied)
@@ -62,6 +86,9 @@ class File(models.Model):
     format = models.CharField(max_length=256, default="Unknown format")
     id = models.AutoField(primary_key=True)
     name = models.CharField(max_length=256)
+    # posix modification time and inode, used for incremental rescans
+    mtime = models.FloatField(null=True)
+    inode = models.BigIntegerField(null=True)
     locations = models.ManyToManyField(Location, related_name="filelocations")
     replicas = models.ManyToManyField(Location)
 
@@ -133,6 +160,79 @@ class Relationship(models.Model):
     related_collection = models.ManyToManyField(Collection, related_name="related")
 
 
+class Directory_Mtime(models.Model):
+    """
+    The modification time of each directory below the head of a collection
+    added by a posix walk, as last seen, so that rescans can skip unchanged
+    directories. These are kept apart from the collection properties, which
+    are loaded with every collection.
+    """
+
+    class Meta:
+        app_label = "cfstoreviewer"
+
+    collection = models.ForeignKey(
+        Collection, on_delete=models.CASCADE, related_name="dir_mtimes"
+    )
+    path = models.TextField()
+    mtime = models.FloatField()
+
+    @classmethod
+    def load(cls, collection):
+        """Return the directory modification times of <collection> as a dictionary"""
+        return dict(
+            cls.objects.filter(collection=collection).values_list("path", "mtime")
+        )
+
+    @classmethod
+    def store(cls, collection, mtimes, chunksize=1000):
+        """
+        Replace the directory modification times of <collection> with <mtimes>,
+        writing only those which have changed.
+        """
+        with transaction.atomic():
+            old = {
+                d.path: d
+                for d in cls.objects.filter(collection=collection).only(
+                    "id", "path", "mtime"
+                )
+            }
+            stale = [d.pk for p, d in old.items() if p not in mtimes]
+            changed = []
+            for p, d in old.items():
+                if p in mtimes and d.mtime != mtimes[p]:
+                    d.mtime = mtimes[p]
+                    changed.append(d)
+            for i in range(0, len(stale), chunksize):
+                cls.objects.filter(pk__in=stale[i : i + chunksize]).delete()
+            cls.objects.bulk_update(changed, ["mtime"], batch_size=chunksize)
+            cls.objects.bulk_create(
+                [
+                    cls(collection=collection, path=p, mtime=m)
+                    for p, m in mtimes.items()
+                    if p not in old
+                ],
+                batch_size=chunksize,
+            )
+
+
+class ET_Workspace_State(models.Model):
+    """
+    The totals of an elastic tape workspace as seen by the last sync, so that
+    syncs can tell when nothing has changed without listing every batch. These
+    are kept out of the collections, which are what users see.
+    """
+
+    class Meta:
+        app_label = "cfstoreviewer"
+
+    workspace = models.CharField(max_length=256, unique=True)
+    file_count = models.BigIntegerField()
+    quota_used = models.BigIntegerField()
+    volume = models.BigIntegerField()
+    synced = models.DateTimeField()
+
+
 class Variable(models.Model):
     class Meta:
         app_label = "cfstoreviewer"
@@ -171,20 +271,139 @@ class Variable(models.Model):
     in_collection = models.ManyToManyField(Collection)
     in_files = models.ManyToManyField(File)
     identity = models.CharField(max_length=1024)
+    # see variable_fingerprint
+    fingerprint = models.CharField(max_length=64, null=True, db_index=True)
+
+    def update_fingerprint(self):
+        """Set (and return) the fingerprint of this variable from its metadata"""
+        self.fingerprint = variable_fingerprint(
+            self.identity,
+            self.standard_name,
+            self.long_name,
+            self.cfdm_size,
+            self.cfdm_domain,
+            self._proxied,
+            self._cell_methods,
+        )
+        return self.fingerprint
+
+    # the fields which go into the fingerprint
+    FINGERPRINTED = {
+        "identity",
+        "standard_name",
+        "long_name",
+        "cfdm_size",
+        "cfdm_domain",
+        "_proxied",
+        "_cell_methods",
+    }
+
+    def save(self, *args, **kwargs):
+        fields = kwargs.get("update_fields")
+        if fields is None or self.FINGERPRINTED.intersection(fields):
+            self.update_fingerprint()
+            if fields is not None:
+                kwargs["update_fields"] = set(fields) | {"fingerprint"}
+        changed = fields is None or "_proxied" in fields or "_cell_methods" in fields
+        old = None
+        if changed and self.pk is not None:
+            old = (
+                Variable.objects.filter(pk=self.pk)
+                .values_list("_proxied", "_cell_methods")
+                .first()
+            )
+        super().save(*args, **kwargs)
+        if changed:
+            Var_Metadata.sync([self])
+            update_facets([(self._proxied, self._cell_methods)], [old] if old else [])
 
 
 class Var_Metadata(models.Model):
+    """
+    One property of a variable, held in the column for its type so that
+    property filters can use indexed joins rather than looking inside the
+    JSON of every variable. Kept in step with Variable._proxied by
+    Variable.save and <Var_Metadata.sync>.
+    """
+
     class Meta:
         app_label = "cfstoreviewer"
-
-    type = models.CharField(max_length=16)
-    collection_id = models.ForeignKey(Collection, on_delete=models.CASCADE)
-    json = models.BooleanField()
-    boolean_value = models.BooleanField()
-    char_value = models.TextField()
-    int_value = models.BigIntegerField()
-    real_value = models.FloatField()
+        constraints = [
+            models.UniqueConstraint(
+                fields=["variable", "key"], name="var_metadata_unique_key"
+            )
+        ]
+        indexes = [
+            models.Index(fields=["key", "char_value"], name="var_metadata_char"),
+            models.Index(fields=["key", "int_value"], name="var_metadata_int"),
+            models.Index(fields=["key", "real_value"], name="var_metadata_real"),
+            models.Index(fields=["key", "boolean_value"], name="var_metadata_bool"),
+        ]
+
+    # strings longer than this go (unindexed) in text_value
+    CHAR_LENGTH = 256
+
+    variable = models.ForeignKey(
+        Variable, on_delete=models.CASCADE, related_name="metadata"
+    )
     key = models.CharField(max_length=128)
+    # one of char, text, int, real, bool, json
+    type = models.CharField(max_length=16)
+    char_value = models.CharField(max_length=CHAR_LENGTH, null=True)
+    text_value = models.TextField(null=True)
+    int_value = models.BigIntegerField(null=True)
+    real_value = models.FloatField(null=True)
+    boolean_value = models.BooleanField(null=True)
+
+    @staticmethod
+    def column(value):
+        """Return the (type, column) in which a property <value> is held"""
+        if isinstance(value, bool):
+            return "bool", "boolean_value"
+        if isinstance(value, int):
+            return "int", "int_value"
+        if isinstance(value, float):
+            return "real", "real_value"
+        if isinstance(value, str):
+            if len(value) <= Var_Metadata.CHAR_LENGTH:
+                return "char", "char_value"
+            return "text", "text_value"
+        return "json", "text_value"
+
+    @classmethod
+    def make(cls, variable_id, key, value):
+        """Return an (unsaved) row holding property <key> of a variable"""
+        type, column = cls.column(value)
+        if type == "json":
+            value = json.dumps(value, sort_keys=True)
+        return cls(variable_id=variable_id, key=key, type=type, **{column: value})
+
+    @classmethod
+    def lookup(cls, key, value, prefix=""):
+        """
+        Return the filter arguments which match property <key> equal to
+        <value>, e.g. lookup(k, v, prefix="metadata__") for Variable queries.
+        """
+        type, column = cls.column(value)
+        if type == "json":
+            value = json.dumps(value, sort_keys=True)
+        return {prefix + "key": key, prefix + "type": type, prefix + column: value}
+
+    @classmethod
+    def sync(cls, variables):
+        """
+        Replace the property rows of (saved) <variables> with their current
+        properties, in bulk.
+        """
+        ids = [v.pk for v in variables]
+        cls.objects.filter(variable_id__in=ids).delete()
+        cls.objects.bulk_create(
+            [
+                cls.make(v.pk, k, value)
+                for v in variables
+                for k, value in v._proxied.items()
+            ]
+        )
 
 
 class Cell_Method(models.Model):
@@ -194,3 +413,142 @@ class Cell_Method(models.Model):
     id = models.AutoField(primary_key=True)
     method = models.CharField(max_length=1024)
     axis = models.CharField(max_length=256)
+
+
+class Property_Facet(models.Model):
+    """
+    The number of variables with each value of each property, kept up to
+    date as variables are added, changed and removed (see <update_facets>),
+    for the viewer sidebar.
+    """
+
+    class Meta:
+        app_label = "cfstoreviewer"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["key", "digest"], name="property_facet_unique"
+            )
+        ]
+
+    key = models.CharField(max_length=128)
+    # the value as (canonical) JSON, so that values of any type can be counted,
+    # and its md5, so that long values can be indexed
+    digest = models.CharField(max_length=32)
+    value = models.TextField()
+    count = models.BigIntegerField(default=0)
+
+    def decoded(self):
+        return json.loads(self.value)
+
+
+class Cell_Method_Facet(models.Model):
+    """
+    The number of variables with a cell method using each method, or over
+    each axis, kept up to date like <Property_Facet>.
+    """
+
+    class Meta:
+        app_label = "cfstoreviewer"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["kind", "name"], name="cell_method_facet_unique"
+            )
+        ]
+
+    # method or axis
+    kind = models.CharField(max_length=16)
+    name = models.CharField(max_length=256)
+    count = models.BigIntegerField(default=0)
+
+
+def facet_counts(variables):
+    """
+    Count the property values, cell methods and axes of <variables>, given
+    as (properties, cell methods) tuples. Each variable counts once for each.
+    """
+    properties, cell_methods = Counter(), Counter()
+    for proxied, methods in variables:
+        for key, value in (proxied or {}).items():
+            value = json.dumps(value, sort_keys=True)
+            properties[(key, hashlib.md5(value.encode()).hexdigest(), value)] += 1
+        names = set()
+        for cm in methods or []:
+            if not isinstance(cm, dict):
+                continue
+            if cm.get("methods") is not None:
+                names.add(("method", str(cm["methods"])))
+            names.update(("axis", str(a)) for a in cm.get("axes") or [])
+        cell_methods.update(names)
+    return properties, cell_methods
+
+
+def _apply_counts(model, fields, deltas):
+    """
+    Add the (non-zero) <deltas> to the counts of facet rows with values of
+    <fields> (the first two of which identify the row), dropping rows which
+    are no longer used.
+    """
+    deltas = {k: n for k, n in deltas.items() if n}
+    if not deltas:
+        return
+    model.objects.bulk_create(
+        [model(**dict(zip(fields, k))) for k, n in deltas.items() if n > 0],
+        ignore_conflicts=True,
+    )
+    for k, n in deltas.items():
+        row = model.objects.filter(**dict(zip(fields[:2], k[:2])))
+        row.update(count=F("count") + n)
+        if n < 0:
+            row.filter(count__lte=0).delete()
+
+
+def update_facets(added=(), removed=()):
+    """
+    Update the facet counts for variables <added> and <removed>, each given
+    as (properties, cell methods) tuples.
+    """
+    properties, cell_methods = facet_counts(added)
+    old_properties, old_cell_methods = facet_counts(removed)
+    properties.subtract(old_properties)
+    cell_methods.subtract(old_cell_methods)
+    _apply_counts(Property_Facet, ("key", "digest", "value"), properties)
+    _apply_counts(Cell_Method_Facet, ("kind", "name"), cell_methods)
+
+
+def index_new_variables(variables):
+    """
+    Index the properties of (saved) <variables> which were bulk created, so
+    bypassing Variable.save: fill in their property rows and count them in
+    the facets.
+    """
+    Var_Metadata.sync(variables)
+    update_facets([(v._proxied, v._cell_methods) for v in variables])
+
+
+def rebuild_facets(chunksize=1000):
+    """
+    Recount the facets from scratch, from all the variables in the database.
+    """
+    rows = Variable.objects.values_list("_proxied", "_cell_methods")
+    properties, cell_methods = facet_counts(rows.iterator(chunk_size=chunksize))
+    Property_Facet.objects.all().delete()
+    Cell_Method_Facet.objects.all().delete()
+    Property_Facet.objects.bulk_create(
+        [
+            Property_Facet(key=k, digest=d, value=v, count=n)
+            for (k, d, v), n in properties.items()
+        ],
+        batch_size=chunksize,
+    )
+    Cell_Method_Facet.objects.bulk_create(
+        [
+            Cell_Method_Facet(kind=k, name=v, count=n)
+            for (k, v), n in cell_methods.items()
+        ],
+        batch_size=chunksize,
+    )
+
+
+@receiver(pre_delete, sender=Variable)
+def _uncount_variable(sender, instance, **kwargs):
+    update_facets(removed=[(instance._proxied, instance._cell_methods)])
@@ -1,7 +1,11 @@
 from django import template
+from django.db.models import Count
 
 from cfstore.config import CFSconfig
 
+from cfstore.db import Cell_Method_Facet, Property_Facet, Variable
+from cfstore.jsonquery import property_values_filter
+
 register = template.Library()
 
 
@@ -66,33 +70,19 @@ def getuniquevariables(collection, check):
 
 @template.defaulttags.register.filter
 def getallvariableproperties(collection):
-    db = CFSconfig().db
-    variables = db.retrieve_variable("all", "")
-    properties = {}
-    for var in variables:
-        for prop, value in var._proxied.items():
-            if prop not in properties:
-                properties[prop] = [value]
-            elif value not in properties[prop]:
-                properties[prop].append(value)
-    for p in properties:
-        properties[p] = len(properties[p])
-    properties = {
-        k: v
-        for k, v in sorted(properties.items(), key=lambda item: item[1], reverse=True)
-    }
-    return properties.items()
+    # properties with the number of different values each has, most first
+    properties = (
+        Property_Facet.objects.values_list("key")
+        .annotate(values=Count("id"))
+        .order_by("-values", "key")
+    )
+    return list(properties)
 
 
 @template.defaulttags.register.filter
 def checkvar(variable, properties):
-    db = CFSconfig().db
-    variable = db.retrieve_variable("identity", variable)
-    check = True
-    for p in properties:
-        if p not in variable._proxied.values():
-            check = False
-    return check
+    variables = Variable.objects.filter(identity=variable)
+    return variables.filter(*property_values_filter(properties)).exists()
 
 
 @template.defaulttags.register.filter
@@ -129,44 +119,15 @@ def getvariableproperties(variable):
 
 @template.defaulttags.register.filter
 def getallvariablecellmethods(collection):
-    db = CFSconfig().db
-    variables = db.retrieve_variable("all", "")
-    allcellmethods = {}
-    for var in variables:
-        cellmethods = var._cell_methods
-        for cellmethod in cellmethods:
-            if isinstance(cellmethod, dict):
-                print(cellmethods)
-                method = cellmethod["methods"]
-                axes = cellmethod["axes"]
-                if method not in allcellmethods:
-                    allcellmethods[method] = [method]
-                elif method not in allcellmethods[method]:
-                    allcellmethods[method].append(method)
-    for cm in allcellmethods:
-        allcellmethods[cm] = len(allcellmethods[cm])  
-    return allcellmethods
+    facets = Cell_Method_Facet.objects.filter(kind="method").order_by("-count", "name")
+    return dict(facets.values_list("name", "count"))
+
 
 @template.defaulttags.register.filter
 def getallvariablecellaxes(collection):
-    db = CFSconfig().db
-    variables = db.retrieve_variable("all", "")
-    allcellmethods = {}
-    for var in variables:
-        cellmethods = var._cell_methods
-        for cellmethod in cellmethods:
-            if isinstance(cellmethod, dict):
-                print(cellmethods)
-                axes = cellmethod["axes"]
-                print("AXES",axes)
-                for a in axes:
-                    if a not in allcellmethods:
-                        allcellmethods[a] = [a]
-                    elif a not in allcellmethods[a]:
-                        allcellmethods[a].append(a)
-    for cm in allcellmethods:
-        allcellmethods[cm] = len(allcellmethods[cm])  
-    return allcellmethods
+    facets = Cell_Method_Facet.objects.filter(kind="axis").order_by("-count", "name")
+    return dict(facets.values_list("name", "count"))
+
 
 @template.defaulttags.register.filter
 def getcellmethods(variable):
@@ -181,13 +142,8 @@ def getcellmethodaxes(variable):
 
 @template.defaulttags.register.filter
 def getpropertyvalues(propname):
-    db = CFSconfig().db
-    variables = db.retrieve_variable("all", "")
-    output = []
-    for var in variables:
-        if propname[0] in var._proxied and var[propname[0]] not in output:
-            output.append(var[propname[0]])
-    return output
+    facets = Property_Facet.objects.filter(key=propname[0]).order_by("-count", "value")
+    return [f.decoded() for f in facets]
 
 
 @template.defaulttags.register.filter
@@ -41,6 +41,10 @@ setup(
         'cfdm',
         'python-dateutil'
     ],
+    extras_require={
+        'fasthash': ['xxhash', 'blake3'],
+        'fastparse': ['lxml'],
+    },
     entry_points={
         'console_scripts': [
             'cfdb=cfstore.cfdb:safe_cli',